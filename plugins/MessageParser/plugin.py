@@ -170,7 +170,8 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
                 return
             max_triggers = self.registryValue('maxTriggers', channel)
             for (channel, regexp, action) in results:
-                for match in re.finditer(regexp, msg.args[1]):
+                reobj = utils.str.compileRegexp(regexp)
+                for match in reobj.finditer(msg.args[1]):
                     if match is not None:
                         thisaction = action
                         self._updateRank(channel, regexp)
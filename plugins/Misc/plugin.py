@@ -34,6 +34,7 @@ import imp
 import sys
 import json
 import time
+import itertools
 
 
 import supybot
@@ -266,11 +267,8 @@ class Misc(callbacks.Plugin):
         """
         commands = {}
         L = []
-        for cb in irc.callbacks:
-            if isinstance(cb, callbacks.Plugin):
-                for command in cb.listCommands():
-                    if s in command:
-                        commands.setdefault(command, []).append(cb.name())
+        for (command, cb) in callbacks.CommandIndex.get(irc).search(s):
+            commands.setdefault(command, []).append(cb.name())
         for (key, names) in commands.items():
             for name in names:
                 L.append('%s %s' % (name, key))
@@ -420,6 +418,7 @@ class Misc(callbacks.Plugin):
         given in is searched.
         """
         predicates = {}
+        regexps = []
         nolimit = False
         skipfirst = True
         if ircutils.isChannel(msg.args[0]):
@@ -451,22 +450,7 @@ class Misc(callbacks.Plugin):
                     return arg.lower() not in m.args[1].lower()
                 predicates.setdefault('without', []).append(f)
             elif option == 'regexp':
-                def f(m, arg=arg):
-                    def f1(s, arg):
-                        """Since we can't enqueue match objects into the multiprocessing queue,
-                        we'll just wrap the function to return bools."""
-                        if process(arg.search, s, timeout=0.1) is not None:
-                            return True
-                        else:
-                            return False
-                    if ircmsgs.isAction(m):
-                        m1 = ircmsgs.unAction(m)
-                    else:
-                        m1 = m.args[1]
-                    return regexp_wrapper(m1, reobj=arg, timeout=0.1,
-                                          plugin_name=self.name(),
-                                          fcn_name='last')
-                predicates.setdefault('regexp', []).append(f)
+                regexps.append(arg)
             elif option == 'nolimit':
                 nolimit = True
         iterable = filter(self._validLastMsg, reversed(irc.state.history))
@@ -498,15 +482,25 @@ class Misc(callbacks.Plugin):
             showNick = False
         else:
             showNick = True
-        for m in iterable:
-            for predicate in predicates:
-                try:
-                    if not predicate(m):
-                        break
-                except RegexpTimeout:
-                    irc.error(_('The regular expression timed out.'))
-                    return
+        def text(m):
+            if ircmsgs.isAction(m):
+                return ircmsgs.unAction(m)
             else:
+                return m.args[1]
+        iterable = (m for m in iterable
+                    if all(predicate(m) for predicate in predicates))
+        while True:
+            # The regexps are evaluated by the sandbox pool for a chunk of
+            # messages at once, rather than one process per message.
+            chunk = list(itertools.islice(iterable, 100))
+            if not chunk:
+                break
+            for reobj in regexps:
+                matches = regexp_filter([text(m) for m in chunk], reobj,
+                                        timeout=0.1, plugin_name=self.name(),
+                                        fcn_name='last')
+                chunk = [m for (m, match) in zip(chunk, matches) if match]
+            for m in chunk:
                 if nolimit:
                     resp.append(ircmsgs.prettyPrint(m,
                                                     timestampFormat=tsf,
@@ -275,7 +275,7 @@ class Relay(callbacks.Plugin):
                 return
             ignores = self.registryValue('ignores', channel)
             for ignore in ignores:
-                if ircutils.hostmaskPatternEqual(ignore, msg.prefix):
+                if ircutils.compileHostmaskPattern(ignore).match(msg.prefix):
                     self.log.debug('Refusing to relay %s, ignored by %s.',
                                    msg.prefix, ignore)
                     return
@@ -97,7 +97,15 @@ class Status(callbacks.Plugin):
         s = format(_('I have spawned %n; %n %b still currently active: %L.'),
                    (world.threadsSpawned, 'thread'),
                    (len(threads), 'thread'), len(threads), threads)
-        irc.reply(s)
+        stats = world.threadPool.stats()
+        s += format(_('  Thread pool: %i running, %i queued, %i rejected; '
+                      '%i completed'), stats['running'], stats['queued'],
+                    stats['rejected'], stats['completed'])
+        if stats['p50'] is not None:
+            s += format(_(', latency %.2f/%.2f/%.2f seconds (50th, 90th '
+                          'and 99th percentiles)'),
+                        stats['p50'], stats['p90'], stats['p99'])
+        irc.reply(s + '.')
     threads = wrap(threads)
 
     def processes(self, irc, msg, args):
@@ -125,13 +133,44 @@ class Status(callbacks.Plugin):
             timeElapsed = utils.timeElapsed(elapsed)
         except KeyError:
             timeElapsed = _('an indeterminate amount of time')
-        irc.reply(format(_('I have received %s messages for a total of %S.  '
+        s = format(_('I have received %s messages for a total of %S.  '
                   'I have sent %s messages for a total of %S.  '
                   'I have been connected to %s for %s.'),
                   self.recvdMsgs, self.recvdBytes,
-                  self.sentMsgs, self.sentBytes, irc.server, timeElapsed))
+                  self.sentMsgs, self.sentBytes, irc.server, timeElapsed)
+        driver = irc.getRealIrc().driver
+        if getattr(driver, 'outbound', None) is not None:
+            s += '  ' + format(_('I am sending %S per second, and %S are '
+                                 'waiting to be sent.'),
+                               int(driver.outbound.rate()),
+                               driver.outboundDepth())
+        irc.reply(s)
     net = wrap(net)
 
+    @internationalizeDocstring
+    def throttle(self, irc, msg, args):
+        """takes no arguments
+
+        Returns how fast the bot may send queued messages to this network, and
+        how long it will take to send the messages currently in the queue.
+        """
+        realIrc = irc.getRealIrc()
+        throttleTime = conf.supybot.protocols.irc.throttleTime()
+        burst = conf.supybot.protocols.irc.throttleTime.burst()
+        if throttleTime > 0:
+            rate = _('%.2f messages per second') % (1 / throttleTime)
+        else:
+            rate = _('as fast as the connection allows')
+        queued = len(realIrc.queue)
+        delay = realIrc.throttle.expectedDelay(queued)
+        irc.reply(format(_('I can send bursts of %n, then %s.  '
+                           'I have sent %n from the queue; %n %b waiting, '
+                           'and will be sent within %.1f seconds.'),
+                         (burst, 'message'), rate,
+                         (realIrc.throttle.sent, 'message'),
+                         (queued, 'message'), queued, delay))
+    throttle = wrap(throttle)
+
     @internationalizeDocstring
     def cpu(self, irc, msg, args):
         """takes no arguments
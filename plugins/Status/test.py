@@ -38,6 +38,9 @@ class StatusTestCase(PluginTestCase):
     def testNet(self):
         self.assertNotError('net')
 
+    def testThrottle(self):
+        self.assertRegexp('throttle', 'bursts of 1 message')
+
     def testCpu(self):
         m = self.assertNotError('status cpu')
         self.failIf('kB kB' in m.args[1])
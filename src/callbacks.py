@@ -40,6 +40,7 @@ from . import shlex
 import codecs
 import getopt
 import inspect
+import weakref
 
 from . import (conf, ircdb, irclib, ircmsgs, ircutils, log, registry,
         utils, world)
@@ -731,10 +732,11 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
                     log.debug('Done calling invalidCommands: %s.',cb.name())
                     return
         if threaded:
-            name = 'Thread #%s (for invalidCommands)' % world.threadsSpawned
-            t = world.SupyThread(target=callInvalidCommands, name=name)
-            t.setDaemon(True)
-            t.start()
+            if not world.threadPool.submit(callInvalidCommands,
+                                           key='invalidCommands',
+                                           name='invalidCommands'):
+                log.warning('Thread pool queue full, not calling '
+                            'invalidCommands for %r.', self.args)
         else:
             callInvalidCommands()
 
@@ -745,10 +747,8 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
         args = list(map(canonicalName, args))
         cbs = []
         maxL = []
-        for cb in self.irc.callbacks:
-            if not hasattr(cb, 'getCommand'):
-                continue
-            L = cb.getCommand(args)
+        index = CommandIndex.get(self.irc)
+        for (cb, L) in index.lookup(args):
             #log.debug('%s.getCommand(%r) returned %r', cb.name(), args, L)
             if L and L >= maxL:
                 maxL = L
@@ -833,9 +833,7 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
             args = self.args[len(command):]
             if world.isMainThread() and \
                (cb.threaded or conf.supybot.debug.threadAllCommands()):
-                t = CommandThread(target=cb._callCommand,
-                                  args=(command, self, self.msg, args))
-                t.start()
+                threadCommand(cb._callCommand, (command, self, self.msg, args))
             else:
                 cb._callCommand(command, self, self.msg, args)
 
@@ -1067,6 +1065,26 @@ class CommandThread(world.SupyThread):
         finally:
             self.cb.threaded = self.originalThreaded
 
+def threadCommand(target, args=(), kwargs={}):
+    """Calls target (a plugin's _callCommand) with args in the thread pool,
+    like CommandThread does in its own thread.  If the queue of the pool is
+    full, replies that the bot is too busy instead."""
+    command = args[0]
+    cb = target.__self__
+    def run():
+        originalThreaded = cb.threaded
+        cb.threaded = True
+        try:
+            target(*args, **kwargs)
+        finally:
+            cb.threaded = originalThreaded
+    name = '%s.%s' % (cb.name(), formatCommand(command))
+    log.debug('Queueing %s in the thread pool (args: %r)', name, args)
+    if not world.threadPool.submit(run, key=cb.name(), name=name):
+        log.warning('Thread pool queue full, not running %s.', name)
+        args[1].error(_('I\'m too busy to do that right now; try again '
+                        'later.'))
+
 class CommandProcess(world.SupyProcess):
     """Just does some extra logging and error-recovery for commands that need
     to run in processes.
@@ -1107,6 +1125,135 @@ conf.registerGlobalValue(conf.supybot.commands, 'disabled',
     commands will not appear in command lists, etc.  They will appear not even
     to exist.""")))
 
+class CommandIndex(object):
+    """Trie of the commands of the callbacks of an Irc, from which
+    findCallbacksForArgs gets the callbacks having a command in its args
+    without asking each callback.
+
+    Callbacks deciding by themselves what their commands are (those
+    overriding getCommand or isCommandMethod, like Aka, Alias or RSS) are
+    not in the trie, but asked on each lookup.  The index is rebuilt when
+    callbacks are added or removed, or when invalidate() is called."""
+    _generation = 0
+    def __init__(self, callbacks):
+        self.generation = (irclib.Irc._callbacksGeneration,
+                           CommandIndex._generation)
+        # Nodes map words to their children, and None to the list of the
+        # callbacks for which the path to the node is a command.
+        self.root = {}
+        self.dynamic = []
+        self.order = {}
+        self.callbacks = list(callbacks)
+        # Built on the first search.
+        self.listed = None
+        self.trigrams = None
+        for (i, cb) in enumerate(callbacks):
+            if not hasattr(cb, 'getCommand'):
+                continue
+            self.order[cb] = i
+            if self._isStatic(cb):
+                for command in self._commands(cb):
+                    node = self.root
+                    for word in command:
+                        node = node.setdefault(word, {})
+                    cbs = node.setdefault(None, [])
+                    if cb not in cbs:
+                        cbs.append(cb)
+            else:
+                self.dynamic.append(cb)
+
+    @classmethod
+    def invalidate(cls):
+        """Makes the indexes be rebuilt; to be called when the commands of a
+        callback change without callbacks being added or removed."""
+        cls._generation += 1
+
+    @classmethod
+    def get(cls, irc):
+        """Returns the up-to-date index of the callbacks of irc."""
+        while isinstance(irc, ReplyIrcProxy):
+            irc = irc.irc
+        index = getattr(irc, '_commandIndex', None)
+        if index is None or index.generation != \
+                (irclib.Irc._callbacksGeneration, cls._generation):
+            index = cls(irc.callbacks)
+            irc._commandIndex = index
+        return index
+
+    @staticmethod
+    def _isStatic(cb):
+        """Returns whether the commands of cb are found the usual way, by
+        Commands.getCommand, and so can be indexed."""
+        cls = type(cb)
+        for attr in ('getCommand', 'isCommandMethod', 'isDisabled'):
+            if irclib._definingClass(cls, attr) is not Commands:
+                return False
+        return all(CommandIndex._isStatic, cb.cbs)
+
+    def _commands(self, cb, stripOwnName=True):
+        """Returns the commands cb.getCommand may return."""
+        name = cb.canonicalName()
+        commands = []
+        for sub in cb.cbs:
+            subName = sub.canonicalName()
+            commands.extend([L for L in self._commands(sub)
+                             if L[0] == subName])
+        if stripOwnName:
+            commands.extend([[name] + L
+                             for L in self._commands(cb, False)])
+        for attr in dir(cb):
+            if cb.isCommandMethod(attr):
+                commands.append([attr])
+        return commands
+
+    def lookup(self, args):
+        """Returns a list of (callback, command) pairs, in the order of the
+        callbacks, command being what callback.getCommand(args) returns."""
+        found = {}
+        node = self.root
+        for (i, word) in enumerate(args):
+            node = node.get(word)
+            if node is None:
+                break
+            for cb in node.get(None, ()):
+                found[cb] = args[:i+1] # The longest command wins.
+        for cb in self.dynamic:
+            found[cb] = cb.getCommand(args)
+        return sorted(found.items(), key=lambda x: self.order[x[0]])
+
+    def _isListed(self, cb):
+        return cb not in self.dynamic and \
+            irclib._definingClass(type(cb), 'listCommands') is Commands
+
+    def search(self, s):
+        """Returns the (command, plugin) pairs of the commands listed by the
+        plugins' listCommands which contain s.  The commands of plugins
+        having static commands are listed once, in an index of their
+        trigrams; the others are listed on each search."""
+        if self.listed is None:
+            self.listed = []
+            self.trigrams = {}
+            for cb in self.callbacks:
+                if isinstance(cb, Plugin) and self._isListed(cb):
+                    for command in cb.listCommands():
+                        for i in range(len(command) - 2):
+                            postings = self.trigrams.setdefault(
+                                    command[i:i+3], set())
+                            postings.add(len(self.listed))
+                        self.listed.append((command, cb))
+        if len(s) < 3:
+            candidates = range(len(self.listed))
+        else:
+            candidates = min([self.trigrams.get(s[i:i+3], ())
+                              for i in range(len(s) - 2)], key=len)
+        found = [self.listed[i] for i in sorted(candidates)
+                 if s in self.listed[i][0]]
+        for cb in self.callbacks:
+            if isinstance(cb, Plugin) and not self._isListed(cb):
+                found.extend([(command, cb) for command in cb.listCommands()
+                              if s in command])
+        return found
+
 class DisabledCommands(object):
     def __init__(self):
         self.d = CanonicalNameDict()
@@ -1130,6 +1277,7 @@ class DisabledCommands(object):
         return False
 
     def add(self, command, plugin=None):
+        CommandIndex.invalidate()
         if plugin is None:
             self.d[command] = None
         else:
@@ -1140,6 +1288,7 @@ class DisabledCommands(object):
                 self.d[command] = CanonicalNameSet([plugin])
 
     def remove(self, command, plugin=None):
+        CommandIndex.invalidate()
         if plugin is None:
             del self.d[command]
         else:
@@ -1160,6 +1309,19 @@ class BasePlugin(object):
                 cb.log = log.getPluginLogger('%s.%s' % (self.name(),cb.name()))
         super(BasePlugin, self).__init__()
 
+class CommandRegistry(object):
+    """Commands of a Commands class, computed once: the names of its methods
+    which are commands (disabled or not), and their help, by command,
+    simpleSyntax and docstring (docstrings change when the locale does)."""
+    __slots__ = ('generation', 'names', 'help')
+    def __init__(self, cb):
+        self.generation = CommandIndex._generation
+        self.names = frozenset(name for name in dir(cb)
+                               if cb._isCommandMethod(name))
+        self.help = {}
+
+_commandRegistries = weakref.WeakKeyDictionary()
+
 class MetaSynchronizedAndFirewalled(log.MetaFirewall, utils.python.MetaSynchronized):
     pass
 SynchronizedAndFirewalled = MetaSynchronizedAndFirewalled(
@@ -1190,15 +1352,26 @@ class Commands(BasePlugin, SynchronizedAndFirewalled):
     def isDisabled(self, command):
         return self._disabled.disabled(command, self.name())
 
+    def _getCommandRegistry(self):
+        cls = self.__class__
+        registry = _commandRegistries.get(cls)
+        if registry is None or registry.generation != CommandIndex._generation:
+            registry = CommandRegistry(self)
+            _commandRegistries[cls] = registry
+        return registry
+
     def isCommandMethod(self, name):
         """Returns whether a given method name is a command in this plugin."""
+        if self.isDisabled(name):
+            return False
+        return name in self._getCommandRegistry().names
+
+    def _isCommandMethod(self, name):
         # This function is ugly, but I don't want users to call methods like
         # doPrivmsg or __init__ or whatever, and this is good to stop them.
 
         # Don't normalize this name: consider outFilter(self, irc, msg).
         # name = canonicalName(name)
-        if self.isDisabled(name):
-            return False
         if name != canonicalName(name):
             return False
         if hasattr(self, name):
@@ -1248,6 +1421,8 @@ class Commands(BasePlugin, SynchronizedAndFirewalled):
         if len(command) > 1:
             assert command[0] == self.canonicalName()
             return self.getCommandMethod(command[1:])
+        elif command[0] in self._getCommandRegistry().names:
+            return getattr(self, command[0])
         else:
             method = getattr(self, command[0])
             if inspect.ismethod(method):
@@ -1259,7 +1434,7 @@ class Commands(BasePlugin, SynchronizedAndFirewalled):
 
     def listCommands(self, pluginCommands=[]):
         commands = set(pluginCommands)
-        for s in dir(self):
+        for s in self._getCommandRegistry().names:
             if self.isCommandMethod(s):
                 commands.add(s)
         for cb in self.cbs:
@@ -1338,7 +1513,17 @@ class Commands(BasePlugin, SynchronizedAndFirewalled):
         if simpleSyntax:
             help = getSyntax
         if hasattr(method, '__doc__'):
-            return help(method, name=formatCommand(command))
+            if not inspect.ismethod(method):
+                # Made on the fly, like Alias' aliases; not worth caching.
+                return help(method, name=formatCommand(command))
+            cache = self._getCommandRegistry().help
+            key = (tuple(command), bool(simpleSyntax), method.__doc__)
+            try:
+                return cache[key]
+            except KeyError:
+                s = help(method, name=formatCommand(command))
+                cache[key] = s
+                return s
         else:
             return format(_('The %q command has no help.'),
                           formatCommand(command))
@@ -1363,6 +1548,7 @@ class PluginMixin(BasePlugin, irclib.IrcCallback):
     def canonicalName(self):
         return canonicalName(self.name())
 
+    _callOnlyDispatches = True
     def __call__(self, irc, msg):
         irc = SimpleProxy(irc, msg)
         if msg.command == 'PRIVMSG':
@@ -32,6 +32,7 @@
 Includes wrappers for commands.
 """
 
+import os
 import time
 import getopt
 import inspect
@@ -61,9 +62,7 @@ def thread(f):
     def newf(self, irc, msg, args, *L, **kwargs):
         if world.isMainThread():
             targetArgs = (self.callingCommand, irc, msg, args) + tuple(L)
-            t = callbacks.CommandThread(target=self._callCommand,
-                                        args=targetArgs, kwargs=kwargs)
-            t.start()
+            callbacks.threadCommand(self._callCommand, targetArgs, kwargs)
         else:
             f(self, irc, msg, args, *L, **kwargs)
     return utils.python.changeFunctionName(newf, f.__name__, f.__doc__)
@@ -72,6 +71,233 @@ class ProcessTimeoutError(Exception):
     """Gets raised when a process is killed due to timeout."""
     pass
 
+class ProcessDiedError(ProcessTimeoutError):
+    """Gets raised when a process of the sandbox pool dies before
+    returning."""
+    pass
+
+class _Unpicklable(Exception):
+    pass
+
+def _closeInheritedFds(keep):
+    """Points the file descriptors the bot had open when the worker was
+    forked (sockets of the connections, databases, ...) to /dev/null, so
+    that when the bot closes them, they really are closed.  They are not
+    simply closed, so that objects inherited from the bot still referring to
+    them can't close files the worker opens later."""
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        try:
+            fds = range(3, os.sysconf('SC_OPEN_MAX'))
+        except (AttributeError, ValueError, OSError):
+            fds = range(3, 256)
+    null = os.open(os.devnull, os.O_RDWR)
+    try:
+        for fd in fds:
+            if fd <= 2 or fd == null or fd in keep:
+                continue
+            try:
+                os.fstat(fd)
+            except OSError: # Not open
+                continue
+            os.dup2(null, fd)
+    finally:
+        os.close(null)
+
+def _sandboxWorker(conn, heap_size):
+    """Main loop of the processes of a SandboxPool: receives
+    (f, args, kwargs, items) jobs and sends back f(*args, **kwargs), or
+    f(item, *args, **kwargs) for each item if items is not None.  Exceptions
+    are sent instead of the result."""
+    if os.name == 'posix':
+        _closeInheritedFds([conn.fileno()])
+    if resource and heap_size is not None:
+        resource.setrlimit(resource.RLIMIT_DATA, (heap_size, heap_size))
+    while True:
+        try:
+            (f, args, kwargs, items) = conn.recv()
+        except (EOFError, IOError, KeyboardInterrupt):
+            return
+        except Exception as e:
+            # For instance, f is in a plugin loaded after we were forked.
+            conn.send(_Unpicklable(repr(e)))
+            continue
+        if items is None:
+            calls = [args]
+        else:
+            calls = [(item,) + tuple(args) for item in items]
+        for callArgs in calls:
+            try:
+                r = f(*callArgs, **kwargs)
+            except Exception as e:
+                r = e
+            try:
+                conn.send(r)
+            except (EOFError, IOError):
+                return
+            except Exception as e:
+                # Unpicklable result
+                conn.send(Exception(repr(e)))
+
+class _SandboxWorker(object):
+    __slots__ = ('process', 'conn', 'heapSize')
+    def __init__(self, heapSize):
+        (self.conn, child) = multiprocessing.Pipe()
+        self.heapSize = heapSize
+        self.process = callbacks.CommandProcess(target=_sandboxWorker,
+                args=(child, heapSize), kwargs={'pn': 'Sandbox', 'cn': 'pool'})
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def send(self, job):
+        try:
+            self.conn.send(job)
+        except (EOFError, IOError, OSError):
+            raise
+        except Exception as e:
+            raise _Unpicklable(e)
+
+    def kill(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+class SandboxPool(object):
+    """Keeps up to size() processes running, with their memory already
+    limited to heapSize() bytes (0 for no limit), to call functions out of
+    the bot's process.  A process that runs out of time is killed and
+    replaced.  The functions and their arguments must be picklable."""
+    def __init__(self, size, heapSize):
+        self.size = size
+        self.heapSize = heapSize
+        self.lock = threading.Condition()
+        self.idle = []
+        self.workers = 0
+
+    def enabled(self):
+        return not world.disableMultiprocessing and self.size() > 0
+
+    def _heapSize(self):
+        heapSize = self.heapSize()
+        if resource and heapSize:
+            return heapSize
+        elif resource:
+            return resource.RLIM_INFINITY
+        else:
+            return None
+
+    def _acquire(self):
+        heapSize = self._heapSize()
+        with self.lock:
+            while True:
+                while self.idle:
+                    worker = self.idle.pop()
+                    if worker.heapSize == heapSize and \
+                       worker.process.is_alive():
+                        return worker
+                    self.workers -= 1
+                    worker.kill()
+                if self.workers < max(self.size(), 1):
+                    self.workers += 1
+                    break
+                self.lock.wait()
+        try:
+            return _SandboxWorker(heapSize)
+        except Exception:
+            with self.lock:
+                self.workers -= 1
+                self.lock.notify()
+            raise
+
+    def _release(self, worker, dead=False):
+        with self.lock:
+            if dead or self.workers > self.size():
+                self.workers -= 1
+                worker.kill()
+            else:
+                self.idle.append(worker)
+            self.lock.notify()
+
+    def _submit(self, job):
+        """Returns an idle worker to which job was sent."""
+        while True:
+            worker = self._acquire()
+            try:
+                worker.send(job)
+                return worker
+            except _Unpicklable:
+                self._release(worker)
+                raise
+            except Exception:
+                # The worker died while idle; try another one.
+                self._release(worker, dead=True)
+
+    def _recv(self, worker, timeout, name):
+        if not worker.conn.poll(timeout):
+            raise ProcessTimeoutError('%s aborted due to timeout.' % name)
+        try:
+            v = worker.conn.recv()
+        except EOFError:
+            raise ProcessDiedError('%s aborted because its process died.'
+                                   % name)
+        if isinstance(v, _Unpicklable):
+            raise v
+        return v
+
+    def call(self, f, args=(), kwargs={}, timeout=None, name='sandbox'):
+        """Returns f(*args, **kwargs), or the exception it raised.  Raises
+        ProcessTimeoutError if it took more than timeout seconds,
+        ProcessDiedError if the process died, and _Unpicklable if the
+        process could not unpickle f or its arguments."""
+        worker = self._submit((f, args, kwargs, None))
+        dead = True
+        try:
+            v = self._recv(worker, timeout, name)
+            dead = False
+            return v
+        except _Unpicklable:
+            dead = False
+            raise
+        finally:
+            self._release(worker, dead)
+
+    def map(self, f, items, args=(), kwargs={}, timeout=None, name='sandbox'):
+        """Returns the list of f(item, *args, **kwargs) for each item, sending
+        all of them to a single process at once.  timeout applies to each
+        item; the results of items that took more than timeout seconds are
+        ProcessTimeoutError instances, and the remaining items are sent to
+        another process.  Results are exceptions raised by f; the other
+        errors are raised like for call()."""
+        items = list(items)
+        results = []
+        while len(results) < len(items):
+            rest = items[len(results):]
+            worker = self._submit((f, args, kwargs, rest))
+            dead = True
+            try:
+                for item in rest:
+                    try:
+                        results.append(self._recv(worker, timeout, name))
+                    except ProcessDiedError:
+                        raise
+                    except ProcessTimeoutError as e:
+                        results.append(e)
+                        break
+                else:
+                    dead = False
+            except _Unpicklable:
+                dead = False
+                raise
+            finally:
+                self._release(worker, dead)
+        return results
+
+sandbox = SandboxPool(conf.supybot.commands.sandbox.workers,
+                      conf.supybot.commands.sandbox.heapSize)
+
 def process(f, *args, **kwargs):
     """Runs a function <f> in a subprocess.
     
@@ -81,9 +307,24 @@ def process(f, *args, **kwargs):
     <timeout>, if supplied, limits the length of execution of target 
     function to <timeout> seconds.
     <heap_size>, if supplied, limits the memory used by the target
-    function."""
+    function.
+
+    Unless <heap_size> is supplied, <f> is run by a process of the sandbox
+    pool if it and its arguments can be pickled."""
     timeout = kwargs.pop('timeout', None)
     heap_size = kwargs.pop('heap_size', None)
+    if heap_size is None and sandbox.enabled():
+        pn = kwargs.pop('pn', 'Unknown')
+        cn = kwargs.pop('cn', 'unknown')
+        try:
+            v = sandbox.call(f, args, kwargs, timeout=timeout,
+                             name='%s.%s' % (pn, cn))
+        except _Unpicklable:
+            kwargs.update(pn=pn, cn=cn)
+        else:
+            if isinstance(v, Exception):
+                raise v
+            return v
     if resource and heap_size is None:
         heap_size = resource.RLIM_INFINITY
 
@@ -94,7 +335,7 @@ def process(f, *args, **kwargs):
             return f(*args, **kwargs)
         except Exception as e:
             raise e
-    
+
     try:
         q = multiprocessing.Queue()
     except OSError:
@@ -135,23 +376,66 @@ def process(f, *args, **kwargs):
     else:
         return v
 
+def _regexpSearch(s, reobj):
+    """Since we can't enqueue match objects into the multiprocessing queue,
+    we'll just wrap the function to return bools."""
+    return reobj.search(s) is not None
+
+def _sandboxedSearch(s, reobj, timeout, plugin_name, fcn_name):
+    try:
+        v = process(_regexpSearch, s, reobj, timeout=timeout, pn=plugin_name, cn=fcn_name)
+        return v
+    except ProcessTimeoutError:
+        return False
+
 def regexp_wrapper(s, reobj, timeout, plugin_name, fcn_name):
     '''A convenient wrapper to stuff regexp search queries through a subprocess.
     
     This is used because specially-crafted regexps can use exponential time
-    and hang the bot.'''
-    def re_bool(s, reobj):
-        """Since we can't enqueue match objects into the multiprocessing queue,
-        we'll just wrap the function to return bools."""
-        if reobj.search(s) is not None:
-            return True
-        else:
-            return False
+    and hang the bot.  Linear regexps are tried in this process first, for
+    up to <timeout> seconds.'''
+    if utils.safere.isLinear(reobj):
+        try:
+            return utils.safere.searchBefore(reobj, s, time.time() + timeout)
+        except utils.safere.Timeout:
+            pass
+    return _sandboxedSearch(s, reobj, timeout, plugin_name, fcn_name)
+
+def regexp_filter(strings, reobj, timeout, plugin_name, fcn_name):
+    """Returns a list of whether reobj matches each of the strings, like
+    regexp_wrapper does, but evaluating all of them in a single round-trip
+    to the sandbox pool.  <timeout> applies to each string; linear regexps
+    are tried in this process first, for up to <timeout> seconds in total."""
+    results = []
+    if utils.safere.isLinear(reobj):
+        deadline = time.time() + timeout
+        try:
+            for s in strings:
+                results.append(utils.safere.searchBefore(reobj, s, deadline))
+        except utils.safere.Timeout:
+            pass
+    if len(results) < len(strings):
+        results.extend(_sandboxedFilter(strings[len(results):], reobj,
+                                        timeout, plugin_name, fcn_name))
+    return results
+
+def _sandboxedFilter(strings, reobj, timeout, plugin_name, fcn_name):
+    if not sandbox.enabled():
+        return [_sandboxedSearch(s, reobj, timeout, plugin_name, fcn_name)
+                for s in strings]
     try:
-        v = process(re_bool, s, reobj, timeout=timeout, pn=plugin_name, cn=fcn_name)
-        return v
-    except ProcessTimeoutError:
-        return False
+        results = sandbox.map(_regexpSearch, strings, (reobj,),
+                              timeout=timeout,
+                              name='%s.%s' % (plugin_name, fcn_name))
+    except _Unpicklable:
+        return [_sandboxedSearch(s, reobj, timeout, plugin_name, fcn_name)
+                for s in strings]
+    for (i, v) in enumerate(results):
+        if isinstance(v, ProcessTimeoutError):
+            results[i] = False
+        elif isinstance(v, Exception):
+            raise v
+    return results
 
 class UrlSnarfThread(world.SupyThread):
     def __init__(self, *args, **kwargs):
@@ -220,9 +504,16 @@ def urlSnarfer(f):
         if threading.currentThread() is not world.mainThread:
             doSnarf()
         else:
-            L = list(L)
-            t = UrlSnarfThread(target=doSnarf, url=url)
-            t.start()
+            def snarf():
+                try:
+                    doSnarf()
+                except utils.web.Error as e:
+                    log.debug('Exception in urlSnarfer: %s',
+                              utils.exnToString(e))
+            if not world.threadPool.submit(snarf, key=self.name(),
+                                           name='snarfing %s' % url):
+                self.log.info('Thread pool queue full, not snarfing %s in '
+                              '%s.', url, channel)
     newf = utils.python.changeFunctionName(newf, f.__name__, f.__doc__)
     return newf
 
@@ -1125,7 +1416,7 @@ __all__ = [
     # Decorators.
     'urlSnarfer', 'thread',
     # Functions.
-    'wrap', 'process', 'regexp_wrapper',
+    'wrap', 'process', 'regexp_wrapper', 'regexp_filter',
     # Stuff for testing.
     'Spec',
 ]
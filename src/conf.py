@@ -758,6 +758,42 @@ registerGlobalValue(supybot.commands, 'allowShell',
     Setting this to False also disables plugins and commands that can be
     used to indirectly gain shell access.""")))
 
+registerGroup(supybot.commands, 'threads')
+registerGlobalValue(supybot.commands.threads, 'maximum',
+    registry.NonNegativeInteger(16, _("""Determines how many threads at most
+    the bot runs threaded commands and URL snarfers in; the others wait for
+    one of them in a queue.  If this is 0, each of them gets a new
+    thread.""")))
+registerGlobalValue(supybot.commands.threads, 'queueSize',
+    registry.NonNegativeInteger(100, _("""Determines how many threaded
+    commands and URL snarfers may wait for a thread.  When the queue is full,
+    the bot replies it is too busy to threaded commands, and ignores URLs.
+    0 means there is no limit.""")))
+registerGlobalValue(supybot.commands.threads, 'perPlugin',
+    registry.NonNegativeInteger(4, _("""Determines how many threads a
+    single plugin may use at once, so a plugin can't keep the others waiting.
+    0 means there is no limit.""")))
+
+registerGroup(supybot.commands, 'sandbox')
+registerGlobalValue(supybot.commands.sandbox, 'workers',
+    registry.NonNegativeInteger(2, _("""Determines how many processes are
+    kept running to evaluate user-supplied code, such as regular expressions,
+    out of the bot's process, so that it can be stopped when it takes too
+    long.  If this is 0, each evaluation forks a new process.""")))
+registerGlobalValue(supybot.commands.sandbox, 'heapSize',
+    registry.NonNegativeInteger(0, _("""Determines how much memory (in
+    bytes) each of these processes may use.  0 means there is no limit.""")))
+
+registerGroup(supybot.commands, 'regexps')
+registerGlobalValue(supybot.commands.regexps, 'safe',
+    registry.Boolean(False, _("""Determines whether regular expressions
+    given by users are matched by an engine taking linear time (RE2, if it is
+    installed) instead of Python's, which can take exponential time on some
+    expressions.  These are then matched in the bot's process, without a
+    timeout.  Expressions using features only Python's engine supports
+    (backreferences, lookaround assertions) are still matched by it.""")))
+utils.str.safeRegexps = supybot.commands.regexps.safe
+
 # supybot.commands.disabled moved to callbacks for canonicalName.
 
 ###
@@ -814,13 +850,21 @@ registerGlobalValue(supybot.drivers, 'poll',
     driver should block waiting for input.""")))
 
 class ValidDriverModule(registry.OnlySomeStrings):
-    validStrings = ('default', 'Socket', 'Twisted')
+    validStrings = ('default', 'Socket', 'Asyncio', 'Twisted')
 
 registerGlobalValue(supybot.drivers, 'module',
     ValidDriverModule('default', _("""Determines what driver module the 
     bot will use. The default is Socket which is simple and stable 
-    and supports SSL. Twisted doesn't work if the IRC server which 
-    you are connecting to has IPv6 (most of them do).""")))
+    and supports SSL. Asyncio (Python 3.4 and newer) runs all the networks
+    on a single event loop instead of polling them, which uses less CPU when
+    the bot is connected to many networks. Twisted doesn't work if the IRC
+    server which you are connecting to has IPv6 (most of them do).""")))
+
+registerGlobalValue(supybot.drivers, 'receiveBufferSize',
+    registry.PositiveInteger(65536, _("""Determines how many bytes the
+    Socket driver reads from a server at once.  Larger values make big bursts
+    of messages (netsplits, NAMES or WHO replies in large channels) cheaper to
+    process.""")))
 
 registerGlobalValue(supybot.drivers, 'maxReconnectWait',
     registry.PositiveFloat(300.0, _("""Determines the maximum time the bot will
@@ -971,6 +1015,14 @@ registerGlobalValue(supybot.databases.channels, 'filename',
     for the channels database.  This file will go into the directory specified
     by the supybot.directories.conf variable.""")))
 
+registerGlobalValue(supybot.databases, 'journalSize',
+    registry.NonNegativeInteger(1000, _("""Determines how many changes to the
+    users, channels, and ignores databases are appended to their journal
+    (a file next to the database, ending in .journal) before the database file
+    is rewritten.  The database is never rewritten before its journal is
+    longer than the database itself.  If set to 0, the whole database file is
+    rewritten on every change.""")))
+
 # TODO This will need to do more in the future (such as making sure link.allow
 # will let the link occur), but for now let's just leave it as this.
 class ChannelSpecific(registry.Boolean):
@@ -1046,6 +1098,29 @@ registerGlobalValue(supybot.databases.types.cdb, 'maximumModifications',
 
 # XXX Configuration variables for dbi, sqlite, flat, mysql, etc.
 
+###
+# supybot.caches
+###
+registerGroup(supybot, 'caches')
+registerGlobalValue(supybot.caches, 'hostmaskPatterns',
+    registry.PositiveInteger(1000, _("""Determines how many compiled hostmask
+    patterns the bot keeps in memory.""")))
+registerGlobalValue(supybot.caches, 'hostmaskMatches',
+    registry.PositiveInteger(1000, _("""Determines how many results of
+    matching a hostmask against a hostmask pattern the bot keeps in
+    memory.""")))
+registerGlobalValue(supybot.caches, 'users',
+    registry.PositiveInteger(1000, _("""Determines how many user names and
+    hostmasks the user database keeps the matching user of in memory.""")))
+registerGlobalValue(supybot.caches, 'capabilities',
+    registry.PositiveInteger(10000, _("""Determines how many capability checks
+    the bot keeps the result of in memory.""")))
+
+ircutils._patternCache = utils.structures.CacheDict(
+    supybot.caches.hostmaskPatterns)
+ircutils._hostmaskPatternEqualCache = utils.structures.CacheDict(
+    supybot.caches.hostmaskMatches)
+
 ###
 # Protocol information.
 ###
@@ -1165,6 +1240,16 @@ registerGlobalValue(supybot.protocols.irc, 'throttleTime',
     registry.Float(1.0, _("""A floating point number of seconds to throttle
     queued messages -- that is, messages will not be sent faster than once per
     throttleTime seconds.""")))
+registerGlobalValue(supybot.protocols.irc.throttleTime, 'burst',
+    registry.PositiveInteger(1, _("""Determines how many queued messages
+    the bot may send at once after it has not sent anything for a while; one
+    more message is then allowed every throttleTime seconds.  Most servers
+    tolerate small bursts, but check your network's flood limits before
+    raising this.""")))
+registerGlobalValue(supybot.protocols.irc.throttleTime, 'bytesPerToken',
+    registry.NonNegativeInteger(0, _("""If non-zero, sending a queued message
+    counts as one more message for each of this many bytes it contains, so
+    long messages are throttled more than short ones.""")))
 
 registerGlobalValue(supybot.protocols.irc, 'ping',
     registry.Boolean(True, _("""Determines whether the bot will send PINGs to
@@ -1185,6 +1270,33 @@ registerGlobalValue(supybot.protocols.irc.queuing, 'duplicates',
     message multiple times; most of the time it doesn't matter, unless you're
     doing certain kinds of plugin hacking.""")))
 
+class QueuingFairness(registry.OnlySomeStrings):
+    validStrings = ('messages', 'bytes')
+
+registerGlobalValue(supybot.protocols.irc.queuing, 'fairness',
+    QueuingFairness('messages', _("""Determines how the bot shares its
+    outgoing queue between the channels and nicks it sends messages to.
+    'messages' sends one message to each of them in turn; 'bytes' sends them
+    the same amount of data, so targets getting long messages get fewer of
+    them.""")))
+registerGlobalValue(supybot.protocols.irc.queuing, 'maxPerTarget',
+    registry.NonNegativeInteger(0, _("""Determines how many messages to the
+    same channel or nick may wait in the outgoing queue.  0 means there is no
+    limit.  See supybot.protocols.irc.queuing.overflow for what happens to
+    messages over the limit.""")))
+
+class QueuingOverflow(registry.OnlySomeStrings):
+    validStrings = ('drop', 'dropOldest', 'merge')
+
+registerGlobalValue(supybot.protocols.irc.queuing, 'overflow',
+    QueuingOverflow('drop', _("""Determines what happens to a message queued
+    for a channel or nick which already has
+    supybot.protocols.irc.queuing.maxPerTarget messages waiting.  'drop'
+    drops the new message, 'dropOldest' drops the oldest waiting message
+    instead, and 'merge' appends the text of the new message to the last
+    waiting one when they are both PRIVMSGs or NOTICEs and the result fits in
+    a single line (otherwise, the new message is dropped).""")))
+
 registerGroup(supybot.protocols.irc.queuing, 'rateLimit')
 registerGlobalValue(supybot.protocols.irc.queuing.rateLimit, 'join',
     registry.Float(0, _("""Determines how many seconds must elapse between
@@ -0,0 +1,481 @@
+###
+# Copyright (c) 2002-2004, Jeremiah Fincher
+# Copyright (c) 2010, 2013, James McCoy
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Contains a driver running the connections to all the networks on a single
+asyncio event loop.  Requires Python 3.4 or newer.
+
+Unlike the Socket driver, nothing is polled: the loop wakes up when a
+connection is readable, when a throttled message may be sent, when a
+reconnection is due, or when the next event of the scheduler is due.
+"""
+
+from __future__ import division
+
+import os
+import ssl
+import time
+import socket
+import asyncio
+import functools
+
+from .. import (conf, drivers, ircmsgs, log, schedule, utils, world)
+from ..utils.str import decode_raw_lines
+
+# All the connections share this loop; it is run by the AsyncioRunnerDriver
+# below, which is itself run by drivers.run().
+loop = asyncio.new_event_loop()
+
+class AsyncioRunnerDriver(drivers.IrcDriver):
+    """Runs the event loop until supybot.drivers.poll seconds elapsed or the
+    next scheduled event is due, whichever comes first."""
+    def name(self):
+        return self.__class__.__name__
+
+    def run(self):
+        timeout = conf.supybot.drivers.poll()
+        nextEvent = schedule.schedule.nextEventTime()
+        if nextEvent is not None:
+            timeout = max(0, min(timeout, nextEvent - time.time()))
+        handle = loop.call_later(timeout, loop.stop)
+        try:
+            loop.run_forever()
+        except Exception:
+            drivers.log.exception('Uncaught exception in the event loop:')
+        finally:
+            handle.cancel()
+
+class IrcProtocol(asyncio.Protocol):
+    """Forwards the events of a single connection to its driver.
+
+    A new protocol is created for each connection, so events from an old
+    connection still being torn down are ignored by the driver."""
+    def __init__(self, driver):
+        self.driver = driver
+
+    def connection_made(self, transport):
+        self.driver._connectionMade(self, transport)
+
+    def data_received(self, data):
+        self.driver._dataReceived(self, data)
+
+    def connection_lost(self, exc):
+        self.driver._connectionLost(self, exc)
+
+class AsyncioDriver(drivers.IrcDriver, drivers.ServersMixin):
+    def __init__(self, irc):
+        assert irc is not None
+        self.irc = irc
+        drivers.IrcDriver.__init__(self, irc)
+        drivers.ServersMixin.__init__(self, irc)
+        self.conn = None
+        self.protocol = None
+        self.transport = None
+        self._attempt = -1
+        self.servers = ()
+        self.inbuffer = bytearray()
+        self.zombie = False
+        self.connected = False
+        self.connectTask = None
+        self.timeoutHandle = None
+        self.reconnectHandle = None
+        self.sendHandle = None
+        self.resetDelay()
+        self.connect()
+
+    def getDelay(self):
+        ret = self.currentDelay
+        self.currentDelay = min(self.currentDelay * 2,
+                                conf.supybot.drivers.maxReconnectWait())
+        return ret
+
+    def resetDelay(self):
+        self.currentDelay = 10.0
+
+    def _getNextServer(self):
+        oldServer = getattr(self, 'currentServer', None)
+        server = drivers.ServersMixin._getNextServer(self)
+        if self.currentServer != oldServer:
+            self.resetDelay()
+        return server
+
+    def _getSslContext(self):
+        network_config = getattr(conf.supybot.networks, self.irc.network)
+        certfile = network_config.certfile()
+        if not certfile:
+            certfile = conf.supybot.protocols.irc.certfile()
+        if not certfile:
+            certfile = None
+        elif not os.path.isfile(certfile):
+            drivers.log.warning('Could not find cert file %s.' %
+                    certfile)
+            certfile = None
+        verifyCertificates = conf.supybot.protocols.ssl.verifyCertificates()
+        if not verifyCertificates:
+            drivers.log.warning('Not checking SSL certificates, connections '
+                    'are vulnerable to man-in-the-middle attacks. Set '
+                    'supybot.protocols.ssl.verifyCertificates to "true" '
+                    'to enable validity checks.')
+        return utils.net.create_ssl_context(certfile=certfile,
+                verify=verifyCertificates,
+                trusted_fingerprints=network_config.ssl.serverFingerprints(),
+                ca_file=network_config.ssl.authorityCertificate(),
+                )
+
+    def _checkFingerprints(self, transport):
+        """Returns whether the certificate of the server matches one of the
+        trusted fingerprints, if there are some."""
+        network_config = getattr(conf.supybot.networks, self.irc.network)
+        fingerprints = network_config.ssl.serverFingerprints()
+        if not fingerprints or \
+                not conf.supybot.protocols.ssl.verifyCertificates():
+            return True
+        if transport.get_extra_info('sslcontext') is None:
+            return True # Not (yet) using TLS.
+        sslobj = transport.get_extra_info('ssl_object')
+        if sslobj is None:
+            drivers.log.error('%s: This Python version cannot check the '
+                              'fingerprint of the server\'s certificate with '
+                              'the Asyncio driver.', self.irc.network)
+            return False
+        try:
+            utils.net.check_certificate_fingerprint(sslobj, fingerprints)
+        except ssl.CertificateError as e:
+            drivers.log.error(('Certificate validation failed when '
+                'connecting to %s: %s\n'
+                'This means either someone is doing a man-in-the-middle '
+                'attack on your connection, or the server\'s certificate is '
+                'not in your trusted fingerprints list.')
+                % (self.irc.network, e.args[0]))
+            return False
+        return True
+
+    def _scheduleSend(self):
+        """Wakes the loop up when the next throttled message may be sent."""
+        if self.sendHandle is not None:
+            return
+        if self.irc.fastqueue:
+            delay = self.irc.fastqueue.delay()
+        elif self.irc.queue:
+            delay = max(self.irc.throttle.delay(), self.irc.queue.delay())
+        else:
+            return
+        self.sendHandle = loop.call_later(delay, self._sendIfMsgs)
+
+    def _sendIfMsgs(self):
+        self.sendHandle = None
+        if not self.connected:
+            return
+        # The transport buffers the data itself, and takeMsg may make us die
+        # (and close the transport) once the Irc's queues are empty.
+        msg = self.irc.takeMsg()
+        while msg is not None and self.transport is not None:
+            data = str(msg).encode()
+            self.transport.write(data)
+            self.outbound.add(len(data))
+            msg = self.irc.takeMsg()
+        if self.connected:
+            self._scheduleSend()
+
+    def outboundDepth(self):
+        if self.transport is None:
+            return 0
+        return self.transport.get_write_buffer_size()
+
+    def _dataReceived(self, protocol, data):
+        if protocol is not self.protocol:
+            return
+        self.inbuffer += data
+        end = self.inbuffer.rfind(b'\n')
+        if end == -1:
+            return
+        lines = decode_raw_lines(self.inbuffer[:end])
+        del self.inbuffer[:end+1]
+        for line in lines:
+            msg = drivers.parseMsg(line)
+            if msg is not None and self.irc is not None:
+                self.irc.feedMsg(msg)
+        if self.irc and not self.irc.zombie:
+            self._sendIfMsgs()
+
+    def _connectionMade(self, protocol, transport):
+        if protocol is not self.protocol:
+            transport.abort()
+            return
+        if not self._checkFingerprints(transport):
+            transport.abort()
+            return
+        self.transport = transport
+        self.connected = True
+        self.resetDelay()
+        self._sendIfMsgs()
+
+    def _connectionLost(self, protocol, exc):
+        if protocol is not self.protocol:
+            return
+        self.protocol = None
+        self.transport = None
+        self.connected = False
+        self.inbuffer = bytearray()
+        if self.zombie:
+            self._reallyDie()
+            return
+        drivers.log.disconnect(self.currentServer, exc)
+        self.scheduleReconnect()
+
+    def _connectDone(self, task):
+        if task is not self.connectTask:
+            return
+        self.connectTask = None
+        if self.timeoutHandle is not None:
+            self.timeoutHandle.cancel()
+            self.timeoutHandle = None
+        if task.cancelled():
+            e = 'Timed out'
+        else:
+            e = task.exception()
+        if e is not None:
+            self.protocol = None
+            self.conn.close()
+            drivers.log.connectError(self.currentServer, e)
+            self.scheduleReconnect()
+        # Otherwise, the transport now owns the socket.
+        self.conn = None
+
+    def _socketConnected(self, sock, protocol, sslContext, serverHostname,
+            task):
+        if task is not self.connectTask:
+            return
+        if task.cancelled() or task.exception() is not None:
+            self._connectDone(task)
+            return
+        self._startConnection(sock, protocol, sslContext, serverHostname)
+
+    def _startConnection(self, sock, protocol, sslContext, serverHostname):
+        self.connectTask = asyncio.ensure_future(
+                loop.create_connection(lambda: protocol, sock=sock,
+                    ssl=sslContext, server_hostname=serverHostname),
+                loop=loop)
+        self.connectTask.add_done_callback(self._connectDone)
+
+    def run(self):
+        # The loop itself is run by the AsyncioRunnerDriver; this only makes
+        # sure messages queued from outside the loop (scheduled events,
+        # threaded commands) are not held until the next loop event.
+        if self.connected:
+            self._sendIfMsgs()
+
+    def connect(self, **kwargs):
+        self.reconnect(reset=False, **kwargs)
+
+    def reconnect(self, wait=False, reset=True):
+        self._attempt += 1
+        if self.reconnectHandle is not None:
+            self.reconnectHandle.cancel()
+            self.reconnectHandle = None
+        self._cancelConnect()
+        if self.transport is not None:
+            drivers.log.reconnect(self.irc.network)
+            self.transport.abort()
+        self.protocol = None
+        self.transport = None
+        self.connected = False
+        self.inbuffer = bytearray()
+        if reset:
+            drivers.log.debug('Resetting %s.', self.irc)
+            self.irc.reset()
+        else:
+            drivers.log.debug('Not resetting %s.', self.irc)
+        if wait:
+            self.scheduleReconnect()
+            return
+        self.server = self._getNextServer()
+        network_config = getattr(conf.supybot.networks, self.irc.network)
+        socks_proxy = network_config.socksproxy()
+        try:
+            if socks_proxy:
+                import socks
+        except ImportError:
+            log.error('Cannot use socks proxy (SocksiPy not installed), '
+                    'using direct connection instead.')
+            socks_proxy = ''
+        if socks_proxy:
+            address = self.server[0]
+        else:
+            try:
+                address = utils.net.getAddressFromHostname(self.server[0],
+                        attempt=self._attempt)
+            except (socket.gaierror, socket.error) as e:
+                drivers.log.connectError(self.currentServer, e)
+                self.scheduleReconnect()
+                return
+        port = self.server[1]
+        drivers.log.connect(self.currentServer)
+        try:
+            sock = utils.net.getSocket(address, port=port,
+                    socks_proxy=socks_proxy,
+                    vhost=conf.supybot.protocols.irc.vhost(),
+                    vhostv6=conf.supybot.protocols.irc.vhostv6(),
+                    )
+            # SOCKS sockets cannot connect asynchronously; others are
+            # connected by the loop.
+            timeout = max(10, conf.supybot.drivers.poll()*10)
+            sock.settimeout(timeout)
+            if socks_proxy:
+                sock.connect((address, port))
+            if network_config.ssl():
+                sslContext = self._getSslContext()
+                serverHostname = self.server[0]
+            else:
+                sslContext = serverHostname = None
+                if not network_config.requireStarttls():
+                    drivers.log.warning(('Connection to network %s '
+                        'does not use SSL/TLS, which makes it vulnerable to '
+                        'man-in-the-middle attacks and passive eavesdropping. '
+                        'You should consider upgrading your connection to '
+                        'SSL/TLS '
+                        '<http://doc.supybot.aperio.fr/en/latest/use/faq.html#how-to-make-a-connection-secure>')
+                        % self.irc.network)
+        except socket.error as e:
+            drivers.log.connectError(self.currentServer, e)
+            self.scheduleReconnect()
+            return
+        sock.setblocking(False)
+        self.conn = sock
+        protocol = IrcProtocol(self)
+        self.protocol = protocol
+        if socks_proxy:
+            self._startConnection(sock, protocol, sslContext, serverHostname)
+        else:
+            # Connecting the socket returned by utils.net.getSocket, rather
+            # than giving the host and port to create_connection, keeps its
+            # vhost handling.
+            self.connectTask = asyncio.ensure_future(
+                    loop.sock_connect(sock, (address, port)), loop=loop)
+            self.connectTask.add_done_callback(functools.partial(
+                self._socketConnected, sock, protocol, sslContext,
+                serverHostname))
+        # We allow more time for the connect here, since it might take longer.
+        self.timeoutHandle = loop.call_later(timeout, self._cancelConnect,
+                                             True)
+
+    def _cancelConnect(self, timedOut=False):
+        if self.timeoutHandle is not None:
+            self.timeoutHandle.cancel()
+            self.timeoutHandle = None
+        task = self.connectTask
+        if task is None or task.done():
+            return
+        if timedOut:
+            # _connectDone will schedule the reconnection.
+            task.cancel()
+        else:
+            self.connectTask = None
+            task.cancel()
+            self.conn.close()
+            self.conn = None
+
+    def scheduleReconnect(self):
+        delay = self.getDelay()
+        if not world.dying:
+            drivers.log.reconnect(self.irc.network, time.time() + delay)
+        if self.reconnectHandle is not None:
+            drivers.log.error('Updating next reconnect time when one is '
+                              'already present.  This is a bug; please '
+                              'report it, with an explanation of what caused '
+                              'this to happen.')
+            self.reconnectHandle.cancel()
+        self.reconnectHandle = loop.call_later(delay, self._reconnectNow)
+
+    def _reconnectNow(self):
+        self.reconnectHandle = None
+        self.reconnect()
+
+    def die(self):
+        self.zombie = True
+        if self.reconnectHandle is not None:
+            self.reconnectHandle.cancel()
+            self.reconnectHandle = None
+        self._cancelConnect()
+        drivers.log.die(self.irc)
+        # Closing the transport still flushes what it buffered.
+        self._reallyDie()
+
+    def _reallyDie(self):
+        if self.sendHandle is not None:
+            self.sendHandle.cancel()
+            self.sendHandle = None
+        if self.transport is not None:
+            self.transport.close()
+        self.protocol = None
+        self.transport = None
+        self.connected = False
+        drivers.IrcDriver.die(self)
+        # self.irc.die() Kill off the ircs yourself, jerk!
+
+    def name(self):
+        return '%s(%s)' % (self.__class__.__name__, self.irc)
+
+    def starttls(self):
+        if not hasattr(loop, 'start_tls'):
+            drivers.log.error('%s: STARTTLS requires Python 3.7 or newer '
+                              'when using the Asyncio driver.',
+                              self.irc.network)
+            self.irc.feedMsg(ircmsgs.error('STARTTLS upgrade not supported '
+                                           'by the driver'))
+            self.irc.die()
+            return
+        transport = self.transport
+        # Hold outgoing messages in the Irc queues until the handshake is
+        # done, they would be sent in clear text otherwise.
+        self.transport = None
+        self.connected = False
+        task = asyncio.ensure_future(loop.start_tls(transport, self.protocol,
+            self._getSslContext(), server_hostname=self.server[0]),
+            loop=loop)
+        task.add_done_callback(functools.partial(self._starttlsDone,
+                                                 self.protocol))
+
+    def _starttlsDone(self, protocol, task):
+        if protocol is not self.protocol:
+            return
+        if task.cancelled() or task.exception() is not None:
+            e = 'Cancelled' if task.cancelled() else task.exception()
+            drivers.log.connectError(self.currentServer, e)
+            self.protocol = None
+            self.scheduleReconnect()
+            return
+        self._connectionMade(protocol, task.result())
+
+
+Driver = AsyncioDriver
+poller = AsyncioRunnerDriver()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -39,10 +39,17 @@ import time
 import errno
 import select
 import socket
+import collections
+
+try:
+    import selectors
+except ImportError:
+    # Python < 3.4; fall back to calling select.select on all the sockets.
+    selectors = None
 
 from .. import (conf, drivers, log, utils, world)
 from ..utils import minisix
-from ..utils.str import decode_raw_line
+from ..utils.str import decode_raw_lines
 
 try:
     import ssl
@@ -57,18 +64,25 @@ except:
 class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
     _instances = []
     _selecting = [False] # We want it to be mutable.
+    # Connected sockets are registered once, instead of passing all of them
+    # to select() on every pass.
+    _selector = selectors.DefaultSelector() if selectors else None
     def __init__(self, irc):
-        self._instances.append(self)
         assert irc is not None
         self.irc = irc
         drivers.IrcDriver.__init__(self, irc)
         drivers.ServersMixin.__init__(self, irc)
         self.conn = None
+        self._events = 0
         self._attempt = -1
         self.servers = ()
         self.eagains = 0
-        self.inbuffer = b''
-        self.outbuffer = ''
+        self.inbuffer = bytearray()
+        self.readbuffer = bytearray()
+        # Messages are encoded once, and queued as bytes; outbufferOffset is
+        # how much of the first chunk was already sent.
+        self.outbuffer = collections.deque()
+        self.outbufferOffset = 0
         self.zombie = False
         self.connected = False
         self.writeCheckTime = None
@@ -105,8 +119,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
         # hasn't finished yet.  We'll keep track of how many we get.
         if e.args[0] != 11 or self.eagains > 120:
             drivers.log.disconnect(self.currentServer, e)
-            if self in self._instances:
-                self._instances.remove(self)
+            self._removeInstance()
             try:
                 self.conn.close()
             except:
@@ -125,24 +138,73 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
             while msgs[-1] is not None:
                 msgs.append(self.irc.takeMsg())
             del msgs[-1]
-            self.outbuffer += ''.join(map(str, msgs))
-        if self.outbuffer:
-            try:
-                if minisix.PY2:
-                    sent = self.conn.send(self.outbuffer)
-                else:
-                    sent = self.conn.send(self.outbuffer.encode())
-                self.outbuffer = self.outbuffer[sent:]
+            if msgs:
+                # Coalesce the messages taken together into a single write.
+                data = ''.join(map(str, msgs))
+                if minisix.PY3:
+                    data = data.encode()
+                self.outbuffer.append(data)
+        try:
+            while self.outbuffer:
+                chunk = self.outbuffer[0]
+                sent = self.conn.send(
+                        memoryview(chunk)[self.outbufferOffset:])
+                self.outbound.add(sent)
                 self.eagains = 0
-            except socket.error as e:
-                self._handleSocketError(e)
+                self.outbufferOffset += sent
+                if self.outbufferOffset < len(chunk):
+                    # The socket is full, we will try again when it is
+                    # writable.
+                    break
+                self.outbuffer.popleft()
+                self.outbufferOffset = 0
+        except socket.error as e:
+            self._handleSocketError(e)
         if self.zombie and not self.outbuffer:
             self._reallyDie()
+        else:
+            # Only wake up for writing when there is something left to
+            # write; the normal queue is throttled, it is emptied by run().
+            self._setWriteInterest(bool(self.outbuffer or
+                                        (self.irc and self.irc.fastqueue)))
+
+    def outboundDepth(self):
+        return sum(map(len, self.outbuffer)) - self.outbufferOffset
+
+    def _addInstance(self):
+        if self not in self._instances:
+            self._instances.append(self)
+        if self._selector is not None and not self._events:
+            self._events = selectors.EVENT_READ
+            self._selector.register(self.conn, self._events, self)
+
+    def _removeInstance(self):
+        if self in self._instances:
+            self._instances.remove(self)
+        if self._selector is not None and self._events:
+            self._events = 0
+            try:
+                self._selector.unregister(self.conn)
+            except (KeyError, ValueError):
+                pass
+
+    def _setWriteInterest(self, write):
+        if not self._events:
+            return
+        events = selectors.EVENT_READ
+        if write:
+            events |= selectors.EVENT_WRITE
+        if events != self._events:
+            self._events = events
+            self._selector.modify(self.conn, events, self)
 
     @classmethod
     def _select(cls):
         if cls._selecting[0]:
             return
+        if cls._selector is not None:
+            cls._selectReady()
+            return
         try:
             cls._selecting[0] = True
             for inst in cls._instances:
@@ -172,6 +234,30 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
             if instance.irc and not instance.irc.zombie:
                 instance._sendIfMsgs()
 
+    @classmethod
+    def _selectReady(cls):
+        """Handles the sockets the selector reports as ready, so the cost
+        of a wakeup depends on the number of active connections, not on the
+        number of networks."""
+        if not cls._selector.get_map():
+            return
+        try:
+            cls._selecting[0] = True
+            try:
+                ready = cls._selector.select(conf.supybot.drivers.poll())
+            except (select.error, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    # 'Interrupted system call'
+                    raise
+                return
+            for (key, events) in ready:
+                instance = key.data
+                if events & selectors.EVENT_READ:
+                    instance._read()
+                if events & selectors.EVENT_WRITE and instance.connected:
+                    instance._sendIfMsgs()
+        finally:
+            cls._selecting[0] = False
 
     def run(self):
         now = time.time()
@@ -190,16 +276,27 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
     def _read(self):
         """Called by _select() when we can read data."""
         try:
-            self.inbuffer += self.conn.recv(1024)
+            size = conf.supybot.drivers.receiveBufferSize()
+            if len(self.readbuffer) != size:
+                self.readbuffer = bytearray(size)
+            # Receive into the same buffer every time rather than allocating
+            # a new string for each read.
+            n = self.conn.recv_into(self.readbuffer)
             self.eagains = 0 # If we successfully recv'ed, we can reset this.
-            lines = self.inbuffer.split(b'\n')
-            self.inbuffer = lines.pop()
-            for line in lines:
-                line = decode_raw_line(line)
-
-                msg = drivers.parseMsg(line)
-                if msg is not None and self.irc is not None:
-                    self.irc.feedMsg(msg)
+            if not n:
+                self._handleSocketError(socket.error(
+                    'Connection closed by the server'))
+                return
+            self.inbuffer += memoryview(self.readbuffer)[:n]
+            end = self.inbuffer.rfind(b'\n')
+            if end != -1:
+                # Only the complete lines are decoded, all at once.
+                lines = decode_raw_lines(self.inbuffer[:end])
+                del self.inbuffer[:end+1]
+                for line in lines:
+                    msg = drivers.parseMsg(line)
+                    if msg is not None and self.irc is not None:
+                        self.irc.feedMsg(msg)
         except socket.timeout:
             pass
         except SSLError as e:
@@ -222,14 +319,14 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
         self.nextReconnectTime = None
         if self.connected:
             drivers.log.reconnect(self.irc.network)
-            if self in self._instances:
-                self._instances.remove(self)
+            self._removeInstance()
             try:
                 self.conn.shutdown(socket.SHUT_RDWR)
             except: # "Transport endpoint not connected"
                 pass
             self.conn.close()
             self.connected = False
+        self.inbuffer = bytearray()
         if reset:
             drivers.log.debug('Resetting %s.', self.irc)
             self.irc.reset()
@@ -305,7 +402,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
                 drivers.log.connectError(self.currentServer, e)
                 self.scheduleReconnect()
             return
-        self._instances.append(self)
+        self._addInstance()
 
     def _checkAndWriteOrReconnect(self):
         self.writeCheckTime = None
@@ -331,8 +428,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
         self.nextReconnectTime = when
 
     def die(self):
-        if self in self._instances:
-            self._instances.remove(self)
+        self._removeInstance()
         self.zombie = True
         if self.nextReconnectTime is not None:
             self.nextReconnectTime = None
@@ -342,6 +438,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
 
     def _reallyDie(self):
         if self.conn is not None:
+            self._removeInstance()
             self.conn.close()
         drivers.IrcDriver.die(self)
         # self.irc.die() Kill off the ircs yourself, jerk!
@@ -367,6 +464,10 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
                     'are vulnerable to man-in-the-middle attacks. Set '
                     'supybot.protocols.ssl.verifyCertificates to "true" '
                     'to enable validity checks.')
+        # The wrapped socket replaces the plain one in the selector.
+        registered = bool(self._events)
+        if registered:
+            self._removeInstance()
         try:
             self.conn = utils.net.ssl_wrap_socket(self.conn,
                     logger=drivers.log, hostname=self.server[0],
@@ -395,6 +496,8 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
                 % (self.irc.network, e.args[1]))
             raise ssl.SSLError('Aborting because of failed certificate '
                     'verification.')
+        if registered:
+            self._addInstance()
 
 
 
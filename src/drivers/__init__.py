@@ -32,7 +32,9 @@
 Contains various drivers (network, file, and otherwise) for using IRC objects.
 """
 
+import time
 import socket
+import collections
 
 from .. import conf, ircmsgs, log as supylog, utils
 from ..utils import minisix
@@ -62,10 +64,41 @@ class IrcDriver(object):
     def name(self):
         return repr(self)
 
+class OutboundCounter(object):
+    """Counts the bytes a driver writes to its network, and how many of them
+    it wrote per second over the last `window` seconds."""
+    def __init__(self, window=10):
+        self.window = window
+        self.total = 0
+        self._buckets = collections.deque()
+
+    def _expire(self, second):
+        while self._buckets and self._buckets[0][0] <= second - self.window:
+            self._buckets.popleft()
+
+    def add(self, size, now=None):
+        if now is None:
+            now = time.time()
+        second = int(now)
+        self.total += size
+        if self._buckets and self._buckets[-1][0] == second:
+            self._buckets[-1][1] += size
+        else:
+            self._buckets.append([second, size])
+        self._expire(second)
+
+    def rate(self, now=None):
+        """Returns the average number of bytes written per second."""
+        if now is None:
+            now = time.time()
+        self._expire(int(now))
+        return sum(size for (_, size) in self._buckets) / float(self.window)
+
 class ServersMixin(object):
     def __init__(self, irc, servers=()):
         self.networkGroup = conf.supybot.networks.get(irc.network)
         self.servers = servers
+        self.outbound = OutboundCounter()
         super(ServersMixin, self).__init__()
 
     def _getServers(self):
@@ -83,6 +116,11 @@ class ServersMixin(object):
         self.currentServer = '%s:%s' % server
         return server
 
+    def outboundDepth(self):
+        """Returns the number of bytes waiting to be written to the
+        network."""
+        return 0
+
 
 def empty():
     """Returns whether or not the driver loop is empty."""
@@ -31,6 +31,7 @@
 
 import os
 import time
+import heapq
 import operator
 
 from . import conf, ircutils, log, registry, unpreserve, utils, world
@@ -105,6 +106,273 @@ _unwildcard_remover = utils.str.MultipleRemover('!@*?')
 def unWildcardHostmask(hostmask):
     return _unwildcard_remover(hostmask)
 
+class HostmaskIndex(object):
+    """Maps hostmask patterns to values, so that the values whose patterns
+    may match a given hostmask can be found without testing every pattern.
+
+    Patterns are bucketed by their literal host suffix (the part after the
+    last wildcard, starting at a '.', ':', '/' or '@'), by the literal start
+    of their host, or by the literal start of their nick; patterns with none
+    of these go into a generic bucket which is always returned.
+    candidates() returns a superset of the matching values, so callers must
+    still check the patterns themselves, for instance with their
+    ircutils.HostmaskPattern in the compiled dictionary."""
+    __slots__ = ('suffixes', 'hosts', 'prefixes', 'generic', 'patterns',
+                 'compiled')
+    separators = '.:/@'
+    def __init__(self):
+        self.suffixes = {}
+        self.hosts = {}
+        self.prefixes = {}
+        self.generic = {}
+        self.patterns = {}
+        self.compiled = {}
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def clear(self):
+        self.suffixes.clear()
+        self.hosts.clear()
+        self.prefixes.clear()
+        self.generic.clear()
+        self.patterns.clear()
+        self.compiled.clear()
+
+    @staticmethod
+    def _literalPrefix(s):
+        for (i, c) in enumerate(s):
+            if c in '*?':
+                return s[:i]
+        return s
+
+    def _bucket(self, pattern):
+        # ircutils.HostmaskPattern matches non-ASCII characters
+        # case-insensitively in the Unicode sense, so only ASCII keys can be
+        # folded with ircutils.toLower.
+        if not ircutils.isUserHostmask(pattern):
+            return (self.generic, None)
+        pattern = ircutils.toLower(pattern)
+        literal = pattern[max(pattern.rfind('*'), pattern.rfind('?'))+1:]
+        for (i, c) in enumerate(literal):
+            if c in self.separators:
+                if ircutils._isAscii(literal[i:]):
+                    return (self.suffixes, literal[i:])
+                break
+        host = self._literalPrefix(pattern[pattern.rfind('@'):])
+        if len(host) > 1 and ircutils._isAscii(host):
+            return (self.hosts, host)
+        nick = self._literalPrefix(pattern.split('!', 1)[0])
+        if nick and ircutils._isAscii(nick):
+            return (self.prefixes, nick)
+        return (self.generic, None)
+
+    def add(self, pattern, value):
+        """Adds value to the values of pattern."""
+        values = self.patterns.get(pattern)
+        if values is None:
+            values = self.patterns[pattern] = set()
+            self.compiled[pattern] = ircutils.HostmaskPattern(pattern)
+        values.add(value)
+        (bucket, key) = self._bucket(pattern)
+        bucket.setdefault(key, {})[pattern] = values
+
+    def remove(self, pattern, value):
+        """Removes value from the values of pattern, if it is there."""
+        values = self.patterns.get(pattern)
+        if values is None:
+            return
+        values.discard(value)
+        if not values:
+            del self.patterns[pattern]
+            del self.compiled[pattern]
+            (bucket, key) = self._bucket(pattern)
+            del bucket[key][pattern]
+            if not bucket[key]:
+                del bucket[key]
+
+    def _lookup(self, hostmask):
+        if not ircutils.isUserHostmask(hostmask) or \
+           not ircutils._isAscii(hostmask):
+            # Non-ASCII characters may match ASCII ones case-insensitively;
+            # everything is a candidate.
+            for patterns in self.patterns.items():
+                yield patterns
+            return
+        hostmask = ircutils.toLower(hostmask)
+        buckets = list(self.generic.values())
+        for (i, c) in enumerate(hostmask):
+            if c in self.separators and hostmask[i:] in self.suffixes:
+                buckets.append(self.suffixes[hostmask[i:]])
+            if c == '@':
+                for j in range(i+2, len(hostmask)+1):
+                    if hostmask[i:j] in self.hosts:
+                        buckets.append(self.hosts[hostmask[i:j]])
+        nick = hostmask.split('!', 1)[0]
+        for i in range(1, len(nick)+1):
+            if nick[:i] in self.prefixes:
+                buckets.append(self.prefixes[nick[:i]])
+        for bucket in buckets:
+            for patterns in bucket.items():
+                yield patterns
+
+    def candidates(self, hostmask):
+        """Returns the set of values whose patterns may match hostmask."""
+        ret = set()
+        for (_, values) in self._lookup(hostmask):
+            ret.update(values)
+        return ret
+
+    def matches(self, hostmask):
+        """Returns a list of (pattern, values) whose pattern matches
+        hostmask."""
+        compiled = self.compiled
+        return [(pattern, values)
+                for (pattern, values) in self._lookup(hostmask)
+                if compiled[pattern].match(hostmask)]
+
+class ExpiringHostmaskDict(dict):
+    """A dictionary of hostmask patterns to their expiration time (0 meaning
+    they never expire).  Patterns are kept in a HostmaskIndex, so checking a
+    hostmask against them does not test every pattern, and their
+    expirations in a heap, so expired patterns are found without scanning
+    the whole dictionary."""
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.index = HostmaskIndex()
+        self.expirations = []
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, pattern, expiration):
+        dict.__setitem__(self, pattern, expiration)
+        self.index.add(pattern, pattern)
+        if expiration:
+            if len(self.expirations) > 2*len(self) + 16:
+                # Drop the entries of patterns which were removed or whose
+                # expiration changed.
+                self.expirations = [(e, p) for (p, e) in self.items() if e]
+                heapq.heapify(self.expirations)
+            else:
+                heapq.heappush(self.expirations, (expiration, pattern))
+
+    def __delitem__(self, pattern):
+        dict.__delitem__(self, pattern)
+        self.index.remove(pattern, pattern)
+
+    def pop(self, pattern, *args):
+        if pattern in self:
+            expiration = self[pattern]
+            del self[pattern]
+            return expiration
+        return dict.pop(self, pattern, *args)
+
+    def popitem(self):
+        (pattern, expiration) = dict.popitem(self)
+        self.index.remove(pattern, pattern)
+        return (pattern, expiration)
+
+    def setdefault(self, pattern, expiration=0):
+        if pattern not in self:
+            self[pattern] = expiration
+        return self[pattern]
+
+    def update(self, *args, **kwargs):
+        for (pattern, expiration) in dict(*args, **kwargs).items():
+            self[pattern] = expiration
+
+    def clear(self):
+        dict.clear(self)
+        self.index.clear()
+        self.expirations = []
+
+    def expire(self, now=None):
+        """Removes the patterns which expired, and returns them as a list of
+        (pattern, expiration) tuples."""
+        if now is None:
+            now = time.time()
+        expired = []
+        while self.expirations and self.expirations[0][0] <= now:
+            (expiration, pattern) = heapq.heappop(self.expirations)
+            if self.get(pattern) == expiration:
+                del self[pattern]
+                expired.append((pattern, expiration))
+        return expired
+
+    def check(self, hostmask):
+        """Returns whether hostmask matches one of the patterns.  Expired
+        patterns are not removed; call expire() first."""
+        compiled = self.index.compiled
+        for (pattern, _) in self.index._lookup(hostmask):
+            if compiled[pattern].match(hostmask):
+                return True
+        return False
+
+class CapabilityCache(object):
+    """Memoizes the decisions of checkCapability.  Anything which may change
+    a decision must call invalidate(), which bumps the generation; decisions
+    made for an older generation are never returned."""
+    def __init__(self, size=10000):
+        self.generation = 0
+        self.cache = utils.structures.CacheDict(size)
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.generation += 1
+        self.cache.clear()
+
+    def get(self, key):
+        try:
+            (generation, decision) = self.cache[key]
+            if generation == self.generation:
+                self.hits += 1
+                return decision
+        except KeyError:
+            pass
+        self.misses += 1
+        raise KeyError(key)
+
+    def set(self, key, generation, decision):
+        """Stores a decision made while the generation was the given one."""
+        if generation == self.generation:
+            self.cache[key] = (generation, decision)
+
+capabilityCache = CapabilityCache(conf.supybot.caches.capabilities)
+
+# Bumped whenever an IrcUser's hostmasks change, so that UsersDictionary
+# knows to rebuild its HostmaskIndex.
+_hostmasksGeneration = 0
+def _hostmasksChanged():
+    global _hostmasksGeneration
+    _hostmasksGeneration += 1
+    capabilityCache.invalidate()
+
+# Users which may have authenticated hostmasks; these are checked on each
+# lookup in addition to the candidates given by the HostmaskIndex.
+_authenticatedUsers = set()
+
+# Earliest time at which one of their authentications may time out.  As user
+# lookups and capability decisions are cached, they call _expireAuths() to
+# remove the authentications which timed out since they were cached.
+_nextAuthExpiry = None
+def _authExpiresAt(when):
+    global _nextAuthExpiry
+    if when is None:
+        return
+    if _nextAuthExpiry is None or when < _nextAuthExpiry:
+        _nextAuthExpiry = when
+
+def _expireAuths():
+    global _nextAuthExpiry
+    if _nextAuthExpiry is None or time.time() <= _nextAuthExpiry:
+        return
+    _nextAuthExpiry = None
+    for user in list(_authenticatedUsers):
+        _authExpiresAt(user.expireAuth())
+# Changing the timeout may expire authentications earlier than planned.
+conf.supybot.databases.users.timeoutIdentification.addCallback(
+    lambda: _authExpiresAt(0))
+
 _invert = invertCapability
 class CapabilitySet(set):
     """A subclass of set handling basic capability stuff."""
@@ -121,11 +389,13 @@ class CapabilitySet(set):
         if self.__parent.__contains__(inverted):
             self.__parent.remove(inverted)
         self.__parent.add(capability)
+        capabilityCache.invalidate()
 
     def remove(self, capability):
         """Removes a capability from the set."""
         capability = ircutils.toLower(capability)
         self.__parent.remove(capability)
+        capabilityCache.invalidate()
 
     def __contains__(self, capability):
         capability = ircutils.toLower(capability)
@@ -270,32 +540,45 @@ class IrcUser(object):
         hostmasks.
         """
         if useAuth:
-            timeout = conf.supybot.databases.users.timeoutIdentification()
-            removals = []
-            try:
-                for (when, authmask) in self.auth:
-                    if timeout and when+timeout < time.time():
-                        removals.append((when, authmask))
-                    elif hostmask == authmask:
-                        return True
-            finally:
-                while removals:
-                    self.auth.remove(removals.pop())
+            self.expireAuth()
+            for (_, authmask) in self.auth:
+                if hostmask == authmask:
+                    return True
         for pat in self.hostmasks:
-            if ircutils.hostmaskPatternEqual(pat, hostmask):
+            if ircutils.compileHostmaskPattern(pat).match(hostmask):
                 return pat
         return False
 
+    def expireAuth(self):
+        """Removes the authentications which timed out, and returns the time
+        at which the next one will, or None."""
+        timeout = conf.supybot.databases.users.timeoutIdentification()
+        if not timeout:
+            return None
+        now = time.time()
+        auth = [x for x in self.auth if x[0]+timeout >= now]
+        if len(auth) != len(self.auth):
+            for (when, hostmask) in self.auth:
+                if when+timeout < now:
+                    users.invalidateCache(hostmask=hostmask)
+            self.auth = auth
+            capabilityCache.invalidate()
+        if auth:
+            return min([when for (when, _) in auth]) + timeout
+        return None
+
     def addHostmask(self, hostmask):
         """Adds a hostmask to the user's hostmasks."""
         assert ircutils.isUserHostmask(hostmask), 'got %s' % hostmask
         if len(unWildcardHostmask(hostmask)) < 3:
             raise ValueError('Hostmask must contain at least 3 non-wildcard characters.')
         self.hostmasks.add(hostmask)
+        _hostmasksChanged()
 
     def removeHostmask(self, hostmask):
         """Removes a hostmask from the user's hostmasks."""
         self.hostmasks.remove(hostmask)
+        _hostmasksChanged()
 
     def checkNick(self, network, nick):
         """Checks a given nick against the user's nicks."""
@@ -312,6 +595,8 @@ class IrcUser(object):
             self.nicks[network] = []
         if nick not in self.nicks[network]:
             self.nicks[network].append(nick)
+        if users.users.get(self.id) is self:
+            users._indexNicks(self)
 
     def removeNick(self, network, nick):
         """Removes a nick from the user's registered nicks on the network."""
@@ -319,6 +604,8 @@ class IrcUser(object):
         if nick not in self.nicks[network]:
             raise KeyError
         self.nicks[network].remove(nick)
+        if users.users.get(self.id) is self:
+            users._indexNicks(self)
 
     def addAuth(self, hostmask):
         """Sets a user's authenticated hostmask.  This times out according to
@@ -335,6 +622,9 @@ class IrcUser(object):
                 return False
             uniqued = list(filter(uniqueHostmask, reversed(self.auth)))
             self.auth = list(reversed(uniqued))
+            _authenticatedUsers.add(self)
+            _authExpiresAt(self.expireAuth())
+            capabilityCache.invalidate()
         else:
             raise ValueError('secure flag set, unmatched hostmask')
 
@@ -343,6 +633,8 @@ class IrcUser(object):
         for (when, hostmask) in self.auth:
             users.invalidateCache(hostmask=hostmask)
         self.auth = []
+        _authenticatedUsers.discard(self)
+        capabilityCache.invalidate()
 
     def preserve(self, fd, indent=''):
         def write(s):
@@ -373,8 +665,8 @@ class IrcChannel(object):
                  capabilities=None, lobotomized=False, defaultAllow=True):
         self.defaultAllow = defaultAllow
         self.expiredBans = []
-        self.bans = bans or {}
-        self.ignores = ignores or {}
+        self.bans = ExpiringHostmaskDict(bans or {})
+        self.ignores = ExpiringHostmaskDict(ignores or {})
         self.silences = silences or []
         self.exceptions = exceptions or []
         self.capabilities = capabilities or CapabilitySet()
@@ -406,15 +698,8 @@ class IrcChannel(object):
     def checkBan(self, hostmask):
         """Checks whether a given hostmask is banned by the channel banlist."""
         assert ircutils.isUserHostmask(hostmask), 'got %s' % hostmask
-        now = time.time()
-        for (pattern, expiration) in list(self.bans.items()):
-            if now < expiration or not expiration:
-                if ircutils.hostmaskPatternEqual(pattern, hostmask):
-                    return True
-            else:
-                self.expiredBans.append((pattern, expiration))
-                del self.bans[pattern]
-        return False
+        self.expiredBans.extend(self.bans.expire())
+        return self.bans.check(hostmask)
 
     def addIgnore(self, hostmask, expiration=0):
         """Adds an ignore to the channel ignore list."""
@@ -439,6 +724,7 @@ class IrcChannel(object):
     def setDefaultCapability(self, b):
         """Sets the default capability in the channel."""
         self.defaultAllow = b
+        capabilityCache.invalidate()
 
     def _checkCapability(self, capability, ignoreOwner=False):
         """Checks whether a certain capability is allowed by the channel."""
@@ -460,15 +746,9 @@ class IrcChannel(object):
         assert ircutils.isUserHostmask(hostmask), 'got %s' % hostmask
         if self.checkBan(hostmask):
             return True
-        now = time.time()
-        for (pattern, expiration) in list(self.ignores.items()):
-            if now < expiration or not expiration:
-                if ircutils.hostmaskPatternEqual(pattern, hostmask):
-                    return True
-            else:
-                del self.ignores[pattern]
-                # Later we may wish to keep expiredIgnores, but not now.
-        return False
+        # Later we may wish to keep expiredIgnores, but not now.
+        self.ignores.expire()
+        return self.ignores.check(hostmask)
 
     def preserve(self, fd, indent=''):
         def write(s):
@@ -496,6 +776,7 @@ class Creator(object):
 
 class IrcUserCreator(Creator):
     u = None
+    removed = False
     def __init__(self, users):
         if self.u is None:
             IrcUserCreator.u = IrcUser()
@@ -547,8 +828,15 @@ class IrcUserCreator(Creator):
         self._checkId()
         self.u.gpgkeys.append(rest)
 
+    def deleted(self, rest, lineno):
+        self._checkId()
+        self.removed = bool(utils.gen.safeEval(rest))
+
     def finish(self):
-        if self.u.name:
+        if self.removed:
+            self.users.delUser(self.u.id)
+            IrcUserCreator.u = None
+        elif self.u.name:
             try:
                 self.users.setUser(self.u)
             except DuplicateHostmask:
@@ -564,6 +852,7 @@ class IrcUserCreator(Creator):
 
 class IrcChannelCreator(Creator):
     name = None
+    removed = False
     def __init__(self, channels):
         self.c = IrcChannel()
         self.channels = channels
@@ -600,24 +889,49 @@ class IrcChannelCreator(Creator):
         (pattern, expiration) = rest.split()
         self.c.ignores[pattern] = int(float(expiration))
 
+    def deleted(self, rest, lineno):
+        self._checkId()
+        self.removed = bool(utils.gen.safeEval(rest))
+
     def finish(self):
         if self.hadChannel:
-            self.channels.setChannel(self.name, self.c)
+            if self.removed:
+                if self.name in self.channels.channels:
+                    self.channels.delChannel(self.name)
+            else:
+                self.channels.setChannel(self.name, self.c)
             IrcChannelCreator.name = None
 
 
 class DuplicateHostmask(ValueError):
     pass
 
+class JournalReplay(object):
+    """Collects the last record of each user found in a users journal."""
+    def __init__(self):
+        self.users = {}
+
+    def setUser(self, user, flush=True):
+        self.users[user.id] = user
+
+    def delUser(self, id):
+        self.users[id] = None
+
 class UsersDictionary(utils.IterableMap):
     """A simple serialized-to-file User Database."""
     def __init__(self):
         self.noFlush = False
         self.filename = None
+        self.journal = None
         self.users = {}
         self.nextId = 0
-        self._nameCache = utils.structures.CacheDict(1000)
-        self._hostmaskCache = utils.structures.CacheDict(1000)
+        self._nameCache = utils.structures.CacheDict(conf.supybot.caches.users)
+        self._hostmaskCache = utils.structures.CacheDict(
+                conf.supybot.caches.users)
+        self._hostmaskIndex = HostmaskIndex()
+        self._hostmaskIndexGeneration = None
+        self._nicks = {} # (network, lowered nick) -> id
+        self._nicksOfUser = {} # id -> keys of self._nicks
 
     # This is separate because the Creator has to access our instance.
     def open(self, filename):
@@ -627,8 +941,9 @@ class UsersDictionary(utils.IterableMap):
             self.noFlush = True
             try:
                 reader.readFile(filename)
+                self.replayJournal()
                 self.noFlush = False
-                self.flush()
+                self._flush(compact=True)
             except EnvironmentError as e:
                 log.error('Invalid user dictionary file, resetting to empty.')
                 log.error('Exact error: %s', utils.exnToString(e))
@@ -643,6 +958,9 @@ class UsersDictionary(utils.IterableMap):
         self.users.clear()
         self._nameCache.clear()
         self._hostmaskCache.clear()
+        self._nicks.clear()
+        self._nicksOfUser.clear()
+        _hostmasksChanged()
         if self.filename is not None:
             try:
                 self.open(self.filename)
@@ -651,25 +969,74 @@ class UsersDictionary(utils.IterableMap):
         else:
             log.error('UsersDictionary.reload called with no filename.')
 
-    def flush(self):
-        """Flushes the database to its file."""
+    def _getJournal(self):
+        if self.journal is None or self.journal.filename != self.filename:
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = utils.file.Journal(self.filename,
+                    lambda id: 'user %s%s  deleted True%s%s' %
+                               (id, os.linesep, os.linesep, os.linesep),
+                    conf.supybot.databases.journalSize)
+        return self.journal
+
+    def replayJournal(self):
+        """Applies the changes appended to the journal since the database
+        file was last rewritten."""
+        journalName = self._getJournal().journalName
+        if not os.path.exists(journalName):
+            return
+        replay = JournalReplay()
+        unpreserve.Reader(IrcUserCreator, replay).readFile(journalName)
+        # Users are removed first, so the hostmasks they gave up do not
+        # collide with the ones other users took since then.
+        for id in replay.users:
+            if id in self.users:
+                self.delUser(id)
+        for (id, user) in sorted(replay.users.items()):
+            if user is not None:
+                try:
+                    self.setUser(user, flush=False)
+                except DuplicateHostmask:
+                    log.error('Hostmasks for %s collided with another '
+                              'user\'s.  Resetting hostmasks for %s.',
+                              user.name, user.name)
+                    user.hostmasks.clear()
+                    self.setUser(user, flush=False)
+
+    def _flush(self, ids=None, compact=False):
+        """Writes the records of the given users, or of all the users if ids
+        is None."""
         if not self.noFlush:
             if self.filename is not None:
-                L = list(self.users.items())
-                L.sort()
-                fd = utils.file.AtomicFile(self.filename)
-                for (id, u) in L:
-                    fd.write('user %s' % id)
-                    fd.write(os.linesep)
-                    u.preserve(fd, indent='  ')
-                fd.close()
+                journal = self._getJournal()
+                if ids is None:
+                    ids = set(self.users) | set(journal.records)
+                records = []
+                for id in ids:
+                    user = self.users.get(id)
+                    if user is None or not user.name:
+                        # Users without a name can't be read back.
+                        records.append((id, None))
+                    else:
+                        fd = minisix.io.StringIO()
+                        fd.write('user %s' % id)
+                        fd.write(os.linesep)
+                        user.preserve(fd, indent='  ')
+                        records.append((id, fd.getvalue()))
+                journal.update(records, compact=compact)
             else:
                 log.error('UsersDictionary.flush called with no filename.')
         else:
             log.debug('Not flushing UsersDictionary because of noFlush.')
 
+    def flush(self):
+        """Flushes the database to its file."""
+        self._flush()
+
     def close(self):
-        self.flush()
+        self._flush(compact=True)
+        if self.journal is not None:
+            self.journal.close()
         if self.flush in world.flushers:
             world.flushers.remove(self.flush)
         self.users.clear()
@@ -677,24 +1044,42 @@ class UsersDictionary(utils.IterableMap):
     def items(self):
         return self.users.items()
 
+    def _hostmaskCandidates(self, hostmask):
+        """Returns the ids of the users who may be recognized by the given
+        hostmask, either through their hostmasks or their authentication."""
+        generation = _hostmasksGeneration
+        if self._hostmaskIndexGeneration != generation:
+            self._hostmaskIndex.clear()
+            for (id, user) in self.users.items():
+                for pattern in user.hostmasks:
+                    self._hostmaskIndex.add(pattern, id)
+            self._hostmaskIndexGeneration = generation
+        ids = self._hostmaskIndex.candidates(hostmask)
+        for user in list(_authenticatedUsers):
+            if not user.auth:
+                _authenticatedUsers.discard(user)
+            elif self.users.get(user.id) is user:
+                ids.add(user.id)
+        return ids
+
     def getUserId(self, s):
         """Returns the user ID of a given name or hostmask."""
         if ircutils.isUserHostmask(s):
+            _expireAuths()
             try:
                 return self._hostmaskCache[s]
             except KeyError:
                 ids = {}
-                for (id, user) in self.users.items():
+                for id in self._hostmaskCandidates(s):
+                    user = self.users.get(id)
+                    if user is None:
+                        continue
                     x = user.checkHostmask(s)
                     if x:
                         ids[id] = x
                 if len(ids) == 1:
                     id = list(ids.keys())[0]
                     self._hostmaskCache[s] = id
-                    try:
-                        self._hostmaskCache[id].add(s)
-                    except KeyError:
-                        self._hostmaskCache[id] = set([s])
                     return id
                 elif len(ids) == 0:
                     raise KeyError(s)
@@ -713,7 +1098,6 @@ class UsersDictionary(utils.IterableMap):
                 for (id, user) in self.users.items():
                     if s == user.name.lower():
                         self._nameCache[s] = id
-                        self._nameCache[id] = s
                         return id
                 else:
                     raise KeyError(s)
@@ -730,15 +1114,29 @@ class UsersDictionary(utils.IterableMap):
         u.id = id
         return u
 
+    def _unindexNicks(self, id):
+        for key in self._nicksOfUser.pop(id, ()):
+            if self._nicks.get(key) == id:
+                del self._nicks[key]
+
+    def _indexNicks(self, user):
+        """Updates the nick index with the current nicks of user."""
+        self._unindexNicks(user.id)
+        keys = set()
+        for (network, nicks) in user.nicks.items():
+            for nick in nicks:
+                key = (network, ircutils.toLower(nick))
+                self._nicks.setdefault(key, user.id)
+                keys.add(key)
+        self._nicksOfUser[user.id] = keys
+
     def getUserFromNick(self, network, nick):
         """Return a user given its nick."""
-        for user in self.users.values():
-            try:
-                if nick in user.nicks[network]:
-                    return user
-            except KeyError:
-                pass
-        return None
+        try:
+            id = self._nicks[(network, ircutils.toLower(nick))]
+        except KeyError:
+            return None
+        return self.users.get(id)
 
     def hasUser(self, id):
         """Returns the database has a user given its id, name, or hostmask."""
@@ -752,23 +1150,17 @@ class UsersDictionary(utils.IterableMap):
         return len(self.users)
 
     def invalidateCache(self, id=None, hostmask=None, name=None):
+        # The caches are only keyed by name and hostmask, so invalidating an
+        # id means looking for it in them; they are small enough for that.
         if hostmask is not None:
-            if hostmask in self._hostmaskCache:
-                id = self._hostmaskCache.pop(hostmask)
-                self._hostmaskCache[id].remove(hostmask)
-                if not self._hostmaskCache[id]:
-                    del self._hostmaskCache[id]
+            self._hostmaskCache.pop(hostmask, None)
         if name is not None:
-            del self._nameCache[self._nameCache[id]]
-            del self._nameCache[id]
+            self._nameCache.pop(name.lower(), None)
         if id is not None:
-            if id in self._nameCache:
-                del self._nameCache[self._nameCache[id]]
-                del self._nameCache[id]
-            if id in self._hostmaskCache:
-                for hostmask in self._hostmaskCache[id]:
-                    del self._hostmaskCache[hostmask]
-                del self._hostmaskCache[id]
+            for cache in (self._nameCache, self._hostmaskCache):
+                for (key, value) in cache.items():
+                    if value == id:
+                        cache.pop(key, None)
 
     def setUser(self, user, flush=True):
         """Sets a user (given its id) to the IrcUser given it."""
@@ -794,20 +1186,18 @@ class UsersDictionary(utils.IterableMap):
                         raise DuplicateHostmask(hostmask)
         self.invalidateCache(user.id)
         self.users[user.id] = user
+        self._indexNicks(user)
+        _hostmasksChanged()
         if flush:
-            self.flush()
+            self._flush([user.id])
 
     def delUser(self, id):
         """Removes a user from the database."""
         del self.users[id]
-        if id in self._nameCache:
-            del self._nameCache[self._nameCache[id]]
-            del self._nameCache[id]
-        if id in self._hostmaskCache:
-            for hostmask in list(self._hostmaskCache[id]):
-                del self._hostmaskCache[hostmask]
-            del self._hostmaskCache[id]
-        self.flush()
+        _hostmasksChanged()
+        self.invalidateCache(id)
+        self._unindexNicks(id)
+        self._flush([id])
 
     def newUser(self):
         """Allocates a new user in the database and returns it and its id."""
@@ -815,7 +1205,7 @@ class UsersDictionary(utils.IterableMap):
         self.nextId += 1
         id = self.nextId
         self.users[id] = user
-        self.flush()
+        self._flush([id])
         user.id = id
         return user
 
@@ -824,6 +1214,7 @@ class ChannelsDictionary(utils.IterableMap):
     def __init__(self):
         self.noFlush = False
         self.filename = None
+        self.journal = None
         self.channels = ircutils.IrcDict()
 
     def open(self, filename):
@@ -833,8 +1224,12 @@ class ChannelsDictionary(utils.IterableMap):
             reader = unpreserve.Reader(IrcChannelCreator, self)
             try:
                 reader.readFile(filename)
+                journalName = self._getJournal().journalName
+                if os.path.exists(journalName):
+                    reader = unpreserve.Reader(IrcChannelCreator, self)
+                    reader.readFile(journalName)
                 self.noFlush = False
-                self.flush()
+                self._flush(compact=True)
             except EnvironmentError as e:
                 log.error('Invalid channel database, resetting to empty.')
                 log.error('Exact error: %s', utils.exnToString(e))
@@ -844,23 +1239,50 @@ class ChannelsDictionary(utils.IterableMap):
         finally:
             self.noFlush = False
 
-    def flush(self):
-        """Flushes the channel database to its file."""
+    def _getJournal(self):
+        if self.journal is None or self.journal.filename != self.filename:
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = utils.file.Journal(self.filename,
+                    lambda channel: 'channel %s%s  deleted True%s%s' %
+                                    (channel, os.linesep, os.linesep,
+                                     os.linesep),
+                    conf.supybot.databases.journalSize)
+        return self.journal
+
+    def _flush(self, channels=None, compact=False):
+        """Writes the records of the given channels, or of all the channels
+        if channels is None."""
         if not self.noFlush:
             if self.filename is not None:
-                fd = utils.file.AtomicFile(self.filename)
-                for (channel, c) in self.channels.items():
-                    fd.write('channel %s' % channel)
-                    fd.write(os.linesep)
-                    c.preserve(fd, indent='  ')
-                fd.close()
+                journal = self._getJournal()
+                if channels is None:
+                    channels = set(self.channels) | set(journal.records)
+                records = []
+                for channel in channels:
+                    c = self.channels.get(channel)
+                    if c is None:
+                        records.append((channel, None))
+                    else:
+                        fd = minisix.io.StringIO()
+                        fd.write('channel %s' % channel)
+                        fd.write(os.linesep)
+                        c.preserve(fd, indent='  ')
+                        records.append((channel, fd.getvalue()))
+                journal.update(records, compact=compact)
             else:
                 log.warning('ChannelsDictionary.flush without self.filename.')
         else:
             log.debug('Not flushing ChannelsDictionary because of noFlush.')
 
+    def flush(self):
+        """Flushes the channel database to its file."""
+        self._flush()
+
     def close(self):
-        self.flush()
+        self._flush(compact=True)
+        if self.journal is not None:
+            self.journal.close()
         if self.flush in world.flushers:
             world.flushers.remove(self.flush)
         self.channels.clear()
@@ -869,6 +1291,7 @@ class ChannelsDictionary(utils.IterableMap):
         """Reloads the channel database from its file."""
         if self.filename is not None:
             self.channels.clear()
+            capabilityCache.invalidate()
             try:
                 self.open(self.filename)
             except EnvironmentError as e:
@@ -890,7 +1313,15 @@ class ChannelsDictionary(utils.IterableMap):
         """Sets a given channel to the IrcChannel object given."""
         channel = channel.lower()
         self.channels[channel] = ircChannel
-        self.flush()
+        capabilityCache.invalidate()
+        self._flush([channel])
+
+    def delChannel(self, channel):
+        """Removes a channel from the database."""
+        channel = channel.lower()
+        del self.channels[channel]
+        capabilityCache.invalidate()
+        self._flush([channel])
 
     def items(self):
         return self.channels.items()
@@ -899,16 +1330,20 @@ class ChannelsDictionary(utils.IterableMap):
 class IgnoresDB(object):
     def __init__(self):
         self.filename = None
-        self.hostmasks = {}
+        self.journal = None
+        self.hostmasks = ExpiringHostmaskDict()
 
-    def open(self, filename):
-        self.filename = filename
-        fd = open(self.filename)
+    def _read(self, filename):
+        fd = open(filename)
         for line in utils.file.nonCommentNonEmptyLines(fd):
             try:
                 line = line.rstrip('\r\n')
                 L = line.split()
                 hostmask = L.pop(0)
+                if hostmask.startswith('-'):
+                    # Removal, from the journal.
+                    self.hostmasks.pop(hostmask[1:], None)
+                    continue
                 if L:
                     expiration = int(float(L.pop(0)))
                 else:
@@ -918,28 +1353,55 @@ class IgnoresDB(object):
                 log.error('Invalid line in ignores database: %q', line)
         fd.close()
 
-    def flush(self):
+    def open(self, filename):
+        self.filename = filename
+        self._read(filename)
+        journalName = self._getJournal().journalName
+        if os.path.exists(journalName):
+            self._read(journalName)
+        self._flush(compact=True)
+
+    def _getJournal(self):
+        if self.journal is None or self.journal.filename != self.filename:
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = utils.file.Journal(self.filename,
+                    lambda hostmask: '-%s%s' % (hostmask, os.linesep),
+                    conf.supybot.databases.journalSize)
+        return self.journal
+
+    def _flush(self, compact=False):
         if self.filename is not None:
-            fd = utils.file.AtomicFile(self.filename)
+            journal = self._getJournal()
             now = time.time()
-            for (hostmask, expiration) in self.hostmasks.items():
-                if now < expiration or not expiration:
-                    fd.write('%s %s' % (hostmask, expiration))
-                    fd.write(os.linesep)
-            fd.close()
+            records = []
+            for hostmask in set(self.hostmasks) | set(journal.records):
+                expiration = self.hostmasks.get(hostmask)
+                if expiration is None or (expiration and now >= expiration):
+                    records.append((hostmask, None))
+                else:
+                    records.append((hostmask, '%s %s%s' %
+                                    (hostmask, expiration, os.linesep)))
+            journal.update(records, compact=compact)
         else:
             log.warning('IgnoresDB.flush called without self.filename.')
 
+    def flush(self):
+        self._flush()
+
     def close(self):
         if self.flush in world.flushers:
             world.flushers.remove(self.flush)
-        self.flush()
+        self._flush(compact=True)
+        if self.journal is not None:
+            self.journal.close()
         self.hostmasks.clear()
 
     def reload(self):
         if self.filename is not None:
             oldhostmasks = self.hostmasks.copy()
             self.hostmasks.clear()
+            capabilityCache.invalidate()
             try:
                 self.open(self.filename)
             except EnvironmentError as e:
@@ -950,21 +1412,17 @@ class IgnoresDB(object):
             log.warning('IgnoresDB.reload called without self.filename.')
 
     def checkIgnored(self, prefix):
-        now = time.time()
-        for (hostmask, expiration) in list(self.hostmasks.items()):
-            if expiration and now > expiration:
-                del self.hostmasks[hostmask]
-            else:
-                if ircutils.hostmaskPatternEqual(hostmask, prefix):
-                    return True
-        return False
+        self.hostmasks.expire()
+        return self.hostmasks.check(prefix)
 
     def add(self, hostmask, expiration=0):
         assert ircutils.isUserHostmask(hostmask), 'got %s' % hostmask
         self.hostmasks[hostmask] = expiration
+        capabilityCache.invalidate()
 
     def remove(self, hostmask):
         del self.hostmasks[hostmask]
+        capabilityCache.invalidate()
 
 
 confDir = conf.supybot.directories.conf()
@@ -1056,6 +1514,7 @@ def _checkCapabilityForUnknownUser(capability, users=users, channels=channels,
     else:
         return _x(capability, conf.supybot.capabilities.default())
 
+_defaultDatabases = (users, channels)
 def checkCapability(hostmask, capability, users=users, channels=channels,
                     ignoreOwner=False, ignoreChannelOp=False,
                     ignoreDefaultAllow=False):
@@ -1079,6 +1538,26 @@ def checkCapability(hostmask, capability, users=users, channels=channels,
             '@' not in hostmask or
             '__no_testcap__' not in hostmask.split('@')[1]):
         return _x(capability, True)
+    if users is not _defaultDatabases[0] or \
+            channels is not _defaultDatabases[1]:
+        return _checkCapability(hostmask, capability, users, channels,
+                                ignoreOwner, ignoreChannelOp,
+                                ignoreDefaultAllow)
+    _expireAuths()
+    key = (hostmask, capability, ignoreOwner, ignoreChannelOp,
+           ignoreDefaultAllow)
+    try:
+        return capabilityCache.get(key)
+    except KeyError:
+        generation = capabilityCache.generation
+        decision = _checkCapability(hostmask, capability, users, channels,
+                                    ignoreOwner, ignoreChannelOp,
+                                    ignoreDefaultAllow)
+        capabilityCache.set(key, generation, decision)
+        return decision
+
+def _checkCapability(hostmask, capability, users, channels,
+                     ignoreOwner, ignoreChannelOp, ignoreDefaultAllow):
     try:
         u = users.getUser(hostmask)
         if u.secure and not u.checkHostmask(hostmask, useAuth=False):
@@ -1167,6 +1646,8 @@ conf.registerGlobalValue(conf.supybot.capabilities, 'default',
     registry.Boolean(True, """Determines whether the bot by default will allow
     users to have a capability.  If this is disabled, a user must explicitly
     have the capability for whatever command they wish to run."""))
+conf.supybot.capabilities.addCallback(capabilityCache.invalidate)
+conf.supybot.capabilities.default.addCallback(capabilityCache.invalidate)
 conf.registerGlobalValue(conf.supybot.capabilities, 'private',
     registry.SpaceSeparatedListOfStrings([], """Determines what capabilities
     the bot will never tell to a non-admin whether or not a user has them."""))
@@ -30,6 +30,7 @@
 import re
 import copy
 import time
+import heapq
 import random
 import base64
 import collections
@@ -46,7 +47,7 @@ except ImportError:
 
 from . import conf, ircdb, ircmsgs, ircutils, log, utils, world
 from .utils.str import rsplit
-from .utils.iter import chain
+from .utils import minisix
 from .utils.structures import smallqueue, RingBuffer
 
 ###
@@ -129,6 +130,10 @@ class IrcCallback(IrcCommandDispatcher, log.Firewalled):
         """
         return msg
 
+    # Classes whose __call__ only calls the do<Command> method of the
+    # message's command (if any) set this in their body, so Irc objects can
+    # skip them for messages they have no method for.
+    _callOnlyDispatches = True
     def __call__(self, irc, msg):
         """Used for handling each message."""
         method = self.dispatchCommand(msg.command)
@@ -143,27 +148,58 @@ class IrcCallback(IrcCommandDispatcher, log.Firewalled):
         """Makes the callback die.  Called when the parent Irc object dies."""
         pass
 
+def _definingClass(cls, attr):
+    for c in cls.__mro__:
+        if attr in c.__dict__:
+            return c
+    return None
+
+def _filtersMessages(callback):
+    """Returns whether the callback may change incoming messages."""
+    if not isinstance(callback, IrcCallback):
+        return False
+    return _definingClass(type(callback), 'inFilter') is not IrcCallback
+
+def _handlesCommand(callback, command):
+    """Returns whether calling the callback with a message of the given
+    command may do anything."""
+    if not isinstance(callback, IrcCallback):
+        # Callbacks are supposed to be IrcCallbacks, but who knows.
+        return True
+    cls = type(callback)
+    if '_callOnlyDispatches' not in _definingClass(cls, '__call__').__dict__:
+        return True
+    if _definingClass(cls, 'dispatchCommand') is not IrcCommandDispatcher:
+        return True
+    return callback.dispatchCommand(command) is not None
+
 ###
-# Basic queue for IRC messages.  It doesn't presently (but should at some
-# later point) reorder messages based on priority or penalty calculations.
+# Priority queue for IRC messages.  Messages are scored by priority and, within
+# a priority, by how much was queued for the same target before them.
 ###
 _high = frozenset(['MODE', 'KICK', 'PONG', 'NICK', 'PASS', 'CAPAB', 'REMOVE'])
 _low = frozenset(['PRIVMSG', 'PING', 'WHO', 'NOTICE', 'JOIN'])
 class IrcMsgQueue(object):
-    """Class for a queue of IrcMsgs.  Eventually, it should be smart.
-
-    Probably smarter than it is now, though it's gotten quite a bit smarter
-    than it originally was.  A method to "score" methods, and a heapq to
-    maintain a priority queue of the messages would be the ideal way to do
-    intelligent queuing.
-
-    As it stands, however, we simply keep track of 'high priority' messages,
-    'low priority' messages, and normal messages, and just make sure to return
-    the 'high priority' ones before the normal ones before the 'low priority'
-    ones.
+    """Class for a queue of IrcMsgs.
+
+    Messages are kept in a heap, scored so that 'high priority' messages are
+    returned before the normal ones, which are returned before the 'low
+    priority' ones.
+
+    Within a priority, each target (the first argument of the messages) has
+    its own sub-queue, and the sub-queues are served in turn: depending on
+    supybot.protocols.irc.queuing.fairness, either one message per target
+    at a time, or an equal number of bytes per target.  So a target with a
+    long backlog of messages does not delay the others, and messages to the
+    same target are returned in the order they were queued.  The length of
+    each sub-queue can be limited with
+    supybot.protocols.irc.queuing.maxPerTarget.  Targets are compared with
+    the casemapping of the given IrcState, if any.
     """
-    __slots__ = ('msgs', 'highpriority', 'normal', 'lowpriority', 'lastJoin')
-    def __init__(self, iterable=()):
+    __slots__ = ('heap', 'index', 'clocks', 'targets', 'length', 'counter',
+                 'lastJoin', 'state')
+    def __init__(self, iterable=(), state=None):
+        self.state = state
         self.reset()
         for msg in iterable:
             self.enqueue(msg)
@@ -171,9 +207,78 @@ class IrcMsgQueue(object):
     def reset(self):
         """Clears the queue."""
         self.lastJoin = 0
-        self.highpriority = smallqueue()
-        self.normal = smallqueue()
-        self.lowpriority = smallqueue()
+        # Entries are [priority, score, counter, msg, key] lists; msg is set
+        # to None when the entry is dropped before it reaches the top of the
+        # heap.  The key is kept as the casemapping may change meanwhile.
+        self.heap = []
+        # Number of occurences of each message in the queue, so we know
+        # whether a message is queued without looking at all of them.
+        self.index = {}
+        # Score of the last message returned, for each priority.
+        self.clocks = [0, 0, 0]
+        # Entries of each (priority, target), oldest first.
+        self.targets = {}
+        self.length = 0
+        self.counter = 0
+
+    def _key(self, msg):
+        if msg.command in _high:
+            priority = 0
+        elif msg.command in _low:
+            priority = 2
+        else:
+            priority = 1
+        if not msg.args:
+            return (priority, '')
+        casemapping = getattr(self.state, 'casemapping', None)
+        return (priority, ircutils.toLower(msg.args[0], casemapping))
+
+    def _cost(self, msg):
+        if conf.supybot.protocols.irc.queuing.fairness() == 'bytes':
+            return len(msg)
+        else:
+            return 1
+
+    def _index(self, msg, n):
+        count = self.index.get(msg, 0) + n
+        if count:
+            self.index[msg] = count
+        else:
+            del self.index[msg]
+
+    def _push(self, msg, key):
+        (priority, _) = key
+        entries = self.targets.get(key)
+        if entries:
+            last = entries[-1][1]
+        else:
+            entries = self.targets[key] = collections.deque()
+            last = 0
+        score = max(self.clocks[priority], last) + self._cost(msg)
+        self.counter += 1
+        entry = [priority, score, self.counter, msg, key]
+        entries.append(entry)
+        heapq.heappush(self.heap, entry)
+        self.length += 1
+
+    def _merge(self, entry, msg):
+        """Appends the text of msg to the message of entry, if they are
+        similar PRIVMSGs or NOTICEs and the result is short enough."""
+        old = entry[3]
+        if msg.command not in ('PRIVMSG', 'NOTICE') or \
+                old.command != msg.command or old.args[0] != msg.args[0] or \
+                old.prefix != msg.prefix or old.tags != msg.tags:
+            return False
+        merged = ircmsgs.IrcMsg(prefix=old.prefix, command=old.command,
+                                args=(old.args[0],
+                                      '%s  %s' % (old.args[1], msg.args[1])))
+        if len(merged) > 512:
+            return False
+        merged.tags.update(old.tags)
+        self._index(old, -1)
+        self._index(merged, 1)
+        entry[3] = merged
+        return True
 
     def enqueue(self, msg):
         """Enqueues a given message."""
@@ -182,71 +287,284 @@ class IrcMsgQueue(object):
             s = str(msg).strip()
             log.info('Not adding message %q to queue, already added.', s)
             return False
-        else:
-            if msg.command in _high:
-                self.highpriority.enqueue(msg)
-            elif msg.command in _low:
-                self.lowpriority.enqueue(msg)
+        key = self._key(msg)
+        entries = self.targets.get(key)
+        maxPerTarget = conf.supybot.protocols.irc.queuing.maxPerTarget()
+        if maxPerTarget and entries and len(entries) >= maxPerTarget:
+            overflow = conf.supybot.protocols.irc.queuing.overflow()
+            if overflow == 'merge' and self._merge(entries[-1], msg):
+                return True
+            elif overflow == 'dropOldest':
+                entry = entries.popleft()
+                log.info('Dropping message %q from the queue, too many '
+                         'messages are queued for %s.',
+                         str(entry[3]).strip(), key[1])
+                self._index(entry[3], -1)
+                entry[3] = None
+                self.length -= 1
             else:
-                self.normal.enqueue(msg)
-            return True
+                log.info('Not adding message %q to queue, too many messages '
+                         'are queued for %s.', str(msg).strip(), key[1])
+                return False
+        self._push(msg, key)
+        self._index(msg, 1)
+        return True
 
     def dequeue(self):
         """Dequeues a given message."""
-        msg = None
-        if self.highpriority:
-            msg = self.highpriority.dequeue()
-        elif self.normal:
-            msg = self.normal.dequeue()
-        elif self.lowpriority:
-            msg = self.lowpriority.dequeue()
-            if msg.command == 'JOIN':
-                limit = conf.supybot.protocols.irc.queuing.rateLimit.join()
-                now = time.time()
-                if self.lastJoin + limit <= now:
-                    self.lastJoin = now
-                else:
-                    self.lowpriority.enqueue(msg)
-                    msg = None
+        while self.heap and self.heap[0][3] is None:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        (priority, score, _, msg, key) = heapq.heappop(self.heap)
+        self.clocks[priority] = score
+        entries = self.targets[key]
+        entries.popleft()
+        if not entries:
+            del self.targets[key]
+        self.length -= 1
+        if msg.command == 'JOIN':
+            limit = conf.supybot.protocols.irc.queuing.rateLimit.join()
+            now = time.time()
+            if self.lastJoin + limit <= now:
+                self.lastJoin = now
+            else:
+                self._push(msg, key)
+                return None
+        self._index(msg, -1)
         return msg
 
+    def delay(self, now=None):
+        """Returns how many seconds to wait before dequeue returns a message,
+        as it holds JOINs back according to
+        supybot.protocols.irc.queuing.rateLimit.join."""
+        while self.heap and self.heap[0][3] is None:
+            heapq.heappop(self.heap)
+        if not self.heap or self.heap[0][3].command != 'JOIN':
+            return 0
+        if now is None:
+            now = time.time()
+        limit = conf.supybot.protocols.irc.queuing.rateLimit.join()
+        return max(0, self.lastJoin + limit - now)
+
     def __contains__(self, msg):
-        return msg in self.normal or \
-               msg in self.lowpriority or \
-               msg in self.highpriority
+        return msg in self.index
 
     def __bool__(self):
-        return bool(self.highpriority or self.normal or self.lowpriority)
+        return bool(self.length)
     __nonzero__ = __bool__
 
     def __len__(self):
-        return len(self.highpriority)+len(self.lowpriority)+len(self.normal)
+        return self.length
 
     def __repr__(self):
         name = self.__class__.__name__
-        return '%s(%r)' % (name, list(chain(self.highpriority,
-                                            self.normal,
-                                            self.lowpriority)))
+        return '%s(%r)' % (name, [x[3] for x in sorted(self.heap)
+                                  if x[3] is not None])
     __str__ = __repr__
 
 
+class TokenBucket(object):
+    """Decides when the messages of an Irc's queue may be sent.
+
+    One token is added to the bucket every
+    supybot.protocols.irc.throttleTime seconds, up to
+    supybot.protocols.irc.throttleTime.burst tokens; a message may be sent
+    as soon as there is a full token in the bucket.  Sending a message costs
+    one token, plus one token per supybot.protocols.irc.throttleTime.
+    bytesPerToken bytes if that is not 0, so long messages delay the next
+    ones a bit more, as many servers' flood protections do.
+
+    Any object with the delay() and take() methods can be used as an Irc's
+    throttle instead.
+    """
+    __slots__ = ('tokens', 'lastRefill', 'sent')
+    def __init__(self):
+        self.tokens = float(conf.supybot.protocols.irc.throttleTime.burst())
+        self.lastRefill = time.time()
+        self.sent = 0
+
+    def _refill(self, now):
+        throttleTime = conf.supybot.protocols.irc.throttleTime()
+        burst = conf.supybot.protocols.irc.throttleTime.burst()
+        if throttleTime <= 0:
+            self.tokens = float(burst)
+        elif self.tokens < burst:
+            self.tokens = min(float(burst), self.tokens +
+                              (now - self.lastRefill) / throttleTime)
+        self.lastRefill = now
+
+    def cost(self, msg):
+        """Returns the number of tokens sending msg costs."""
+        bytesPerToken = conf.supybot.protocols.irc.throttleTime.bytesPerToken()
+        if bytesPerToken:
+            return 1 + len(msg) // bytesPerToken
+        else:
+            return 1
+
+    def delay(self, now=None):
+        """Returns how many seconds to wait before the next message can be
+        sent."""
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * conf.supybot.protocols.irc.throttleTime()
+
+    def expectedDelay(self, n, now=None):
+        """Returns how many seconds it will take before n messages (of the
+        smallest cost) are sent."""
+        if not n:
+            return 0
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        return max(0, n - self.tokens) * \
+            conf.supybot.protocols.irc.throttleTime()
+
+    def take(self, msg, now=None):
+        """Takes the tokens needed to send msg.  The bucket may go in debt
+        if msg costs more tokens than are available."""
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        self.tokens -= self.cost(msg)
+        self.sent += 1
+
+
 ###
 # Maintains the state of IRC connection -- the most recent messages, the
 # status of various modes (especially ops/halfops/voices) in channels, etc.
 ###
+def _internNick(s):
+    if isinstance(s, str):
+        # str() makes a plain string of IrcStrings.
+        return minisix.intern(str(s))
+    return s # unicode on Python 2
+
+def _foldNick(nick):
+    if isinstance(nick, ircutils.IrcString):
+        return nick.lowered
+    return ircutils.toLower(nick)
+
+class ChannelNickSet(object):
+    """Set-like view of the nicks of a ChannelState that have the given
+    mode bit (ChannelState.USER, OP, HALFOP or VOICE).  Iterating over it
+    gives the nicks as they were last seen, as plain strings."""
+    __slots__ = ('state', 'mode')
+    def __init__(self, state, mode):
+        self.state = state
+        self.mode = mode
+
+    def __contains__(self, nick):
+        try:
+            return bool(self.state._getModes(_foldNick(nick)) & self.mode)
+        except (TypeError, AttributeError):
+            return False
+
+    def __iter__(self):
+        state = self.state
+        if self.mode == ChannelState.USER:
+            # Copied, so that changes to the channel don't break our caller.
+            items = list(state._nicks.items())
+            for (key, nick) in items:
+                if state._modes.get(key, ChannelState.USER) & self.mode:
+                    yield nick
+        else:
+            items = list(state._modes.items())
+            for (key, modes) in items:
+                if modes & self.mode:
+                    yield state._nicks[key]
+
+    def __len__(self):
+        state = self.state
+        if self.mode == ChannelState.USER:
+            notUsers = [key for (key, modes) in state._modes.items()
+                        if not modes & self.mode]
+            return len(state._nicks) - len(notUsers)
+        else:
+            return len([key for (key, modes) in state._modes.items()
+                        if modes & self.mode])
+
+    def __eq__(self, other):
+        try:
+            return set(map(_foldNick, self)) == set(map(_foldNick, other))
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+    def add(self, nick):
+        self.state._setModes(nick, self.mode, True)
+
+    def discard(self, nick):
+        self.state._setModes(nick, self.mode, False)
+
+    def remove(self, nick):
+        if nick not in self:
+            raise KeyError(nick)
+        self.discard(nick)
+
 class ChannelState(utils.python.Object):
-    __slots__ = ('users', 'ops', 'halfops', 'bans',
-                 'voices', 'topic', 'modes', 'created')
+    """State of a channel.  Its members are kept in a single dict from their
+    case-folded nick to their nick, and their ops, halfops and voices as a
+    bitfield of modes, stored only for members that have any of those; nicks
+    are interned, so a nick in many channels is stored once.  users, ops,
+    halfops and voices are set-like views (see ChannelNickSet) on them."""
+    __slots__ = ('_nicks', '_modes', 'bans', 'topic', 'modes', 'created')
+    USER = 1
+    OP = 2
+    HALFOP = 4
+    VOICE = 8
     def __init__(self):
         self.topic = ''
         self.created = 0
-        self.ops = ircutils.IrcSet()
         self.bans = ircutils.IrcSet()
-        self.users = ircutils.IrcSet()
-        self.voices = ircutils.IrcSet()
-        self.halfops = ircutils.IrcSet()
+        self._nicks = {}
+        self._modes = {}
         self.modes = {}
 
+    users = property(lambda self: ChannelNickSet(self, self.USER))
+    ops = property(lambda self: ChannelNickSet(self, self.OP))
+    halfops = property(lambda self: ChannelNickSet(self, self.HALFOP))
+    voices = property(lambda self: ChannelNickSet(self, self.VOICE))
+
+    def _getModes(self, key):
+        """Returns the mode bits of the given case-folded nick."""
+        modes = self._modes.get(key)
+        if modes is None:
+            return self.USER if key in self._nicks else 0
+        return modes
+
+    def _setModes(self, nick, modes, value):
+        """Sets (if value is true) or unsets the given mode bits of nick."""
+        key = _foldNick(nick)
+        old = self._getModes(key)
+        if value:
+            new = old | modes
+        else:
+            new = old & ~modes
+        if new == old:
+            return
+        if not new:
+            del self._nicks[key]
+            self._modes.pop(key, None)
+            return
+        if not old:
+            key = _internNick(key)
+            self._nicks[key] = _internNick(nick)
+        if new == self.USER:
+            self._modes.pop(key, None)
+        else:
+            self._modes[key] = new
+
     def isOp(self, nick):
         return nick in self.ops
     def isOpPlus(self, nick):
@@ -254,17 +572,18 @@ class ChannelState(utils.python.Object):
     def isVoice(self, nick):
         return nick in self.voices
     def isVoicePlus(self, nick):
-        return nick in self.voices or nick in self.halfops or nick in self.ops
+        return nick in ChannelNickSet(self, self.VOICE|self.HALFOP|self.OP)
     def isHalfop(self, nick):
         return nick in self.halfops
     def isHalfopPlus(self, nick):
-        return nick in self.halfops or nick in self.ops
+        return nick in ChannelNickSet(self, self.HALFOP|self.OP)
 
     def addUser(self, user):
         "Adds a given user to the ChannelState.  Power prefixes are handled."
         nick = user.lstrip('@%+&~!')
         if not nick:
             return
+        modes = self.USER
         # & is used to denote protected users in UnrealIRCd
         # ~ is used to denote channel owner in UnrealIRCd
         # ! is used to denote protected users in UltimateIRCd
@@ -272,29 +591,39 @@ class ChannelState(utils.python.Object):
             (marker, user) = (user[0], user[1:])
             assert user, 'Looks like my caller is passing chars, not nicks.'
             if marker in '@&~!':
-                self.ops.add(nick)
+                modes |= self.OP
             elif marker == '%':
-                self.halfops.add(nick)
+                modes |= self.HALFOP
             elif marker == '+':
-                self.voices.add(nick)
-        self.users.add(nick)
+                modes |= self.VOICE
+        self._setModes(nick, modes, True)
 
     def replaceUser(self, oldNick, newNick):
         """Changes the user oldNick to newNick; used for NICK changes."""
         # Note that this doesn't have to have the sigil (@%+) that users
         # have to have for addUser; it just changes the name of the user
         # without changing any of their categories.
-        for s in (self.users, self.ops, self.halfops, self.voices):
-            if oldNick in s:
-                s.remove(oldNick)
-                s.add(newNick)
+        modes = self._getModes(_foldNick(oldNick))
+        if modes:
+            self._setModes(oldNick, modes, False)
+            self._setModes(newNick, modes, True)
 
     def removeUser(self, user):
         """Removes a given user from the channel."""
-        self.users.discard(user)
-        self.ops.discard(user)
-        self.halfops.discard(user)
-        self.voices.discard(user)
+        key = _foldNick(user)
+        if key in self._nicks:
+            del self._nicks[key]
+            self._modes.pop(key, None)
+
+    def copy(self):
+        ret = self.__class__()
+        ret.topic = self.topic
+        ret.created = self.created
+        ret.bans = ircutils.IrcSet(self.bans)
+        ret._nicks = self._nicks.copy()
+        ret._modes = self._modes.copy()
+        ret.modes = self.modes.copy()
+        return ret
 
     def setMode(self, mode, value=None):
         assert mode not in 'ovhbeq'
@@ -368,17 +697,22 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
         self.capabilities_nak = capabilities_nak or set()
         self.capabilities_ls = capabilities_ls or {}
         self.ircd = None
+        self.casemapping = 'rfc1459'
         self.supported = supported
         self.history = history
         self.channels = channels
         self.nicksToHostmasks = nicksToHostmasks
         self.batches = {}
+        # id() -> ChannelState, for the channel states shared with a copy.
+        self._sharedChannels = {}
 
     def reset(self):
         """Resets the state to normal, unconnected state."""
         self.history.reset()
         self.channels.clear()
+        self._sharedChannels = {}
         self.supported.clear()
+        self.casemapping = 'rfc1459'
         self.nicksToHostmasks.clear()
         self.history.resize(conf.supybot.protocols.irc.maxHistoryLength())
         self.batches = {}
@@ -398,12 +732,47 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
         return not self == other
 
     def copy(self):
+        """Returns a snapshot of this state.  Channel states are not copied,
+        but shared between the snapshot and this state until one of them
+        changes them through addMsg, so the copy costs O(number of channels)
+        plus O(members) for each channel that changes afterwards.  Channel
+        states are thus replaced when they change; don't keep references to
+        them, nor change those of a snapshot directly."""
         ret = self.__class__()
-        ret.history = copy.deepcopy(self.history)
-        ret.nicksToHostmasks = copy.deepcopy(self.nicksToHostmasks)
-        ret.channels = copy.deepcopy(self.channels)
-        ret.batches = copy.deepcopy(self.batches)
+        ret.history = copy.copy(self.history)
+        ret.supported = self.supported.copy()
+        ret.nicksToHostmasks = self.nicksToHostmasks.copy()
+        ret.channels = self.channels.copy()
+        ret.batches = dict((name, Batch(batch.type, batch.arguments,
+                                        list(batch.messages)))
+                           for (name, batch) in self.batches.items())
+        ret.casemapping = self.casemapping
+        shared = dict((id(chan), chan) for chan in self.channels.values())
+        self._sharedChannels = shared
+        ret._sharedChannels = shared.copy()
         return ret
+    __copy__ = copy
+
+    def _changeChannel(self, channel, create=False):
+        """Returns the state of the given channel, to be changed; it is
+        created if create is true and it doesn't exist.  Channel states shared
+        with a copy of this state are copied first."""
+        try:
+            chan = self.channels[channel]
+        except KeyError:
+            if not create:
+                raise
+            chan = ChannelState()
+            self.channels[channel] = chan
+        else:
+            if self._sharedChannels.pop(id(chan), None) is not None:
+                chan = chan.copy()
+                self.channels[channel] = chan
+        return chan
+
+    def _delChannel(self, channel):
+        chan = self.channels.pop(channel)
+        self._sharedChannels.pop(id(chan), None)
 
     def addMsg(self, irc, msg):
         """Updates the state based on the irc object and the message."""
@@ -504,6 +873,13 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
                     log.error('Name: %s, Converter: %s', name, converter)
             else:
                 self.supported[arg] = None
+        casemapping = self.supported.get('casemapping')
+        if casemapping in ircutils.casemappings:
+            self.casemapping = casemapping
+        elif casemapping is not None:
+            log.debug('Unsupported casemapping %r, using rfc1459.',
+                      casemapping)
+            self.casemapping = 'rfc1459'
 
     def do352(self, irc, msg):
         # WHO reply.
@@ -525,9 +901,7 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
     def do353(self, irc, msg):
         # NAMES reply.
         (__, type, channel, items) = msg.args
-        if channel not in self.channels:
-            self.channels[channel] = ChannelState()
-        c = self.channels[channel]
+        c = self._changeChannel(channel, create=True)
         for item in items.split():
             if ircutils.isUserHostmask(item):
                 name = ircutils.nickFromHostmask(item)
@@ -547,7 +921,7 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
     def doJoin(self, irc, msg):
         for channel in msg.args[0].split(','):
             if channel in self.channels:
-                self.channels[channel].addUser(msg.nick)
+                self._changeChannel(channel).addUser(msg.nick)
             elif msg.nick: # It must be us.
                 chan = ChannelState()
                 chan.addUser(msg.nick)
@@ -559,7 +933,7 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
         # Example:
         # :server 367 user #chan some!random@user evil!channel@op 1356276459
         try:
-            state = self.channels[msg.args[1]]
+            state = self._changeChannel(msg.args[1])
         except KeyError:
             # We have been kicked of the channel before the server replied to
             # the MODE +b command.
@@ -570,20 +944,12 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
     def doMode(self, irc, msg):
         channel = msg.args[0]
         if ircutils.isChannel(channel): # There can be user modes, as well.
-            try:
-                chan = self.channels[channel]
-            except KeyError:
-                chan = ChannelState()
-                self.channels[channel] = chan
+            chan = self._changeChannel(channel, create=True)
             chan.doMode(msg)
 
     def do324(self, irc, msg):
         channel = msg.args[1]
-        try:
-            chan = self.channels[channel]
-        except KeyError:
-            chan = ChannelState()
-            self.channels[channel] = chan
+        chan = self._changeChannel(channel, create=True)
         for (mode, value) in ircutils.separateModes(msg.args[2:]):
             modeChar = mode[1]
             if mode[0] == '+' and mode[1] not in 'ovh':
@@ -594,40 +960,33 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
     def do329(self, irc, msg):
         # This is the last part of an empty mode.
         channel = msg.args[1]
-        try:
-            chan = self.channels[channel]
-        except KeyError:
-            chan = ChannelState()
-            self.channels[channel] = chan
+        chan = self._changeChannel(channel, create=True)
         chan.created = int(msg.args[2])
 
     def doPart(self, irc, msg):
         for channel in msg.args[0].split(','):
-            try:
-                chan = self.channels[channel]
-            except KeyError:
+            if channel not in self.channels:
                 continue
-            if ircutils.strEqual(msg.nick, irc.nick):
-                del self.channels[channel]
+            if ircutils.strEqual(msg.nick, irc.nick, self.casemapping):
+                self._delChannel(channel)
             else:
-                chan.removeUser(msg.nick)
+                self._changeChannel(channel).removeUser(msg.nick)
 
     def doKick(self, irc, msg):
         (channel, users) = msg.args[:2]
-        chan = self.channels[channel]
         for user in users.split(','):
-            if ircutils.strEqual(user, irc.nick):
-                del self.channels[channel]
+            if ircutils.strEqual(user, irc.nick, self.casemapping):
+                self._delChannel(channel)
                 return
             else:
-                chan.removeUser(user)
+                self._changeChannel(channel).removeUser(user)
 
     def doQuit(self, irc, msg):
         channel_names = ircutils.IrcSet()
-        for (name, channel) in self.channels.items():
+        for (name, channel) in list(self.channels.items()):
             if msg.nick in channel.users:
                 channel_names.add(name)
-                channel.removeUser(msg.nick)
+                self._changeChannel(name).removeUser(msg.nick)
         # Remember which channels the user was on
         msg.tag('channels', channel_names)
         if msg.nick in self.nicksToHostmasks:
@@ -638,13 +997,13 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
         if len(msg.args) == 1:
             return # Empty TOPIC for information.  Does not affect state.
         try:
-            chan = self.channels[msg.args[0]]
+            chan = self._changeChannel(msg.args[0])
             chan.topic = msg.args[1]
         except KeyError:
             pass # We don't have to be in a channel to send a TOPIC.
 
     def do332(self, irc, msg):
-        chan = self.channels[msg.args[1]]
+        chan = self._changeChannel(msg.args[1])
         chan.topic = msg.args[2]
 
     def doNick(self, irc, msg):
@@ -660,10 +1019,10 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
         except KeyError:
             pass
         channel_names = ircutils.IrcSet()
-        for (name, channel) in self.channels.items():
-            if msg.nick in channel.users:
+        for (name, channel) in list(self.channels.items()):
+            if oldNick in channel.users:
                 channel_names.add(name)
-            channel.replaceUser(oldNick, newNick)
+                self._changeChannel(name).replaceUser(oldNick, newNick)
         msg.tag('channels', channel_names)
 
     def doBatch(self, irc, msg):
@@ -704,6 +1063,9 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
     _nickSetters = set(['001', '002', '003', '004', '250', '251', '252',
                         '254', '255', '265', '266', '372', '375', '376',
                         '333', '353', '332', '366', '005'])
+    # Incremented whenever a list of callbacks changes, since lists of
+    # callbacks may be shared by Irc objects.
+    _callbacksGeneration = 0
     # We specifically want these callbacks to be common between all Ircs,
     # that's why we don't do the normal None default with a check.
     def __init__(self, network, callbacks=_callbacks):
@@ -713,13 +1075,14 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
         self.startedAt = time.time()
         self.callbacks = callbacks
         self.state = IrcState()
-        self.queue = IrcMsgQueue()
+        self.queue = IrcMsgQueue(state=self.state)
         self.fastqueue = smallqueue()
         self.driver = None # The driver should set this later.
         self._setNonResettingVariables()
         self._queueConnectMessages()
         self.startedSync = ircutils.IrcDict()
         self.monitoring = ircutils.IrcDict()
+        self._resetDispatchTable()
 
     def isChannel(self, s):
         """Helper function to check whether a given string is a channel on
@@ -737,6 +1100,29 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
             kw['nicklen'] = self.state.supported['nicklen']
         return ircutils.isNick(s, **kw)
 
+    def _resetDispatchTable(self):
+        self._dispatchGeneration = Irc._callbacksGeneration
+        self._filters = [cb for cb in self.callbacks if _filtersMessages(cb)]
+        # Maps commands to the callbacks which handle them.
+        self._handlers = {}
+
+    def _callbacksChanged(self):
+        Irc._callbacksGeneration += 1
+        self._resetDispatchTable()
+
+    def _getHandlers(self, command):
+        """Returns the callbacks which need to be called for messages of the
+        given command, in the order they must be called."""
+        if self._dispatchGeneration != Irc._callbacksGeneration:
+            self._resetDispatchTable()
+        try:
+            return self._handlers[command]
+        except KeyError:
+            handlers = [cb for cb in self.callbacks
+                        if _handlesCommand(cb, command)]
+            self._handlers[command] = handlers
+            return handlers
+
     # This *isn't* threadsafe!
     def addCallback(self, callback):
         """Adds a callback to the callbacks list.
@@ -779,6 +1165,7 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
         assert len(cbs) == len(self.callbacks), \
                'cbs: %s, self.callbacks: %s' % (cbs, self.callbacks)
         self.callbacks[:] = cbs
+        self._callbacksChanged()
 
     def getCallback(self, name):
         """Gets a given callback by name."""
@@ -796,6 +1183,7 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
             return cb.name().lower() == name
         (bad, good) = utils.iter.partition(nameMatches, self.callbacks)
         self.callbacks[:] = good
+        self._callbacksChanged()
         return bad
 
     def queueMsg(self, msg):
@@ -822,11 +1210,13 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
         if self.fastqueue:
             msg = self.fastqueue.dequeue()
         elif self.queue:
-            if now-self.lastTake <= conf.supybot.protocols.irc.throttleTime():
+            if self.throttle.delay(now):
                 log.debug('Irc.takeMsg throttling.')
             else:
                 self.lastTake = now
                 msg = self.queue.dequeue()
+                if msg is not None:
+                    self.throttle.take(msg, now)
         elif self.afterConnect and \
              conf.supybot.protocols.irc.ping() and \
              now > self.lastping + conf.supybot.protocols.irc.ping.interval():
@@ -921,9 +1311,13 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
         except:
             log.exception('Exception in update of IrcState object:')
 
-        # Now call the callbacks.
+        # Now call the callbacks.  Only the callbacks which override inFilter
+        # can change the message, and only the callbacks which handle its
+        # command (or all commands) need to be called.
         world.debugFlush()
-        for callback in self.callbacks:
+        if self._dispatchGeneration != Irc._callbacksGeneration:
+            self._resetDispatchTable()
+        for callback in self._filters:
             try:
                 m = callback.inFilter(self, msg)
                 if not m:
@@ -936,7 +1330,7 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
         postInFilter = str(msg).rstrip('\r\n')
         if postInFilter != preInFilter:
             log.debug('Incoming message (post-inFilter): %s', postInFilter)
-        for callback in self.callbacks:
+        for callback in self._getHandlers(msg.command):
             try:
                 if callback is not None:
                     callback(self, msg)
@@ -982,6 +1376,7 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
         self.prefix = '%s!%s@%s' % (self.nick, self.ident, 'unset.domain')
         # The rest.
         self.lastTake = 0
+        self.throttle = TokenBucket()
         self.server = 'unset'
         self.afterConnect = False
         self.startedAt = time.time()
@@ -1485,7 +1880,8 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
                 (_, user, host) = ircutils.splitHostmask(msg.prefix)
                 newhostmask = ircutils.joinHostmask(msg.args[0], user, host)
                 for (i, (when, authmask)) in enumerate(u.auth[:]):
-                    if ircutils.strEqual(msg.prefix, authmask):
+                    if ircutils.strEqual(msg.prefix, authmask,
+                                         self.state.casemapping):
                         log.info('Following identification for %s: %s -> %s',
                                  u.name, authmask, newhostmask)
                         u.auth[i] = (u.auth[i][0], newhostmask)
@@ -1512,6 +1908,7 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
                 # hurt anybody.
                 log.debug('Last Irc, clearing callbacks.')
                 self.callbacks[:] = []
+                self._callbacksChanged()
         else:
             log.warning('Irc object killed twice: %s', utils.stackTrace())
 
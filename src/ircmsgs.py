@@ -75,6 +75,34 @@ def parse_server_tags(s):
             (key, value) = tag.split('=', 1)
             server_tags[key] = unescape_server_tag_value(value)
     return server_tags
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+def parse_time_tag(s):
+    """Returns the timestamp represented by the value of a 'time' server
+    tag, which is in the YYYY-MM-DDThh:mm:ss.sssZ format.
+
+    This is equivalent to (but much faster than) parsing it with
+    datetime.datetime.strptime."""
+    if len(s) < 20 or s[4] != '-' or s[7] != '-' or s[10] != 'T' or \
+            s[13] != ':' or s[16] != ':' or s[-1] != 'Z':
+        raise ValueError('Invalid time tag: %r' % s)
+    days = datetime.date(int(s[0:4]), int(s[5:7]), int(s[8:10])).toordinal()
+    seconds = (days - _EPOCH_ORDINAL) * 86400 + int(s[11:13]) * 3600 + \
+              int(s[14:16]) * 60 + int(s[17:19])
+    if len(s) == 20:
+        return float(seconds)
+    if s[19] != '.':
+        raise ValueError('Invalid time tag: %r' % s)
+    microseconds = int(s[20:-1][:6].ljust(6, '0'))
+    return (seconds * 1000000 + microseconds) / 1000000.0
+
+def _parse_raw_time_tag(s):
+    """Returns the timestamp of the 'time' tag in the raw server tags s, or
+    None if there is none, without parsing the other tags."""
+    for tag in s.split(';'):
+        if tag.startswith('time='):
+            return parse_time_tag(unescape_server_tag_value(tag[5:]))
+    return None
+
 def format_server_tags(server_tags):
     parts = []
     for (key, value) in server_tags.items():
@@ -114,9 +142,9 @@ class IrcMsg(object):
     # It's too useful to be able to tag IrcMsg objects with extra, unforeseen
     # data.  Goodbye, __slots__.
     # On second thought, let's use methods for tagging.
-    __slots__ = ('args', 'command', 'host', 'nick', 'prefix', 'user',
+    __slots__ = ('_args', 'command', '_hostmask', 'prefix', '_rawArgs',
                  '_hash', '_str', '_repr', '_len', 'tags', 'reply_env',
-                 'server_tags', 'time')
+                 '_server_tags', '_rawServerTags', 'time')
     def __init__(self, s='', command='', args=(), prefix='', msg=None,
             reply_env=None):
         assert not (msg and s), 'IrcMsg.__init__ cannot accept both s and msg'
@@ -126,37 +154,41 @@ class IrcMsg(object):
         self._repr = None
         self._hash = None
         self._len = None
+        self._hostmask = None
+        self._rawArgs = None
+        self._rawServerTags = None
         self.reply_env = reply_env
         self.tags = {}
         if s:
+            # Only the prefix, the command and the time are parsed here; the
+            # arguments and server tags are parsed from the raw line the first
+            # time they are used, since most messages are only looked at by
+            # callbacks which do not care about them.
             originalString = s
             try:
                 if not s.endswith('\n'):
                     s += '\n'
                 self._str = s
+                self.time = time.time()
                 if s[0] == '@':
                     (server_tags, s) = s.split(' ', 1)
-                    self.server_tags = parse_server_tags(server_tags[1:])
+                    self._rawServerTags = server_tags[1:]
+                    self._server_tags = None
+                    if 'time=' in server_tags:
+                        # Raises ValueError if the time tag is invalid.
+                        timestamp = _parse_raw_time_tag(self._rawServerTags)
+                        if timestamp is not None:
+                            self.time = timestamp
                 else:
-                    self.server_tags = {}
+                    self._server_tags = {}
                 if s[0] == ':':
                     self.prefix, s = s[1:].split(None, 1)
                 else:
                     self.prefix = ''
-                if ' :' in s: # Note the space: IPV6 addresses are bad w/o it.
-                    s, last = s.split(' :', 1)
-                    self.args = s.split()
-                    self.args.append(last.rstrip('\r\n'))
-                else:
-                    self.args = s.split()
-                self.command = self.args.pop(0)
-                if 'time' in self.server_tags:
-                    s = self.server_tags['time']
-                    date = datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%fZ')
-                    date = minisix.make_datetime_utc(date)
-                    self.time = minisix.datetime__timestamp(date)
-                else:
-                    self.time = time.time()
+                if s[0].isspace():
+                    raise ValueError('No command.')
+                self.command = s.split(None, 1)[0]
+                self._rawArgs = s
             except (IndexError, ValueError):
                 raise MalformedIrcMsg(repr(originalString))
         else:
@@ -180,7 +212,7 @@ class IrcMsg(object):
                 else:
                     self.reply_env = None
                 self.tags = msg.tags.copy()
-                self.server_tags = msg.server_tags
+                self._server_tags = msg.server_tags
                 self.time = msg.time
             else:
                 self.prefix = prefix
@@ -188,12 +220,56 @@ class IrcMsg(object):
                 assert all(ircutils.isValidArgument, args), args
                 self.args = args
                 self.time = None
-                self.server_tags = {}
-        self.args = tuple(self.args)
-        if isUserHostmask(self.prefix):
-            (self.nick,self.user,self.host)=ircutils.splitHostmask(self.prefix)
+                self._server_tags = {}
+
+    def _parseArgs(self):
+        s = self._rawArgs
+        if ' :' in s: # Note the space: IPV6 addresses are bad w/o it.
+            s, last = s.split(' :', 1)
+            args = s.split()
+            args.append(last.rstrip('\r\n'))
         else:
-            (self.nick, self.user, self.host) = (self.prefix,)*3
+            args = s.split()
+        self._args = tuple(args[1:])
+        self._rawArgs = None
+
+    @property
+    def args(self):
+        if self._rawArgs is not None:
+            self._parseArgs()
+        return self._args
+
+    @args.setter
+    def args(self, args):
+        self._args = tuple(args)
+        self._rawArgs = None
+
+    def _splitPrefix(self):
+        if self._hostmask is None:
+            if isUserHostmask(self.prefix):
+                self._hostmask = ircutils.splitHostmask(self.prefix)
+            else:
+                self._hostmask = (self.prefix,)*3
+        return self._hostmask
+
+    @property
+    def nick(self):
+        return self._splitPrefix()[0]
+
+    @property
+    def user(self):
+        return self._splitPrefix()[1]
+
+    @property
+    def host(self):
+        return self._splitPrefix()[2]
+
+    @property
+    def server_tags(self):
+        if self._rawServerTags is not None:
+            self._server_tags = parse_server_tags(self._rawServerTags)
+            self._rawServerTags = None
+        return self._server_tags
 
     def __str__(self):
         if self._str is not None:
@@ -44,6 +44,7 @@ import time
 import base64
 import random
 import string
+import operator
 import textwrap
 import functools
 
@@ -100,25 +101,56 @@ def joinHostmask(nick, ident, host):
     assert nick and ident and host
     return minisix.intern('%s!%s@%s' % (nick, ident, host))
 
-_rfc1459trans = utils.str.MultipleReplacer(dict(list(zip(
-                                 string.ascii_uppercase + r'\[]~',
-                                 string.ascii_lowercase + r'|{}^'))))
-def toLower(s, casemapping=None):
-    """s => s
-    Returns the string s lowered according to IRC case rules."""
-    if casemapping is None or casemapping == 'rfc1459':
-        return _rfc1459trans(s)
-    elif casemapping == 'ascii': # freenode
-        return s.lower()
+# The values of the CASEMAPPING token of RPL_ISUPPORT (005), and the
+# characters they lower.
+casemappings = {
+    'ascii': (string.ascii_uppercase, string.ascii_lowercase),
+    'strict-rfc1459': (string.ascii_uppercase + r'\[]',
+                       string.ascii_lowercase + r'|{}'),
+    'rfc1459': (string.ascii_uppercase + r'\[]~',
+                string.ascii_lowercase + r'|{}^'),
+    }
+# str.translate is much faster with a string of the first 256 characters as
+# its table than with a dict; characters past the end are left alone.
+_casemappingTables = {}
+for (_name, (_from, _to)) in casemappings.items():
+    if minisix.PY3:
+        _casemappingTables[_name] = ''.join(map(chr, range(256))).translate(
+                str.maketrans(_from, _to))
     else:
-        raise ValueError('Invalid casemapping: %r' % casemapping)
+        # One table for str, one for unicode.
+        _casemappingTables[_name] = (string.maketrans(_from, _to),
+                dict(zip(map(ord, _from), map(ord, _to))))
+del _name, _from, _to
+
+if minisix.PY3:
+    def toLower(s, casemapping=None):
+        """s => s
+        Returns the string s lowered according to IRC case rules."""
+        try:
+            table = _casemappingTables[casemapping or 'rfc1459']
+        except KeyError:
+            raise ValueError('Invalid casemapping: %r' % casemapping)
+        return s.translate(table)
+else:
+    def toLower(s, casemapping=None):
+        """s => s
+        Returns the string s lowered according to IRC case rules."""
+        try:
+            (bytesTable, unicodeTable) = \
+                    _casemappingTables[casemapping or 'rfc1459']
+        except KeyError:
+            raise ValueError('Invalid casemapping: %r' % casemapping)
+        if isinstance(s, str):
+            return s.translate(bytesTable)
+        return s.translate(unicodeTable)
 
-def strEqual(nick1, nick2):
+def strEqual(nick1, nick2, casemapping=None):
     """s1, s2 => bool
     Returns True if nick1 == nick2 according to IRC case rules."""
     assert isinstance(nick1, minisix.string_types)
     assert isinstance(nick2, minisix.string_types)
-    return toLower(nick1) == toLower(nick2)
+    return toLower(nick1, casemapping) == toLower(nick2, casemapping)
 
 nickEqual = strEqual
 
@@ -167,15 +199,70 @@ def areReceivers(s, strictRfc=True, nicklen=None, chantypes='#&+!',
             channellen=channellen)
     return all([nick(x) or chan(x) for x in s.split(',')])
 
-_patternCache = utils.structures.CacheDict(1000)
-def _hostmaskPatternEqual(pattern, hostmask):
+_lower = operator.methodcaller('lower')
+
+def _isAscii(s):
     try:
-        return _patternCache[pattern](hostmask) is not None
-    except KeyError:
+        s.encode('ascii')
+        return True
+    except UnicodeError:
+        return False
+
+class HostmaskPattern(object):
+    """A compiled hostmask pattern; match(hostmask) returns whether hostmask
+    matches it, IRC-case-insensitively.
+
+    Patterns are classified by their wildcards: 'exact' patterns have none,
+    'prefix' ones only end with a '*', 'suffix' ones only start with a '*',
+    'segments' ones only have '*' wildcards (like '*!*@host'), and the
+    others (with a '?' or non-ASCII characters) are 'generic'.  Suffix and
+    segments patterns starting with a '*', like most bans, are matched by
+    looking for their literal parts in the folded hostmask, which is much
+    cheaper than the backtracking of a regexp starting with '.*'.  The other
+    patterns are matched with a regexp, which rejects most hostmasks at
+    their first character."""
+    __slots__ = ('pattern', 'kind', 'match', '_parts', '_fold', '_regexp')
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._regexp = None
+        self._parts = None
+        self.match = self._matchRegexp
+        if '?' in pattern or not _isAscii(pattern):
+            self.kind = 'generic'
+            return
+        folded = toLower(pattern)
+        parts = folded.split('*')
+        if len(parts) == 1:
+            self.kind = 'exact'
+        elif len(parts) == 2 and not parts[1]:
+            self.kind = 'prefix'
+        elif len(parts) == 2:
+            self.kind = 'suffix'
+        else:
+            self.kind = 'segments'
+        if not parts[0] and parts[-1] and self.kind != 'prefix':
+            self._parts = parts
+            if self.kind == 'suffix':
+                self.match = self._matchSuffix
+            else:
+                self.match = self._matchSegments
+            # str.lower is much faster than str.translate, and folds like
+            # rfc1459 unless the pattern has one of the characters it maps
+            # '[]\\~' to.
+            if '{' in folded or '}' in folded or '|' in folded or \
+               '^' in folded:
+                self._fold = toLower
+            else:
+                self._fold = _lower
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.pattern)
+
+    def _compile(self):
         # We make our own regexps, rather than use fnmatch, because fnmatch's
         # case-insensitivity is not IRC's case-insensitity.
         fd = minisix.io.StringIO()
-        for c in pattern:
+        for c in self.pattern:
             if c == '*':
                 fd.write('.*')
             elif c == '?':
@@ -191,18 +278,71 @@ def _hostmaskPatternEqual(pattern, hostmask):
             else:
                 fd.write(re.escape(c))
         fd.write('$')
-        f = re.compile(fd.getvalue(), re.I).match
-        _patternCache[pattern] = f
-        return f(hostmask) is not None
+        self._regexp = re.compile(fd.getvalue(), re.I).match
+        return self._regexp
+
+    def _matchRegexp(self, hostmask):
+        regexp = self._regexp or self._compile()
+        return regexp(hostmask) is not None
+
+    def _matchSuffix(self, hostmask):
+        last = self._parts[1]
+        if self._fold(hostmask[-len(last):]) == last:
+            return True
+        return self._matchNonAscii(hostmask)
+
+    def _matchSegments(self, hostmask):
+        parts = self._parts
+        last = parts[-1]
+        folded = self._fold(hostmask)
+        if folded.endswith(last):
+            # Finding each literal part at its leftmost position leaves as
+            # much room as possible to the following ones.
+            (start, end) = (0, len(folded) - len(last))
+            for part in parts[1:-1]:
+                start = folded.find(part, start, end)
+                if start == -1:
+                    break
+                start += len(part)
+            else:
+                return True
+        return self._matchNonAscii(hostmask)
+
+    def _matchNonAscii(self, hostmask):
+        try:
+            hostmask.encode('ascii')
+            return False
+        except UnicodeError:
+            # Some non-ASCII characters match ASCII letters
+            # case-insensitively.
+            return self._matchRegexp(hostmask)
+
+_patternCache = utils.structures.CacheDict(1000)
+def compileHostmaskPattern(pattern):
+    """pattern => HostmaskPattern
+    Returns a (cached) HostmaskPattern for the given pattern."""
+    try:
+        return _patternCache[pattern]
+    except KeyError:
+        compiled = HostmaskPattern(pattern)
+        _patternCache[pattern] = compiled
+        return compiled
+
+def _hostmaskPatternEqual(pattern, hostmask):
+    return compileHostmaskPattern(pattern).match(hostmask)
 
 _hostmaskPatternEqualCache = utils.structures.CacheDict(1000)
 def hostmaskPatternEqual(pattern, hostmask):
     """pattern, hostmask => bool
     Returns True if hostmask matches the hostmask pattern pattern."""
+    compiled = compileHostmaskPattern(pattern)
+    if compiled.kind != 'generic':
+        # Cheaper than a lookup in the cache.
+        return compiled.match(hostmask)
     try:
         return _hostmaskPatternEqualCache[(pattern, hostmask)]
     except KeyError:
-        b = _hostmaskPatternEqual(pattern, hostmask)
+        b = compiled.match(hostmask)
         _hostmaskPatternEqualCache[(pattern, hostmask)] = b
         return b
 
@@ -657,13 +797,18 @@ def unDccIP(i):
     return '.'.join(map(str, L))
 
 class IrcString(str):
-    """This class does case-insensitive comparison and hashing of nicks."""
+    """This class does case-insensitive comparison and hashing of nicks.
+    Its lowered form is computed (and interned) once."""
     def __new__(cls, s=''):
+        if type(s) is cls:
+            return s
         x = super(IrcString, cls).__new__(cls, s)
-        x.lowered = str(toLower(x))
+        x.lowered = minisix.intern(str(toLower(x)))
         return x
 
     def __eq__(self, s):
+        if isinstance(s, IrcString):
+            return s.lowered == self.lowered
         try:
             return toLower(s) == self.lowered
         except:
@@ -679,7 +824,9 @@ class IrcString(str):
 class IrcDict(utils.InsensitivePreservingDict):
     """Subclass of dict to make key comparison IRC-case insensitive."""
     def key(self, s):
-        if s is not None:
+        if isinstance(s, IrcString):
+            return s.lowered
+        elif s is not None:
             s = toLower(s)
         return s
 
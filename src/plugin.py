@@ -89,6 +89,7 @@ def renameCommand(cb, name, newName):
         method = getattr(cb.__class__, name)
         setattr(cb.__class__, newName, method)
         delattr(cb.__class__, name)
+        callbacks.CommandIndex.invalidate()
 
 def registerRename(plugin, command=None, newName=None):
     g = conf.registerGlobalValue(conf.supybot.commands.renames, plugin,
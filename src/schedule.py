@@ -128,6 +128,15 @@ class Schedule(drivers.IrcDriver):
 
     removePeriodicEvent = removeEvent
 
+    def nextEventTime(self):
+        """Returns the time at which the next event is due, or None if no
+        event is scheduled."""
+        with self.lock:
+            if self.schedule:
+                return self.schedule[0][0]
+            else:
+                return None
+
     def run(self):
         if len(drivers._drivers) == 1 and not world.testing:
             log.error('Schedule is the only remaining driver, '
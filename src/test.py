@@ -60,6 +60,7 @@ class verbosity:
 i18n.import_conf()
 network = True
 setuid = True
+benchmark = False
 
 # This is the global list of suites that are to be run.
 suites = []
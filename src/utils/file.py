@@ -236,4 +236,80 @@ class AtomicFile(object):
         # no logging facility in utils.  I've got some ideas for this, though.
         self.rollback()
 
+class Journal(object):
+    """Keeps a file made of records up to date by appending the records that
+    changed to filename + '.journal' instead of rewriting the whole file.
+
+    Each record is a string, identified by a key; the file is the records
+    sorted by key.  removal(key) returns the record to append to the journal
+    when a key is removed.  Once the journal holds more than max(maxSize(),
+    number of records) records, the file is rewritten through AtomicFile and
+    the journal is removed ("compacted"), so writes cost time proportional
+    to the change rather than to the whole file.  If maxSize() is 0, the file
+    is rewritten on every change, without any journal."""
+    def __init__(self, filename, removal, maxSize=1000):
+        self.filename = filename
+        self.journalName = filename + '.journal'
+        self.removal = removal
+        self.maxSize = maxSize
+        self.records = {}
+        self.size = 0
+        self.fd = None
+
+    def _maxSize(self):
+        if callable(self.maxSize):
+            return self.maxSize()
+        return self.maxSize
+
+    def update(self, changes, compact=False):
+        """Takes an iterable of (key, record) pairs, record being None for
+        removed keys, and writes the records that changed."""
+        L = []
+        for (key, record) in changes:
+            old = self.records.get(key)
+            if record == old:
+                continue
+            elif record is None:
+                del self.records[key]
+                L.append(self.removal(key))
+            else:
+                self.records[key] = record
+                L.append(record)
+        maxSize = self._maxSize()
+        if L and maxSize:
+            # Changes are journaled even when compacting right after, so
+            # that replaying the journal over the new file is harmless if we
+            # die before removing the journal.
+            if self.fd is not None and not os.path.exists(self.journalName):
+                # Compacted by someone else.
+                self.close()
+                self.size = 0
+            if self.fd is None:
+                self.fd = codecs.open(self.journalName, 'a', encoding='utf8')
+            for record in L:
+                self.fd.write(record)
+            self.fd.flush()
+            self.size += len(L)
+        if compact or (L and not maxSize) or \
+           self.size > max(maxSize, len(self.records)) or \
+           (self.size and not os.path.exists(self.filename)):
+            self.compact()
+
+    def compact(self):
+        """Rewrites the file with the current records and removes the
+        journal."""
+        fd = AtomicFile(self.filename)
+        for key in sorted(self.records):
+            fd.write(self.records[key])
+        fd.close()
+        self.close()
+        if os.path.exists(self.journalName):
+            os.remove(self.journalName)
+        self.size = 0
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
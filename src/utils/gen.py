@@ -284,6 +284,12 @@ class InsensitivePreservingDict(collections.MutableMapping):
     def __delitem__(self, k):
         del self.data[self.key(k)]
 
+    def copy(self):
+        ret = self.__class__.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__) # Keeps the key function.
+        ret.data = self.data.copy()
+        return ret
+
     def __iter__(self):
         return iter(self.data)
 
@@ -0,0 +1,676 @@
+###
+# Copyright (c) 2026, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""Regular expressions matched in linear time, for patterns given by users.
+
+compile() parses patterns with the parser of the re module, and compiles
+them to a Thompson NFA instead of using re's backtracking engine, so matching
+takes time proportional to the length of the string times the size of the
+pattern, instead of exponential time for patterns like (a+)+$.  The DFA
+states reached while searching are cached, so searching is mostly a dict
+lookup per character.  If the RE2 bindings are installed, they are used
+instead.  Patterns using features that need backtracking (backreferences,
+lookaround assertions, conditionals) or optional repeats of sub-patterns
+which may match the empty string, like (a*)*, are compiled by the re
+module."""
+
+import re
+import sys
+import time
+import string
+
+try:
+    import sre_parse
+    import sre_constants
+except ImportError: # Python 3.11+ deprecated them.
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+from . import minisix
+
+error = re.error
+
+# Patterns compiled to more instructions than this are left to re, so that
+# a{1000}{1000} can't be used to make the NFA huge.
+maxProgramSize = 2000
+# Number of DFA transitions cached per pattern.
+maxCacheSize = 10000
+
+# Since Python 3.7, an empty match found by finditer or sub is followed by
+# a search for a match which is not empty at the same position, instead of
+# a search from the next position.
+_MUST_ADVANCE = sys.version_info >= (3, 7)
+
+class _Unsupported(Exception):
+    pass
+
+class Timeout(Exception):
+    """Raised by searchBefore when its deadline passes."""
+    pass
+
+_LITERAL = sre_constants.LITERAL
+_NOT_LITERAL = sre_constants.NOT_LITERAL
+_IN = sre_constants.IN
+_ANY = sre_constants.ANY
+_NEGATE = sre_constants.NEGATE
+_RANGE = sre_constants.RANGE
+_CATEGORY = sre_constants.CATEGORY
+_SUBPATTERN = sre_constants.SUBPATTERN
+_BRANCH = sre_constants.BRANCH
+_MAX_REPEAT = sre_constants.MAX_REPEAT
+_MIN_REPEAT = sre_constants.MIN_REPEAT
+_AT = sre_constants.AT
+_MAXREPEAT = sre_constants.MAXREPEAT
+
+_asciiWord = frozenset(string.ascii_letters + string.digits + '_')
+def _isWord(c, uni):
+    if uni:
+        return c.isalnum() or c == '_'
+    else:
+        return c in _asciiWord
+
+def _isDigit(c, uni):
+    if uni:
+        return getattr(c, 'isdecimal', c.isdigit)()
+    else:
+        return '0' <= c <= '9'
+
+def _isSpace(c, uni):
+    if uni:
+        return c.isspace()
+    else:
+        return c in ' \t\n\r\f\v'
+
+_categories = {
+    sre_constants.CATEGORY_DIGIT: _isDigit,
+    sre_constants.CATEGORY_NOT_DIGIT: lambda c, uni: not _isDigit(c, uni),
+    sre_constants.CATEGORY_SPACE: _isSpace,
+    sre_constants.CATEGORY_NOT_SPACE: lambda c, uni: not _isSpace(c, uni),
+    sre_constants.CATEGORY_WORD: _isWord,
+    sre_constants.CATEGORY_NOT_WORD: lambda c, uni: not _isWord(c, uni),
+}
+
+def _charTest(op, av, flags):
+    """Returns a function telling whether a character matches the
+    LITERAL, NOT_LITERAL, ANY or IN item (op, av)."""
+    if op == _ANY:
+        if flags & re.DOTALL:
+            return lambda c: True
+        else:
+            return lambda c: c != '\n'
+    negate = op == _NOT_LITERAL
+    if op == _IN:
+        items = av
+    else:
+        items = [(_LITERAL, av)]
+    literals = set()
+    ranges = []
+    categories = []
+    for (op, av) in items:
+        if op == _NEGATE:
+            negate = True
+        elif op == _LITERAL:
+            literals.add(av)
+        elif op == _RANGE:
+            ranges.append(av)
+        elif op == _CATEGORY and av in _categories:
+            categories.append(_categories[av])
+        else:
+            raise _Unsupported(op)
+    uni = flags & re.UNICODE
+    def raw(c):
+        o = ord(c)
+        if o in literals:
+            return True
+        for (low, high) in ranges:
+            if low <= o <= high:
+                return True
+        for category in categories:
+            if category(c, uni):
+                return True
+        return False
+    if flags & re.IGNORECASE:
+        def test(c):
+            if raw(c):
+                return not negate
+            for d in (c.lower(), c.upper()):
+                if len(d) == 1 and raw(d):
+                    return not negate
+            return negate
+    else:
+        def test(c):
+            return raw(c) != negate
+    return test
+
+def _nullable(subpattern):
+    """Returns whether subpattern may match the empty string."""
+    for (op, av) in subpattern:
+        if op in (_LITERAL, _NOT_LITERAL, _IN, _ANY):
+            return False
+        elif op == _SUBPATTERN:
+            if not _nullable(av[-1]):
+                return False
+        elif op == _BRANCH:
+            if not any(map(_nullable, av[1])):
+                return False
+        elif op in (_MAX_REPEAT, _MIN_REPEAT):
+            if av[0] and not _nullable(av[2]):
+                return False
+    return True
+
+# Instructions of the programs are tuples whose first item is one of these.
+(_CHAR, _SPLIT, _JMP, _SAVE, _ASSERT, _MATCH) = range(6)
+# Kinds of _ASSERT instructions.
+(_BOS, _BOL, _EOS, _EOSNL, _EOL, _BOUNDARY, _NON_BOUNDARY) = range(7)
+
+def _context(s, i, n):
+    """Returns what assertions need to know about the position i of s[:n],
+    apart from the next character."""
+    if i > 0:
+        p = s[i-1]
+        return (False, p == '\n', _isWord(p, False), _isWord(p, True),
+                i == n, i == n - 1 and s[i] == '\n')
+    else:
+        return (True, False, False, False, i == n, n == 1 and s[0] == '\n')
+
+def _check(kind, uni, context, c):
+    (bos, afterNewline, afterWordA, afterWordU, eos, beforeLastNewline) = \
+            context
+    if kind == _BOS:
+        return bos
+    elif kind == _BOL:
+        return bos or afterNewline
+    elif kind == _EOS:
+        return eos
+    elif kind == _EOSNL:
+        return eos or beforeLastNewline
+    elif kind == _EOL:
+        return eos or c == '\n'
+    elif bos and eos:
+        # re's \b and \B both fail on the empty string.
+        return False
+    afterWord = afterWordU if uni else afterWordA
+    beforeWord = c is not None and _isWord(c, uni)
+    if kind == _BOUNDARY:
+        return afterWord != beforeWord
+    else:
+        return afterWord == beforeWord
+
+class _Compiler(object):
+    def __init__(self):
+        # Searching starts at 0, with a lazy .* before the pattern, and
+        # matching starts at 3.
+        self.prog = [(_SPLIT, 3, 1), (_CHAR, lambda c: True), (_JMP, 0),
+                     (_SAVE, 0)]
+        self.asserts = False
+
+    def emit(self, instruction):
+        self.prog.append(instruction)
+        if len(self.prog) > maxProgramSize:
+            raise _Unsupported('too big')
+        return len(self.prog) - 1
+
+    def split(self, pc, preferred, other, greedy):
+        if greedy:
+            self.prog[pc] = (_SPLIT, preferred, other)
+        else:
+            self.prog[pc] = (_SPLIT, other, preferred)
+
+    def compile(self, subpattern, flags):
+        for (op, av) in subpattern:
+            self.compileItem(op, av, flags)
+
+    def compileItem(self, op, av, flags):
+        prog = self.prog
+        if op in (_LITERAL, _NOT_LITERAL, _IN, _ANY):
+            self.emit((_CHAR, _charTest(op, av, flags)))
+        elif op == _SUBPATTERN:
+            if len(av) == 2:
+                (group, subpattern) = av
+            else: # Python 3.6+, with scoped flags.
+                (group, add, remove, subpattern) = av
+                flags = (flags | add) & ~remove
+            if group:
+                self.emit((_SAVE, 2*group))
+            self.compile(subpattern, flags)
+            if group:
+                self.emit((_SAVE, 2*group + 1))
+        elif op == _BRANCH:
+            alternatives = av[1]
+            jumps = []
+            for alternative in alternatives[:-1]:
+                split = self.emit(None)
+                self.compile(alternative, flags)
+                jumps.append(self.emit(None))
+                self.split(split, split + 1, len(prog), True)
+            self.compile(alternatives[-1], flags)
+            for jump in jumps:
+                prog[jump] = (_JMP, len(prog))
+        elif op in (_MAX_REPEAT, _MIN_REPEAT):
+            (min, max, item) = av
+            greedy = op == _MAX_REPEAT
+            if max > min and _nullable(item):
+                # re stops repeating item as soon as an iteration matches
+                # the empty string, which threads of the NFA can't know.
+                raise _Unsupported('nullable repeat')
+            for i in range(min):
+                self.compile(item, flags)
+            if max == _MAXREPEAT:
+                split = self.emit(None)
+                self.compile(item, flags)
+                self.emit((_JMP, split))
+                self.split(split, split + 1, len(prog), greedy)
+            else:
+                splits = []
+                for i in range(max - min):
+                    splits.append(self.emit(None))
+                    self.compile(item, flags)
+                for split in splits:
+                    self.split(split, split + 1, len(prog), greedy)
+        elif op == _AT:
+            self.asserts = True
+            multiline = flags & re.MULTILINE
+            kind = {
+                sre_constants.AT_BEGINNING: _BOL if multiline else _BOS,
+                sre_constants.AT_BEGINNING_STRING: _BOS,
+                sre_constants.AT_END: _EOL if multiline else _EOSNL,
+                sre_constants.AT_END_STRING: _EOS,
+                sre_constants.AT_BOUNDARY: _BOUNDARY,
+                sre_constants.AT_NON_BOUNDARY: _NON_BOUNDARY,
+            }.get(av)
+            if kind is None:
+                raise _Unsupported(av)
+            self.emit((_ASSERT, kind, flags & re.UNICODE))
+        else:
+            # Backreferences, lookaround assertions, conditionals, ...
+            raise _Unsupported(op)
+
+class Pattern(object):
+    """A compiled regular expression, with the same interface as the ones
+    of the re module (except for split and fullmatch), matched in linear
+    time."""
+    def __init__(self, regexp, prog, asserts):
+        self.pattern = regexp.pattern
+        self.flags = regexp.flags
+        self.groups = regexp.groups
+        self.groupindex = regexp.groupindex
+        self._prog = prog
+        self._asserts = asserts
+        self._cache = {}
+
+    def __reduce__(self):
+        return (compile, (self.pattern, self.flags))
+
+    def __repr__(self):
+        return 'safere.compile(%r)' % (self.pattern,)
+
+    def _step(self, kernel, context, c, deadline=None):
+        """Returns whether the DFA state kernel (a frozenset of pcs) reaches
+        a _MATCH before c, and the state reached after c."""
+        key = (kernel, context, c)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        if deadline is not None and time.time() > deadline:
+            raise Timeout()
+        prog = self._prog
+        stack = list(kernel)
+        seen = set()
+        matched = False
+        next = set()
+        while stack:
+            pc = stack.pop()
+            if pc in seen:
+                continue
+            seen.add(pc)
+            instruction = prog[pc]
+            op = instruction[0]
+            if op == _CHAR:
+                if c is not None and instruction[1](c):
+                    next.add(pc + 1)
+            elif op == _SPLIT:
+                stack.append(instruction[1])
+                stack.append(instruction[2])
+            elif op == _JMP:
+                stack.append(instruction[1])
+            elif op == _SAVE:
+                stack.append(pc + 1)
+            elif op == _ASSERT:
+                if _check(instruction[1], instruction[2], context, c):
+                    stack.append(pc + 1)
+            else:
+                matched = True
+        result = (matched, frozenset(next))
+        if len(self._cache) >= maxCacheSize:
+            self._cache.clear()
+        self._cache[key] = result
+        return result
+
+    def _matches(self, s, start, pos, n, deadline=None):
+        """Returns whether the program, started at start, matches s[pos:n],
+        without keeping track of where.  Raises Timeout if deadline is given
+        and passes first."""
+        kernel = frozenset([start])
+        asserts = self._asserts
+        context = None
+        for i in range(pos, n + 1):
+            c = s[i] if i < n else None
+            if asserts:
+                context = _context(s, i, n)
+            if deadline is not None and not i & 4095 and \
+               time.time() > deadline:
+                raise Timeout()
+            (matched, kernel) = self._step(kernel, context, c, deadline)
+            if matched:
+                return True
+            elif not kernel:
+                return False
+        return False
+
+    def _addThread(self, threads, seen, pc, slots, s, i, n):
+        prog = self._prog
+        context = c = None
+        stack = [(pc, slots)]
+        while stack:
+            (pc, slots) = stack.pop()
+            if pc in seen:
+                continue
+            seen.add(pc)
+            instruction = prog[pc]
+            op = instruction[0]
+            if op == _CHAR or op == _MATCH:
+                threads.append((pc, slots))
+            elif op == _SPLIT:
+                # Pushed last so it is followed first.
+                stack.append((instruction[2], slots))
+                stack.append((instruction[1], slots))
+            elif op == _JMP:
+                stack.append((instruction[1], slots))
+            elif op == _SAVE:
+                slots = slots[:]
+                slots[instruction[1]] = i
+                stack.append((pc + 1, slots))
+            else:
+                if context is None:
+                    context = _context(s, i, n)
+                    c = s[i] if i < n else None
+                if _check(instruction[1], instruction[2], context, c):
+                    stack.append((pc + 1, slots))
+
+    def _spans(self, s, start, pos, n, mustAdvance=False):
+        """Runs the program as a Pike VM, and returns the list of the
+        start and end of each group of the preferred match of s[pos:n], or
+        None.  If mustAdvance is true, empty matches at pos are ignored."""
+        prog = self._prog
+        threads = []
+        self._addThread(threads, set(), start, [None] * (2*self.groups + 2),
+                        s, pos, n)
+        matched = None
+        i = pos
+        while threads:
+            c = s[i] if i < n else None
+            next = []
+            seen = set()
+            for (pc, slots) in threads:
+                instruction = prog[pc]
+                if instruction[0] == _MATCH:
+                    if mustAdvance and slots[1] == pos:
+                        continue
+                    # Threads after this one have a lower priority.
+                    matched = slots
+                    break
+                elif c is not None and instruction[1](c):
+                    self._addThread(next, seen, pc + 1, slots, s, i + 1, n)
+            threads = next
+            i += 1
+        return matched
+
+    def _bounds(self, s, pos, endpos):
+        n = len(s)
+        if endpos is not None:
+            n = max(0, min(endpos, n))
+        return (max(0, pos), n)
+
+    def search(self, string, pos=0, endpos=None):
+        (pos, n) = self._bounds(string, pos, endpos)
+        if pos <= n and self._matches(string, 0, pos, n):
+            return Match(self, string, pos, n, 0)
+        return None
+
+    def match(self, string, pos=0, endpos=None):
+        (pos, n) = self._bounds(string, pos, endpos)
+        if pos <= n and self._matches(string, 3, pos, n):
+            return Match(self, string, pos, n, 3)
+        return None
+
+    def finditer(self, string, pos=0, endpos=None):
+        (pos, n) = self._bounds(string, pos, endpos)
+        mustAdvance = False
+        while pos <= n:
+            slots = self._spans(string, 0, pos, n, mustAdvance)
+            if slots is None:
+                break
+            yield Match(self, string, pos, n, 0, slots)
+            (start, end) = slots[0:2]
+            if _MUST_ADVANCE:
+                (pos, mustAdvance) = (end, end == start)
+            else:
+                pos = end if end > start else end + 1
+
+    def findall(self, string, pos=0, endpos=None):
+        L = []
+        for m in self.finditer(string, pos, endpos):
+            if self.groups == 0:
+                L.append(m.group())
+            elif self.groups == 1:
+                L.append(m.group(1) or string[:0])
+            else:
+                L.append(m.groups(string[:0]))
+        return L
+
+    def subn(self, repl, string, count=0):
+        pieces = []
+        last = 0
+        n = 0
+        for m in self.finditer(string):
+            (start, end) = m.span()
+            if start == end and n and start == last and not _MUST_ADVANCE:
+                # Before Python 3.7, re does not replace empty matches
+                # adjacent to a previous match.
+                continue
+            pieces.append(string[last:start])
+            if callable(repl):
+                pieces.append(repl(m))
+            else:
+                pieces.append(m.expand(repl))
+            last = end
+            n += 1
+            if count and n >= count:
+                break
+        pieces.append(string[last:])
+        return (string[:0].join(pieces), n)
+
+    def sub(self, repl, string, count=0):
+        return self.subn(repl, string, count)[0]
+
+_escapes = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+            'v': '\v', '\\': '\\'}
+_templateRe = re.compile(r'\\(?:g<([^>]*)>|(0[0-7]{0,2}|[1-9][0-9]?)|(.))',
+                         re.S)
+def _expand(m, template):
+    def repl(t):
+        (name, number, escaped) = t.groups()
+        if escaped is not None:
+            return _escapes.get(escaped, t.group(0))
+        elif number is not None and number[0] == '0':
+            return chr(int(number, 8))
+        group = name if number is None else number
+        if group.isdigit():
+            group = int(group)
+        try:
+            return m.group(group) or m.string[:0]
+        except IndexError:
+            raise error('invalid group reference %s' % group)
+    return _templateRe.sub(repl, template)
+
+class Match(object):
+    """The result of a successful search or match.  The positions of the
+    groups are only computed when needed."""
+    def __init__(self, re, string, pos, endpos, start, slots=None):
+        self.re = re
+        self.string = string
+        self.pos = pos
+        self.endpos = endpos
+        self._start = start
+        self._slotList = slots
+
+    def __repr__(self):
+        return '<safere.Match object; span=%r, match=%r>' % \
+                (self.span(), self.group())
+
+    @property
+    def _slots(self):
+        if self._slotList is None:
+            self._slotList = self.re._spans(self.string, self._start,
+                                            self.pos, self.endpos)
+        return self._slotList
+
+    def _index(self, group):
+        if isinstance(group, minisix.string_types):
+            group = self.re.groupindex.get(group, -1)
+        if not 0 <= group <= self.re.groups:
+            raise IndexError('no such group')
+        return group
+
+    def span(self, group=0):
+        i = self._index(group)
+        (start, end) = self._slots[2*i:2*i + 2]
+        if start is None or end is None:
+            return (-1, -1)
+        return (start, end)
+
+    def start(self, group=0):
+        return self.span(group)[0]
+
+    def end(self, group=0):
+        return self.span(group)[1]
+
+    def _group(self, group, default=None):
+        (start, end) = self.span(group)
+        if start == -1:
+            return default
+        return self.string[start:end]
+
+    def group(self, *groups):
+        if not groups:
+            return self._group(0)
+        elif len(groups) == 1:
+            return self._group(groups[0])
+        else:
+            return tuple(map(self._group, groups))
+    __getitem__ = _group
+
+    def groups(self, default=None):
+        return tuple([self._group(i, default)
+                      for i in range(1, self.re.groups + 1)])
+
+    def groupdict(self, default=None):
+        return dict([(name, self._group(i, default))
+                     for (name, i) in self.re.groupindex.items()])
+
+    def expand(self, template):
+        return _expand(self, template)
+
+_re2Flags = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'))
+def _compile(regexp):
+    if not isinstance(regexp.pattern, minisix.string_types) or \
+       regexp.flags & re.LOCALE:
+        raise _Unsupported('bytes or locale')
+    parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    # Includes the inline flags of the pattern.
+    flags = (getattr(parsed, 'state', None) or parsed.pattern).flags
+    compiler = _Compiler()
+    compiler.compile(parsed, flags)
+    if re2 is not None and not flags & re.VERBOSE:
+        inline = ''.join([c for (flag, c) in _re2Flags if flags & flag])
+        try:
+            if inline:
+                return re2.compile('(?%s)%s' % (inline, regexp.pattern))
+            else:
+                return re2.compile(regexp.pattern)
+        except Exception:
+            pass
+    compiler.emit((_SAVE, 1))
+    compiler.emit((_MATCH,))
+    return Pattern(regexp, compiler.prog, compiler.asserts)
+
+_cache = {}
+def compile(pattern, flags=0):
+    """Compiles pattern like re.compile does (and raises re.error if it is
+    invalid), but returns an object matching in linear time if it can."""
+    key = (type(pattern), pattern, flags)
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    regexp = re.compile(pattern, flags)
+    try:
+        compiled = _compile(regexp)
+    except _Unsupported:
+        compiled = regexp
+    if len(_cache) >= 100:
+        _cache.clear()
+    _cache[key] = compiled
+    return compiled
+
+def searchBefore(regexp, string, deadline):
+    """Returns whether regexp, which must be linear, matches somewhere in
+    string.  Patterns compiled by this module raise Timeout if this is not
+    known by the time.time() deadline: while linear, matching still takes
+    time proportional to the size of the pattern for each character when
+    the DFA states don't fit in the cache."""
+    if isinstance(regexp, Pattern):
+        (pos, n) = regexp._bounds(string, 0, None)
+        return regexp._matches(string, 0, pos, n, deadline)
+    else:
+        return regexp.search(string) is not None
+
+def isLinear(regexp):
+    """Returns whether regexp is matched in linear time, i.e. whether it was
+    compiled by this module or by RE2."""
+    return isinstance(regexp, Pattern) or \
+           type(regexp).__module__.split('.')[0] in ('re2', '_re2')
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -38,7 +38,7 @@ import time
 import string
 import textwrap
 
-from . import minisix
+from . import minisix, safere
 from .iter import any
 from .structures import TwoWayDictionary
 
@@ -79,10 +79,22 @@ if minisix.PY3:
             else:
                 line = line.decode('utf8', 'replace')
         return line
+
+    def decode_raw_lines(data):
+        """Splits data on newlines and decodes the lines.  All the lines are
+        decoded at once when they are valid UTF-8, which is much faster than
+        decoding them one by one."""
+        try:
+            return data.decode('utf8', 'strict').split('\n')
+        except UnicodeError:
+            return [decode_raw_line(line) for line in data.split(b'\n')]
 else:
     def decode_raw_line(line):
         return line
 
+    def decode_raw_lines(data):
+        return str(data).split('\n')
+
 def rsplit(s, sep=None, maxsplit=-1):
     """Equivalent to str.split, except splitting from the right."""
     return s.rsplit(sep, maxsplit)
@@ -208,6 +220,17 @@ def _getSep(s, allowBraces=False):
               '"%s"' % braces)
     return separator
 
+# Set to supybot.commands.regexps.safe by conf.
+safeRegexps = False
+
+def compileRegexp(pattern, flags=0):
+    """Compiles a regular expression given by a user, with utils.safere
+    instead of the re module if safeRegexps is true."""
+    if force(safeRegexps):
+        return safere.compile(pattern, flags)
+    else:
+        return re.compile(pattern, flags)
+
 def perlReToPythonRe(s, allowG=False):
     """Converts a string representation of a Perl regular expression (i.e.,
     m/^foo$/i or /foo|bar/) to a Python regular expression.
@@ -236,7 +259,7 @@ def perlReToPythonRe(s, allowG=False):
     except AttributeError:
         raise ValueError('Invalid flag: %s' % c)
     try:
-        r = re.compile(regexp, flag)
+        r = compileRegexp(regexp, flag)
     except re.error as e:
         raise ValueError(str(e))
     if allowG:
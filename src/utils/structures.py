@@ -32,6 +32,7 @@ Data structures for Python.
 """
 
 import time
+import threading
 import collections
 
 
@@ -160,6 +161,11 @@ class RingBuffer(object):
         self.i = i
         self.L = L
 
+    def __copy__(self):
+        ret = self.__class__.__new__(self.__class__)
+        ret.__setstate__((self.maxSize, self.full, self.i, list(self.L)))
+        return ret
+
 
 class queue(object):
     """Queue class for handling large queues.  Queues smaller than 1,000 or so
@@ -428,34 +434,153 @@ class MultiSet(object):
 
 
 class CacheDict(collections.MutableMapping):
-    __slots__ = ('d', 'max')
-    def __init__(self, max, **kwargs):
-        self.d = dict(**kwargs)
+    """A dictionary holding at most `max` items, evicting the least recently
+    used ones (as approximated by the CLOCK algorithm) when it is full.
+
+    `max` may be a callable (such as a registry value), which is called
+    again whenever the cache is full.  If `ttl` is given, items older than
+    that many seconds are treated as missing.  Lookups only mark items as
+    recently used, so they do not need to lock the cache."""
+    __slots__ = ('d', 'max', 'maxGetter', 'ttl', 'ring', 'hand', 'lock',
+                 'hits', 'misses', 'evictions')
+    def __init__(self, max, ttl=None, **kwargs):
+        if callable(max):
+            self.maxGetter = max
+            max = max()
+        else:
+            self.maxGetter = None
+        if max <= 0:
+            raise ValueError('max must be > 0.')
         self.max = max
+        self.ttl = ttl
+        self.d = {} # key -> [value, referenced, expiration, slot]
+        self.ring = []
+        self.hand = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        for (key, value) in kwargs.items():
+            self[key] = value
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.max,
+                               dict(self.items()))
+
+    def _get(self, key):
+        entry = self.d[key]
+        if entry[2] is not None and entry[2] <= time.time():
+            raise KeyError(key)
+        entry[1] = True
+        return entry[0]
 
     def __getitem__(self, key):
-        return self.d[key]
+        try:
+            value = self._get(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def __contains__(self, key):
+        try:
+            self._get(key)
+            return True
+        except KeyError:
+            return False
+
+    def _evict(self):
+        """Moves the hand to the next slot of the ring which a new item can
+        use, evicting the item in it if needed, and returns that slot."""
+        while True:
+            if self.hand >= len(self.ring):
+                self.hand = 0
+            slot = self.hand
+            self.hand += 1
+            key = self.ring[slot]
+            entry = self.d.get(key)
+            if entry is None or entry[3] != slot:
+                # The item of this slot was removed, or added again since.
+                return slot
+            if entry[1] and (entry[2] is None or time.time() < entry[2]):
+                entry[1] = False
+            else:
+                del self.d[key]
+                self.evictions += 1
+                return slot
+
+    def _resize(self, max):
+        self.max = max
+        while len(self.d) > max:
+            self._evict()
+        # Compact the ring, so it is not longer than max.
+        self.ring = list(self.d)
+        self.hand = 0
+        for (slot, key) in enumerate(self.ring):
+            self.d[key][3] = slot
+
+    def resize(self, max):
+        """Changes the maximum size of the cache, evicting items if it
+        shrinks."""
+        if max <= 0:
+            raise ValueError('max must be > 0.')
+        with self.lock:
+            self._resize(max)
 
     def __setitem__(self, key, value):
-        if len(self.d) >= self.max:
-            self.d.clear()
-        self.d[key] = value
+        expiration = None
+        if self.ttl is not None:
+            expiration = time.time() + self.ttl
+        with self.lock:
+            entry = self.d.get(key)
+            if entry is not None:
+                entry[0] = value
+                entry[2] = expiration
+                return
+            if self.maxGetter is not None and len(self.ring) >= self.max:
+                max = self.maxGetter()
+                if max != self.max and max > 0:
+                    self._resize(max)
+            if len(self.ring) < self.max:
+                slot = len(self.ring)
+                self.ring.append(key)
+            else:
+                slot = self._evict()
+                self.ring[slot] = key
+            self.d[key] = [value, False, expiration, slot]
 
     def __delitem__(self, key):
-        del self.d[key]
+        with self.lock:
+            del self.d[key]
+
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+            self.ring = []
+            self.hand = 0
+
+    def _live(self):
+        now = time.time()
+        return [(key, entry[0]) for (key, entry) in list(self.d.items())
+                if entry[2] is None or now < entry[2]]
 
     def keys(self):
-        return self.d.keys()
-    
+        return [key for (key, _) in self._live()]
+
     def items(self):
-        return self.d.items()
+        return self._live()
 
     def __iter__(self):
-        return iter(self.d)
+        return iter(self.keys())
 
     def __len__(self):
         return len(self.d)
 
+    def stats(self):
+        """Returns a (size, hits, misses, evictions) tuple."""
+        return (len(self.d), self.hits, self.misses, self.evictions)
+
 class TruncatableSet(collections.MutableSet):
     """A set that keeps track of the order of inserted elements so
     the oldest can be removed."""
@@ -38,6 +38,7 @@ import time
 import atexit
 import select
 import threading
+import collections
 import multiprocessing
 
 import re
@@ -63,6 +64,137 @@ class SupyThread(threading.Thread, object):
         super(SupyThread, self).__init__(*args, **kwargs)
         log.debug('Spawning thread %q.', self.getName())
 
+class ThreadPool(object):
+    """Runs jobs in at most maxThreads() threads, started when needed and
+    stopped after idleTimeout seconds without jobs.  Jobs waiting for a
+    thread are queued, up to maxQueued() of them (0 for no limit), and at
+    most maxPerKey() (0 for no limit) jobs of the same key run at once; keys
+    are usually plugin names.  If maxThreads() is 0, each job gets its own
+    thread, like before pools existed."""
+    def __init__(self, name, maxThreads, maxQueued, maxPerKey,
+                 idleTimeout=60, samples=1000):
+        self.name = name
+        self.maxThreads = maxThreads
+        self.maxQueued = maxQueued
+        self.maxPerKey = maxPerKey
+        self.idleTimeout = idleTimeout
+        self.lock = threading.Condition()
+        self.queue = []
+        self.running = {}
+        self.threads = 0
+        self.idle = 0
+        self.completed = 0
+        self.rejected = 0
+        # Seconds between the submission and the end of the last jobs.
+        self.latencies = collections.deque(maxlen=samples)
+
+    def submit(self, f, key=None, name=None):
+        """Runs f() in a thread of the pool; name is used for the thread
+        while it runs f.  Returns False without running f if the queue is
+        full."""
+        if name is None:
+            name = getattr(f, '__name__', repr(f))
+        maxThreads = self.maxThreads()
+        job = (f, key, name, time.time())
+        if not maxThreads:
+            t = SupyThread(target=self._run, args=(job,),
+                           name='Thread #%s' % threadsSpawned)
+            t.setDaemon(True)
+            t.start()
+            return True
+        with self.lock:
+            maxQueued = self.maxQueued()
+            if maxQueued and len(self.queue) >= maxQueued:
+                self.rejected += 1
+                return False
+            self.queue.append(job)
+            if self.idle:
+                self.lock.notify()
+            if len(self.queue) > self.idle and self.threads < maxThreads:
+                self.threads += 1
+                t = SupyThread(target=self._work, name='Thread #%s (%s pool)'
+                               % (threadsSpawned, self.name))
+                t.setDaemon(True)
+                t.start()
+        return True
+
+    def _pop(self):
+        """Returns the first queued job whose key is under its cap, if
+        any.  Must be called with the lock held."""
+        maxPerKey = self.maxPerKey()
+        for (i, job) in enumerate(self.queue):
+            key = job[1]
+            if not maxPerKey or key is None or \
+               self.running.get(key, 0) < maxPerKey:
+                return self.queue.pop(i)
+        return None
+
+    def _run(self, job):
+        (f, key, name, submitted) = job
+        thread = threading.currentThread()
+        threadName = thread.getName()
+        thread.setName('%s (for %s)' % (threadName, name))
+        try:
+            f()
+        except Exception:
+            log.exception('Uncaught exception in %s:', name)
+        finally:
+            thread.setName(threadName)
+            with self.lock:
+                self.completed += 1
+                self.latencies.append(time.time() - submitted)
+
+    def _work(self):
+        with self.lock:
+            while True:
+                job = self._pop()
+                if job is None:
+                    if self.threads > self.maxThreads():
+                        break
+                    self.idle += 1
+                    waited = time.time()
+                    self.lock.wait(self.idleTimeout)
+                    self.idle -= 1
+                    if time.time() - waited >= self.idleTimeout and \
+                       not self.queue:
+                        break
+                    continue
+                key = job[1]
+                self.running[key] = self.running.get(key, 0) + 1
+                self.lock.release()
+                try:
+                    self._run(job)
+                finally:
+                    self.lock.acquire()
+                    self.running[key] -= 1
+                    if not self.running[key]:
+                        del self.running[key]
+                    # Jobs waiting for this key's cap may run now.
+                    self.lock.notify_all()
+            self.threads -= 1
+
+    def stats(self):
+        """Returns a dict of the number of threads, queued, running,
+        completed and rejected jobs, and of the 50th, 90th and 99th
+        percentiles of the latency of the last jobs (None if there were no
+        jobs)."""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'threads': self.threads, 'queued': len(self.queue),
+                     'running': sum(self.running.values()),
+                     'completed': self.completed, 'rejected': self.rejected}
+        for p in (50, 90, 99):
+            if latencies:
+                i = int(round((len(latencies) - 1) * p / 100.))
+                stats['p%s' % p] = latencies[i]
+            else:
+                stats['p%s' % p] = None
+        return stats
+
+threadPool = ThreadPool('commands', conf.supybot.commands.threads.maximum,
+                        conf.supybot.commands.threads.queueSize,
+                        conf.supybot.commands.threads.perPlugin)
+
 processesSpawned = 1 # Starts at one for the initial process.
 class SupyProcess(multiprocessing.Process):
     def __init__(self, *args, **kwargs):
@@ -176,9 +308,20 @@ def upkeep():
     if not dying:
         if minisix.PY2:
             log.debug('Regexp cache size: %s', len(re._cache))
-        log.debug('Pattern cache size: %s', len(ircutils._patternCache))
-        log.debug('HostmaskPatternEqual cache size: %s',
-                  len(ircutils._hostmaskPatternEqualCache))
+        from . import ircdb # ircdb imports us.
+        caches = [('Pattern', ircutils._patternCache),
+                  ('HostmaskPatternEqual',
+                   ircutils._hostmaskPatternEqualCache),
+                  ('User name', ircdb.users._nameCache),
+                  ('User hostmask', ircdb.users._hostmaskCache),
+                  ('Capability', ircdb.capabilityCache.cache)]
+        for (name, cache) in caches:
+            (size, hits, misses, evictions) = cache.stats()
+            log.debug('%s cache: %s/%s entries, %s hits, %s misses, '
+                      '%s evictions.', name, size, cache.max, hits, misses,
+                      evictions)
+        log.debug('Capability decisions: %s hits, %s misses.',
+                  ircdb.capabilityCache.hits, ircdb.capabilityCache.misses)
         #timestamp = log.timestamp()
         if doFlush:
             log.info('Flushers flushed and garbage collected.')
@@ -620,6 +620,87 @@ class SourceNestedPluginTestCase(PluginTestCase):
         self.assertEqual(cb.getCommand(['e', 'same']), ['e', 'same'])
         self.assertResponse('e same', 'same')
 
+    def testCommandIndex(self):
+        cb = self.E(self.irc)
+        self.irc.addCallback(cb)
+        index = callbacks.CommandIndex.get(self.irc)
+        self.failUnless(cb not in index.dynamic)
+        for args in (['f'], ['same'], ['same', 'same'], ['e', 'f', 'g'],
+                     ['e', 'g', 'h'], ['e', 'g', 'i', 'j', 'k'], ['g', 'h'],
+                     ['e', 'g'], ['e'], ['echo', 'foo'], ['utilities'],
+                     ['utilities', 'echo'], ['e', 'same', 'same']):
+            expected = [(c, c.getCommand(args)) for c in self.irc.callbacks
+                        if hasattr(c, 'getCommand')]
+            self.assertEqual([x for x in index.lookup(args) if x[1]],
+                             [x for x in expected if x[1]])
+        self.assertEqual(index.lookup(['e', 'g', 'i', 'j']),
+                         [(cb, ['e', 'g', 'i', 'j'])])
+        self.failUnless(callbacks.CommandIndex.get(self.irc) is index)
+        cb._disabled.add('f', cb.name())
+        try:
+            index = callbacks.CommandIndex.get(self.irc)
+            self.assertEqual(index.lookup(['f']), [])
+        finally:
+            cb._disabled.remove('f', cb.name())
+        self.assertEqual(callbacks.CommandIndex.get(self.irc).lookup(['f']),
+                         [(cb, ['f'])])
+        self.irc.removeCallback(cb.name())
+        self.assertEqual(callbacks.CommandIndex.get(self.irc).lookup(['f']),
+                         [])
+
+    def testCommandRegistry(self):
+        cb = self.E(self.irc)
+        self.irc.addCallback(cb)
+        self.assertEqual(cb._getCommandRegistry().names,
+                         frozenset(['f', 'empty']))
+        self.assertEqual(cb.g._getCommandRegistry().names, frozenset(['h']))
+        self.failUnless(cb.isCommandMethod('f'))
+        self.failIf(cb.isCommandMethod('E'))
+        self.failIf(cb.isCommandMethod('getCommand'))
+        self.failIf(cb.isCommandMethod('g'))
+        help = cb.getCommandHelp(['f'], simpleSyntax=False)
+        self.assertEqual(help, callbacks.getHelp(cb.f, name='f'))
+        self.failUnless(cb.getCommandHelp(['f'], simpleSyntax=False) is help)
+        self.assertEqual(cb.getCommandHelp(['f'], simpleSyntax=True),
+                         'f takes no arguments')
+        cb._disabled.add('f', cb.name())
+        try:
+            self.failIf(cb.isCommandMethod('f'))
+            self.assertEqual(cb.listCommands(),
+                             ['empty', 'g h', 'g i j', 'same'])
+        finally:
+            cb._disabled.remove('f', cb.name())
+        self.failUnless(cb.isCommandMethod('f'))
+
+    def testCommandIndexSearch(self):
+        cb = self.E(self.irc)
+        self.irc.addCallback(cb)
+        index = callbacks.CommandIndex.get(self.irc)
+        for s in ('e', 'ec', 'ech', 'g i', 'ame', 'mpt', 'xyz'):
+            expected = [(command, c) for c in self.irc.callbacks
+                        if isinstance(c, callbacks.Plugin)
+                        for command in c.listCommands() if s in command]
+            self.assertEqual(sorted(index.search(s), key=repr),
+                             sorted(expected, key=repr))
+        self.failUnless(('g i j', cb) in index.search('g i'))
+
+    if benchmark:
+        def testBenchmarkCommandIndex(self):
+            self.irc.addCallback(self.E(self.irc))
+            args = ['e', 'g', 'i', 'j']
+            index = callbacks.CommandIndex.get(self.irc)
+            started = time.time()
+            for i in range(10000):
+                index.lookup(args)
+            indexed = time.time() - started
+            started = time.time()
+            for i in range(10000):
+                [cb.getCommand(args) for cb in self.irc.callbacks]
+            print('')
+            print('10000 command lookups: %.2f seconds with CommandIndex, '
+                  '%.2f seconds with getCommand.' %
+                  (indexed, time.time() - started))
+
 
 class WithPrivateNoticeTestCase(ChannelPluginTestCase):
     plugins = ('Utilities',)
@@ -28,12 +28,20 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import os
+import re
 import sys
+import types
+import socket
+import time
+import random
 import getopt
+import threading
 
 from supybot.test import *
 
 from supybot.commands import *
+import supybot.commands as commands
 import supybot.conf as conf
 import supybot.irclib as irclib
 import supybot.ircmsgs as ircmsgs
@@ -217,5 +225,165 @@ class GetoptTestCase(PluginTestCase):
         self.assertResponse('bar --f 3 --fb 5',
                 'Error: Invalid arguments for bar.')
 
+class ThreadPoolTestCase(SupyTestCase):
+    def testPool(self):
+        pool = world.ThreadPool('test', lambda: 2, lambda: 3, lambda: 1)
+        release = threading.Event()
+        lock = threading.Lock()
+        ran = []
+        def job(name):
+            def f():
+                release.wait(10)
+                with lock:
+                    ran.append(name)
+            return f
+        self.failUnless(pool.submit(job('a'), key='x'))
+        self.failUnless(pool.submit(job('b'), key='x')) # Over x's cap
+        self.failUnless(pool.submit(job('c'), key='y'))
+        time.sleep(0.1) # Lets the threads start a and c.
+        self.failUnless(pool.submit(job('d'), key='z'))
+        self.failUnless(pool.submit(job('e'), key='z'))
+        self.failIf(pool.submit(job('f'), key='z')) # Queue is full
+        time.sleep(0.1)
+        stats = pool.stats()
+        self.assertEqual(stats['threads'], 2)
+        self.assertEqual(stats['running'], 2)
+        self.assertEqual(stats['queued'], 3)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['p50'], None)
+        release.set()
+        for i in range(100):
+            if pool.stats()['completed'] == 5:
+                break
+            time.sleep(0.05)
+        self.assertEqual(sorted(ran), ['a', 'b', 'c', 'd', 'e'])
+        stats = pool.stats()
+        self.assertEqual((stats['running'], stats['queued']), (0, 0))
+        self.failUnless(stats['p50'] <= stats['p90'] <= stats['p99'])
+
+    def testNoPool(self):
+        pool = world.ThreadPool('test', lambda: 0, lambda: 1, lambda: 1)
+        done = threading.Event()
+        self.failUnless(pool.submit(done.set))
+        self.failUnless(done.wait(10) or done.isSet())
+        self.assertEqual(pool.stats()['threads'], 0)
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+class SandboxPoolTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.disableMultiprocessing = world.disableMultiprocessing
+        world.disableMultiprocessing = False
+        self.pool = commands.SandboxPool(lambda: 1, lambda: 0)
+
+    def tearDown(self):
+        for worker in self.pool.idle:
+            worker.kill()
+        world.disableMultiprocessing = self.disableMultiprocessing
+        SupyTestCase.tearDown(self)
+
+    def testCall(self):
+        self.assertEqual(self.pool.call(max, (1, 3, 2)), 3)
+        self.failUnless(isinstance(self.pool.call(int, ('a',)), ValueError))
+        self.assertEqual(self.pool.workers, 1)
+        (worker,) = self.pool.idle
+        self.assertEqual(self.pool.call(len, ('foo',)), 3)
+        self.assertEqual(self.pool.idle, [worker])
+
+    def testMap(self):
+        reobj = re.compile('^a')
+        self.assertEqual(self.pool.map(commands._regexpSearch,
+                                       ['ab', 'ba', 'a'], (reobj,)),
+                         [True, False, True])
+        self.assertEqual(self.pool.map(len, []), [])
+
+    def testTimeout(self):
+        self.assertRaises(commands.ProcessTimeoutError,
+                          self.pool.call, _sleep, (10,), timeout=0.2)
+        self.assertEqual((self.pool.workers, self.pool.idle), (0, []))
+        results = self.pool.map(_sleep, [0, 10, 0], timeout=0.2)
+        self.assertEqual(results[0::2], [0, 0])
+        self.failUnless(isinstance(results[1],
+                                   commands.ProcessTimeoutError))
+        self.assertEqual(self.pool.workers, 1)
+
+    def testUnpicklable(self):
+        self.assertRaises(commands._Unpicklable,
+                          self.pool.call, lambda: 1)
+        self.assertEqual(self.pool.call(len, ('foo',)), 3)
+
+    def testInheritedFdsAreReleased(self):
+        (a, b) = socket.socketpair()
+        try:
+            self.assertEqual(self.pool.call(len, ('foo',)), 3)
+            a.close()
+            b.settimeout(10)
+            # The idle worker must not keep a open.
+            self.assertEqual(b.recv(1), b'')
+        finally:
+            b.close()
+
+    def testUnpicklableInWorker(self):
+        self.assertEqual(self.pool.call(len, ('foo',)), 3)
+        # A module the worker did not have when it was forked.
+        module = types.ModuleType('sandboxtest')
+        exec('def f(x):\n    return x + 1', module.__dict__)
+        module.f.__module__ = 'sandboxtest'
+        sys.modules['sandboxtest'] = module
+        try:
+            self.assertRaises(commands._Unpicklable,
+                              self.pool.call, module.f, (1,))
+            self.assertRaises(commands._Unpicklable,
+                              self.pool.map, module.f, [1, 2])
+            self.assertEqual(self.pool.workers, 1)
+            self.assertEqual(self.pool.call(len, ('foo',)), 3)
+            commands.sandbox, pool = self.pool, commands.sandbox
+            try:
+                self.assertEqual(process(module.f, 1), 2)
+            finally:
+                commands.sandbox = pool
+        finally:
+            del sys.modules['sandboxtest']
+
+    def testWorkerDied(self):
+        self.assertRaises(commands.ProcessDiedError,
+                          self.pool.call, os._exit, (1,))
+        self.assertRaises(commands.ProcessDiedError,
+                          self.pool.map, os._exit, [1])
+        self.assertEqual((self.pool.workers, self.pool.idle), (0, []))
+        self.assertEqual(self.pool.call(len, ('foo',)), 3)
+
+    def testRegexpDeadline(self):
+        re2 = utils.safere.re2
+        utils.safere.re2 = None
+        utils.safere._cache.clear()
+        commands.sandbox, pool = self.pool, commands.sandbox
+        try:
+            # Too many DFA states for its cache, so each string is slow.
+            reobj = utils.safere.compile('[ab]*a[ab]{60}c')
+            rnd = random.Random(0)
+            strings = [''.join(rnd.choice('ab') for i in range(100)) + c
+                       for c in 'cd' * 15]
+            expected = [re.search(reobj.pattern, s) is not None
+                        for s in strings]
+            self.assertEqual(regexp_filter(strings, reobj, 0.05,
+                                           'Test', 'test'), expected)
+            # The strings left when the deadline passed went to the pool.
+            self.assertEqual(self.pool.workers, 1)
+        finally:
+            commands.sandbox = pool
+            utils.safere.re2 = re2
+            utils.safere._cache.clear()
+
+    def testProcess(self):
+        self.assertEqual(process(len, 'foo'), 3)
+        self.assertEqual(process(lambda x: x + 1, 2, timeout=10), 3)
+        self.assertEqual(regexp_filter(['foo', 'bar'], re.compile('o'),
+                                       10, 'Test', 'test'), [True, False])
+
+
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
 
@@ -0,0 +1,344 @@
+###
+# Copyright (c) 2002-2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+from supybot.test import *
+
+import time
+import unittest
+import socket
+import threading
+
+import supybot.conf as conf
+import supybot.ircmsgs as ircmsgs
+import supybot.irclib as irclib
+import supybot.drivers as drivers
+from supybot.drivers import Socket
+
+try:
+    from supybot.drivers import Asyncio
+except ImportError: # Python < 3.4
+    Asyncio = None
+else:
+    # The tests run the event loop themselves; drivers.run() must not block
+    # on it while other tests wait for replies.
+    drivers._newDrivers[:] = [(name, driver)
+            for (name, driver) in drivers._newDrivers
+            if driver is not Asyncio.poller]
+
+class FakeServer(threading.Thread):
+    """Accepts a single connection, sends it the given data, and keeps it
+    open until the client closes it (unless closeAfterSending is true).
+    What the client sends is kept in the received attribute."""
+    def __init__(self, data, closeAfterSending=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.data = data
+        self.closeAfterSending = closeAfterSending
+        self.received = bytearray()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        (conn, _) = self.sock.accept()
+        self.sock.close()
+        conn.sendall(self.data)
+        if not self.closeAfterSending:
+            try:
+                data = conn.recv(4096)
+                while data:
+                    self.received += data
+                    data = conn.recv(4096)
+            except socket.error:
+                pass
+        conn.close()
+
+class MessageCounter(irclib.IrcCallback):
+    def __init__(self):
+        self.msgs = []
+    def __call__(self, irc, msg):
+        self.msgs.append(msg)
+
+class SlowConnection(object):
+    """Wraps a socket so it accepts only a few bytes per send()."""
+    def __init__(self, conn, size):
+        self.conn = conn
+        self.size = size
+        self.sent = []
+    def fileno(self):
+        return self.conn.fileno()
+    def send(self, data):
+        data = data[:self.size].tobytes()
+        self.sent.append(data)
+        return len(data)
+
+class OutboundCounterTestCase(SupyTestCase):
+    def testRate(self):
+        counter = drivers.OutboundCounter(window=10)
+        counter.add(100, now=1000)
+        counter.add(50, now=1000.5)
+        counter.add(850, now=1005)
+        self.assertEqual(counter.total, 1000)
+        self.assertEqual(counter.rate(now=1005), 100)
+        self.assertEqual(counter.rate(now=1012), 85)
+        self.assertEqual(counter.rate(now=1020), 0)
+        self.assertEqual(counter.total, 1000)
+
+class DriverTestCase(SupyTestCase):
+    driverClass = None
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        network = conf.supybot.networks.test
+        self.originals = [(network.servers, network.servers()),
+                          (network.ssl, network.ssl()),
+                          (conf.supybot.drivers.receiveBufferSize,
+                           conf.supybot.drivers.receiveBufferSize())]
+        network.ssl.setValue(False)
+        self.driver = None
+
+    def tearDown(self):
+        if self.driver is not None:
+            self.killDriver()
+            # Do not let drivers.run() pick up our dead driver.
+            drivers._newDrivers[:] = [(name, driver)
+                    for (name, driver) in drivers._newDrivers
+                    if driver is not self.driver]
+        for (group, value) in self.originals:
+            group.setValue(value)
+        SupyTestCase.tearDown(self)
+
+    def killDriver(self):
+        self.driver._reallyDie()
+
+    def setConf(self, group, value):
+        self.originals.append((group, group()))
+        group.setValue(value)
+
+    def connect(self, data, **kwargs):
+        self.server = FakeServer(data, **kwargs)
+        self.server.start()
+        conf.supybot.networks.test.servers.setValue(
+                ['127.0.0.1:%s' % self.server.port])
+        self.counter = MessageCounter()
+        irc = irclib.Irc('test', callbacks=[self.counter])
+        self.driver = self.driverClass(irc)
+        irc.driver = self.driver
+        return irc
+
+class SocketDriverTestCase(DriverTestCase):
+    driverClass = Socket.SocketDriver
+    def connect(self, data, **kwargs):
+        irc = DriverTestCase.connect(self, data, **kwargs)
+        self.assertTrue(self.driver.connected)
+        return irc
+
+    def readUntil(self, predicate, timeout=10):
+        started = time.time()
+        while not predicate() and time.time() - started < timeout:
+            Socket.SocketDriver._select()
+
+    def testLinesSplitAcrossReads(self):
+        conf.supybot.drivers.receiveBufferSize.setValue(7)
+        data = (b':foo!bar@baz PRIVMSG #chan :hello there\r\n'
+                b':foo!bar@baz PRIVMSG #chan :caf\xc3\xa9\r\n'
+                b':foo!bar@baz PRIVMSG #chan :caf\xe9\r\n'
+                b'PING :12345\r\n')
+        self.connect(data)
+        self.readUntil(lambda: len(self.counter.msgs) >= 4)
+        msgs = self.counter.msgs
+        self.assertEqual(len(msgs), 4)
+        self.assertEqual(msgs[0].args, ('#chan', 'hello there'))
+        if minisix.PY3:
+            self.assertEqual(msgs[1].args, ('#chan', u'caf\xe9'))
+        self.assertEqual(msgs[3].command, 'PING')
+        self.assertEqual(self.driver.inbuffer, b'')
+
+    def testPartialLineIsKept(self):
+        self.connect(b'PING :12345\r\nPING :678')
+        self.readUntil(lambda: self.counter.msgs)
+        self.assertEqual(len(self.counter.msgs), 1)
+        self.assertEqual(self.driver.inbuffer, b'PING :678')
+
+    def testServerClosesConnection(self):
+        self.connect(b'PING :12345\r\n', closeAfterSending=True)
+        self.readUntil(lambda: not self.driver.connected)
+        self.assertFalse(self.driver.connected)
+        self.assertNotEqual(self.driver.nextReconnectTime, None)
+
+    def testPartialSends(self):
+        irc = self.connect(b'')
+        irc.queue.reset()
+        irc.fastqueue.reset()
+        conn = self.driver.conn
+        self.driver.conn = SlowConnection(conn, 7)
+        try:
+            irc.sendMsg(ircmsgs.privmsg('#chan', 'foo'))
+            irc.sendMsg(ircmsgs.privmsg('#chan', 'bar'))
+            self.driver._sendIfMsgs()
+            self.assertEqual(len(self.driver.outbuffer), 1)
+            self.assertEqual(self.driver.outboundDepth(), 40 - 7)
+            while self.driver.outbuffer:
+                self.driver._sendIfMsgs()
+            sent = self.driver.conn.sent
+        finally:
+            self.driver.conn = conn
+        self.assertEqual(b''.join(sent),
+                         b'PRIVMSG #chan :foo\r\nPRIVMSG #chan :bar\r\n')
+        self.assertEqual(len(sent), 6)
+        self.assertEqual(self.driver.outboundDepth(), 0)
+        self.assertEqual(self.driver.outbound.total, 40)
+
+    if benchmark:
+        def testBenchmarkBurst(self):
+            """Replays a burst similar to what the bot receives when joining
+            large channels or during a netsplit."""
+            server = 'irc.example.net'
+            lines = []
+            for i in range(100000):
+                kind = i % 5
+                if kind == 0:
+                    line = ':%s 353 test = #big :@op%d +voice%d user%d ' \
+                           'other%d' % (server, i, i, i, i)
+                elif kind == 1:
+                    line = ':%s 352 test #big ident%d host%d.example.com ' \
+                           '%s nick%d H :0 Real Name' % (server, i, i,
+                                                         server, i)
+                elif kind == 2:
+                    line = ':nick%d!ident@host%d.example.com JOIN #big' % \
+                           (i, i)
+                elif kind == 3:
+                    line = ':nick%d!ident@host%d.example.com PRIVMSG #big ' \
+                           ':some chatter, number %d' % (i, i, i)
+                else:
+                    line = ':nick%d!ident@host%d.example.com QUIT ' \
+                           ':*.net *.split' % (i - 2, i - 2)
+                lines.append(line)
+            data = ('\r\n'.join(lines) + '\r\n').encode()
+            self.connect(data)
+            started = time.time()
+            self.readUntil(lambda: len(self.counter.msgs) >= len(lines),
+                           timeout=600)
+            elapsed = time.time() - started
+            self.assertEqual(len(self.counter.msgs), len(lines))
+            print('')
+            print('Socket driver: %d lines in %.2f seconds (%d lines/s).' %
+                  (len(lines), elapsed, len(lines) / elapsed))
+
+@unittest.skipIf(Asyncio is None, 'Python 3.4 or newer is required.')
+class AsyncioDriverTestCase(DriverTestCase):
+    driverClass = Asyncio and Asyncio.AsyncioDriver
+    def killDriver(self):
+        if not self.driver.zombie:
+            self.driver.die()
+
+    def runUntil(self, predicate, timeout=10):
+        started = time.time()
+        while not predicate() and time.time() - started < timeout:
+            Asyncio.loop.call_later(0.01, Asyncio.loop.stop)
+            Asyncio.loop.run_forever()
+
+    def connect(self, data, **kwargs):
+        irc = DriverTestCase.connect(self, data, **kwargs)
+        self.runUntil(lambda: self.driver.connected)
+        self.assertTrue(self.driver.connected)
+        return irc
+
+    def testConnect(self):
+        self.connect(b'PING :12345\r\n')
+        self.runUntil(lambda: b'PONG' in self.server.received)
+        self.assertEqual(self.counter.msgs[0].command, 'PING')
+        self.assertTrue(b'PONG :12345\r\n' in self.server.received)
+        self.assertEqual(self.driver.outbound.total,
+                         len(self.server.received))
+
+    def testThrottle(self):
+        self.setConf(conf.supybot.protocols.irc.throttleTime, 0.2)
+        self.setConf(conf.supybot.protocols.irc.throttleTime.burst, 1)
+        self.setConf(conf.supybot.protocols.irc.throttleTime.bytesPerToken,
+                     0)
+        irc = self.connect(b'')
+        started = time.time()
+        for i in range(3):
+            irc.queueMsg(ircmsgs.privmsg('#chan', str(i)))
+        self.driver.run()
+        self.assertNotEqual(self.driver.sendHandle, None)
+        self.runUntil(lambda: b'PRIVMSG #chan :2' in self.server.received)
+        self.assertTrue(time.time() - started >= 0.35)
+        received = bytes(self.server.received)
+        self.assertTrue(received.index(b'PRIVMSG #chan :0') <
+                        received.index(b'PRIVMSG #chan :1') <
+                        received.index(b'PRIVMSG #chan :2'))
+
+    def testJoinRateLimit(self):
+        self.setConf(conf.supybot.protocols.irc.throttleTime, 0)
+        self.setConf(conf.supybot.protocols.irc.queuing.rateLimit.join, 0.5)
+        irc = self.connect(b'')
+        calls = []
+        sendIfMsgs = self.driver._sendIfMsgs
+        def countCalls():
+            calls.append(None)
+            sendIfMsgs()
+        self.driver._sendIfMsgs = countCalls
+        irc.queueMsg(ircmsgs.join('#foo'))
+        irc.queueMsg(ircmsgs.join('#bar'))
+        self.driver.run()
+        self.runUntil(lambda: b'#bar' in self.server.received)
+        self.assertTrue(b'#bar' in self.server.received)
+        # Woken up when the second JOIN may be sent, not continuously.
+        self.assertTrue(len(calls) <= 3, '%d wake-ups' % len(calls))
+
+    def testReconnect(self):
+        DriverTestCase.connect(self, b'PING :1\r\n', closeAfterSending=True)
+        self.runUntil(lambda: self.driver.reconnectHandle is not None)
+        self.assertFalse(self.driver.connected)
+        self.server = FakeServer(b'PING :2\r\n')
+        self.server.start()
+        conf.supybot.networks.test.servers.setValue(
+                ['127.0.0.1:%s' % self.server.port])
+        self.driver.reconnect()
+        self.assertEqual(self.driver.reconnectHandle, None)
+        self.runUntil(lambda: b'PONG :2' in self.server.received)
+        self.assertTrue(self.driver.connected)
+        self.assertEqual(self.counter.msgs[-1].args, ('2',))
+
+    def testDie(self):
+        irc = self.connect(b'')
+        irc.sendMsg(ircmsgs.quit('bye'))
+        self.driver.run()
+        self.driver.die()
+        self.assertFalse(self.driver.connected)
+        self.assertEqual(self.driver.transport, None)
+        self.runUntil(lambda: not self.server.is_alive())
+        self.assertFalse(self.server.is_alive())
+        self.assertTrue(self.server.received.endswith(b'QUIT :bye\r\n'))
+        self.assertEqual(self.driver.reconnectHandle, None)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -347,6 +347,49 @@ class IrcChannelTestCase(IrcdbTestCase):
         c.removeBan(banmask)
         self.failIf(c.checkIgnored(prefix))
 
+    def testExpiredIgnores(self):
+        prefix = 'foo!bar@baz'
+        c = ircdb.IrcChannel()
+        c.addIgnore('*!*@baz', time.time() - 1)
+        c.addBan('foo!*@*', time.time() - 1)
+        c.addIgnore('*!bar@*', time.time() + 1000)
+        self.failUnless(c.checkIgnored(prefix))
+        self.assertEqual(list(c.ignores), ['*!bar@*'])
+        self.assertEqual(c.bans, {})
+        self.assertEqual([ban for (ban, _) in c.expiredBans], ['foo!*@*'])
+
+class ExpiringHostmaskDictTestCase(SupyTestCase):
+    def testCheck(self):
+        d = ircdb.ExpiringHostmaskDict({'*!*@*.example.com': 0})
+        d['nick!*@*'] = 0
+        d['*!*@*'] = 0
+        self.failUnless(d.check('foo!bar@baz.example.com'))
+        self.failUnless(d.check('NICK!bar@baz'))
+        del d['*!*@*']
+        self.failIf(d.check('foo!bar@baz'))
+        self.assertEqual(d.pop('nick!*@*'), 0)
+        self.failIf(d.check('nick!bar@baz'))
+        self.assertRaises(KeyError, d.pop, 'nick!*@*')
+        d.clear()
+        self.failIf(d.check('foo!bar@baz.example.com'))
+
+    def testExpire(self):
+        d = ircdb.ExpiringHostmaskDict()
+        d['a!*@*'] = 10
+        d['b!*@*'] = 20
+        d['c!*@*'] = 0
+        d['a!*@*'] = 30
+        self.assertEqual(d.expire(now=15), [])
+        self.assertEqual(d.expire(now=25), [('b!*@*', 20)])
+        self.failIf(d.check('b!x@y'))
+        self.assertEqual(d.expire(now=1000), [('a!*@*', 30)])
+        self.assertEqual(list(d), ['c!*@*'])
+        for i in range(100):
+            d['c!*@*'] = 2000 + i
+        self.assertTrue(len(d.expirations) < 100)
+        self.assertEqual(d.expire(now=2050), [])
+        self.assertEqual(d.expire(now=3000), [('c!*@*', 2099)])
+
 class UsersDictionaryTestCase(IrcdbTestCase):
     filename = os.path.join(conf.supybot.directories.conf(),
                             'UsersDictionaryTestCase.conf')
@@ -400,6 +443,83 @@ class UsersDictionaryTestCase(IrcdbTestCase):
         u2.addHostmask('*!xyzzy@baz.domain.c?m')
         self.assertRaises(ValueError, self.users.setUser, u2)
 
+    def testHostmaskIndex(self):
+        u = self.users.newUser()
+        u.name = 'foo'
+        u.addHostmask('*!*@*.Example.COM')
+        self.users.setUser(u)
+        self.assertEqual(self.users.getUserId('bar!baz@host.example.com'), 1)
+        self.assertRaises(KeyError, self.users.getUserId,
+                          'bar!baz@host.example.org')
+        # Hostmasks added without setUser are still taken into account.
+        u.addHostmask('qu[x]!*@*')
+        self.assertEqual(self.users.getUserId('QU{X}!baz@host.example.org'),
+                         1)
+        u.removeHostmask('qu[x]!*@*')
+        self.users.invalidateCache(1)
+        self.assertRaises(KeyError, self.users.getUserId,
+                          'qux!baz@host.example.org')
+        u.addAuth('qux!baz@host.example.org')
+        self.assertEqual(self.users.getUserId('qux!baz@host.example.org'), 1)
+        u.clearAuth()
+        self.users.invalidateCache(1)
+        self.assertRaises(KeyError, self.users.getUserId,
+                          'qux!baz@host.example.org')
+
+    def testGetUserFromNick(self):
+        u = self.users.newUser()
+        u.name = 'foo'
+        u.nicks['test'] = ['Foo[bar]']
+        self.users.setUser(u)
+        self.assertEqual(self.users.getUserFromNick('test', 'foo{bar}'), u)
+        self.assertEqual(self.users.getUserFromNick('other', 'foo[bar]'),
+                         None)
+        u.nicks['test'] = ['baz']
+        self.users.setUser(u)
+        self.assertEqual(self.users.getUserFromNick('test', 'foo[bar]'), None)
+        self.assertEqual(self.users.getUserFromNick('test', 'BAZ'), u)
+        self.users.delUser(u.id)
+        self.assertEqual(self.users.getUserFromNick('test', 'baz'), None)
+
+class HostmaskIndexTestCase(SupyTestCase):
+    patterns = ['*!*@*', '*!*@*.example.com', '*!*@host.example.com',
+                'nick!*@*', 'ni?k!*@*', 'n*!*@*', '*!user@*', '*!*@1.2.3.*',
+                '*!*@unaffiliated/nick', '*!*@2001:db8::*', 'NICK!*@*.COM',
+                '*!*@*example.com', '[]!*@*', '*!*@h\xe9te', 'nick!user@host',
+                '*!*@ho?t.example.com', '*!*@*.example.c*']
+    hostmasks = ['nick!user@host.example.com', 'NiCk!user@host',
+                 'nick2!~user@1.2.3.4', 'other!u@unaffiliated/nick',
+                 'other!u@2001:db8::1', 'other!u@EXAMPLE.COM',
+                 '{}!x@y', 'x!y@h\xe9te', 'x!y@H\xc9TE', 'x!y@aexample.com',
+                 'n!y@example.coma', 'nick!user@hoxt.example.com']
+
+    def testCandidates(self):
+        index = ircdb.HostmaskIndex()
+        for (i, pattern) in enumerate(self.patterns):
+            index.add(pattern, i)
+        for hostmask in self.hostmasks:
+            expected = set(i for (i, pattern) in enumerate(self.patterns)
+                           if ircutils.hostmaskPatternEqual(pattern, hostmask))
+            self.assertTrue(expected <= index.candidates(hostmask),
+                            hostmask)
+            matches = set()
+            for (_, values) in index.matches(hostmask):
+                matches.update(values)
+            self.assertEqual(matches, expected, hostmask)
+        self.assertEqual(index.candidates('nobody!u@elsewhere.org'),
+                         set([0, 5, 6, 13, 16]))
+
+    def testRemove(self):
+        index = ircdb.HostmaskIndex()
+        index.add('*!*@*.example.com', 1)
+        index.add('*!*@*.example.com', 2)
+        index.remove('*!*@*.example.com', 1)
+        self.assertEqual(index.candidates('a!b@c.example.com'), set([2]))
+        index.remove('*!*@*.example.com', 2)
+        self.assertEqual(index.candidates('a!b@c.example.com'), set())
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.suffixes, {})
+
 
 class CheckCapabilityTestCase(IrcdbTestCase):
     filename = os.path.join(conf.supybot.directories.conf(),
@@ -562,6 +682,69 @@ class CheckCapabilityTestCase(IrcdbTestCase):
         finally:
             conf.supybot.capabilities.default.set(str(originalConfDefaultAllow))
 
+class CapabilityCacheTestCase(IrcdbTestCase):
+    prefix = 'cached!cached@cached'
+    def setUp(self):
+        IrcdbTestCase.setUp(self)
+        self.user = ircdb.users.newUser()
+        self.user.name = 'cached'
+        self.user.addHostmask(self.prefix)
+        ircdb.users.setUser(self.user)
+
+    def tearDown(self):
+        ircdb.users.delUser(self.user.id)
+        IrcdbTestCase.tearDown(self)
+
+    def testHitsAndInvalidation(self):
+        cache = ircdb.capabilityCache
+        conf.supybot.capabilities() # May be lazily reloaded from the registry
+        (hits, misses) = (cache.hits, cache.misses)
+        self.failIf(ircdb.checkCapability(self.prefix, 'admin'))
+        self.failIf(ircdb.checkCapability(self.prefix, 'admin'))
+        self.assertEqual((cache.hits, cache.misses), (hits + 1, misses + 1))
+        self.user.addCapability('admin')
+        self.failUnless(ircdb.checkCapability(self.prefix, 'admin'))
+        self.user.removeCapability('admin')
+        self.failIf(ircdb.checkCapability(self.prefix, 'admin'))
+        self.failUnless(ircdb.checkCapability(self.prefix, 'foo'))
+        original = conf.supybot.capabilities()
+        try:
+            conf.supybot.capabilities.setValue(['-foo'])
+            self.failIf(ircdb.checkCapability(self.prefix, 'foo'))
+        finally:
+            conf.supybot.capabilities.setValue(original)
+        self.failUnless(ircdb.checkCapability(self.prefix, 'foo'))
+        channel = ircdb.channels.getChannel('#cachetest')
+        self.failUnless(ircdb.checkCapability(self.prefix, '#cachetest,foo'))
+        channel.setDefaultCapability(False)
+        try:
+            self.failIf(ircdb.checkCapability(self.prefix, '#cachetest,foo'))
+        finally:
+            channel.setDefaultCapability(True)
+
+    def testAuthTimeout(self):
+        authmask = 'other!other@elsewhere'
+        self.user.addCapability('owner')
+        orig = conf.supybot.databases.users.timeoutIdentification()
+        try:
+            conf.supybot.databases.users.timeoutIdentification.setValue(1)
+            self.user.addAuth(authmask)
+            self.failUnless(ircdb.checkCapability(authmask, 'owner'))
+            self.failUnless(ircdb.checkCapability(authmask, 'owner'))
+            time.sleep(1.1)
+            self.failIf(ircdb.checkCapability(authmask, 'owner'))
+            self.assertRaises(KeyError, ircdb.users.getUser, authmask)
+            self.assertEqual(self.user.auth, [])
+        finally:
+            conf.supybot.databases.users.timeoutIdentification.setValue(orig)
+
+    def testStaleDecisionsAreNotStored(self):
+        cache = ircdb.capabilityCache
+        generation = cache.generation
+        cache.invalidate()
+        cache.set('key', generation, True)
+        self.assertRaises(KeyError, cache.get, 'key')
+
 class PersistanceTestCase(IrcdbTestCase):
     filename = os.path.join(conf.supybot.directories.conf(),
                             'PersistanceTestCase.conf')
@@ -611,6 +794,82 @@ class PersistanceTestCase(IrcdbTestCase):
         db2.open(self.filename)
         self.assertEqual(list(db.users), [])
 
+    def testJournal(self):
+        journalName = self.filename + '.journal'
+        db = ircdb.UsersDictionary()
+        db.filename = self.filename
+        u = db.newUser()
+        u.name = 'foouser'
+        u.addHostmask('*!fooident@foohost')
+        db.setUser(u)
+        self.assertFalse(os.path.exists(journalName))
+        u.addCapability('foocapa')
+        u.removeHostmask('*!fooident@foohost')
+        db.setUser(u)
+        u = db.newUser()
+        u.name = 'baruser'
+        u.addHostmask('*!fooident@foohost')
+        db.setUser(u)
+        self.assertTrue(os.path.exists(journalName))
+        self.assertFalse('foocapa' in utils.file.contents(self.filename))
+
+        db2 = ircdb.UsersDictionary()
+        db2.open(self.filename)
+        self.assertEqual(sorted(db2.users), [1, 2])
+        self.assertTrue(db2.users[1].capabilities.check('foocapa'))
+        self.assertEqual(db2.getUserId('foo!fooident@foohost'), 2)
+        # Opening the database compacted it.
+        self.assertFalse(os.path.exists(journalName))
+        self.assertTrue('foocapa' in utils.file.contents(self.filename))
+
+        db.delUser(1)
+        db2 = ircdb.UsersDictionary()
+        db2.open(self.filename)
+        self.assertEqual(list(db2.users), [2])
+
+    def testNoJournal(self):
+        journalName = self.filename + '.journal'
+        with conf.supybot.databases.journalSize.context(0):
+            db = ircdb.UsersDictionary()
+            db.filename = self.filename
+            u = db.newUser()
+            u.name = 'foouser'
+            db.setUser(u)
+            u.addCapability('foocapa')
+            db.setUser(u)
+            self.assertFalse(os.path.exists(journalName))
+            self.assertTrue('foocapa' in utils.file.contents(self.filename))
+
+    def testChannelsAndIgnoresJournal(self):
+        filename = self.filename + '.channels'
+        db = ircdb.ChannelsDictionary()
+        db.filename = filename
+        c = db.getChannel('#foo')
+        c.addBan('*!*@foo', 0)
+        db.setChannel('#foo', c)
+        c.addBan('*!*@bar', 0)
+        db.setChannel('#foo', c)
+        db.setChannel('#bar', ircdb.IrcChannel(lobotomized=True))
+        db.delChannel('#bar')
+        db2 = ircdb.ChannelsDictionary()
+        db2.open(filename)
+        self.assertEqual(list(db2.channels), ['#foo'])
+        self.assertEqual(sorted(db2.getChannel('#foo').bans),
+                         ['*!*@bar', '*!*@foo'])
+
+        filename = self.filename + '.ignores'
+        open(filename, 'w').close()
+        db = ircdb.IgnoresDB()
+        db.open(filename)
+        db.add('*!*@foo')
+        db.add('*!*@bar', time.time() + 1000)
+        db.flush()
+        db.remove('*!*@foo')
+        db.flush()
+        db2 = ircdb.IgnoresDB()
+        db2.open(filename)
+        self.assertEqual(list(db2.hostmasks), ['*!*@bar'])
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
 
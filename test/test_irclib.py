@@ -152,6 +152,127 @@ class IrcMsgQueueTestCase(SupyTestCase):
         finally:
             configVar.setValue(original)
 
+    def testFairness(self):
+        q = irclib.IrcMsgQueue()
+        flood = [ircmsgs.privmsg('#flood', str(i)) for i in range(5)]
+        for msg in flood:
+            q.enqueue(msg)
+        q.enqueue(self.msg)
+        q.enqueue(self.notice)
+        self.assertEqual(flood[0], q.dequeue())
+        self.assertEqual(self.msg, q.dequeue())
+        self.assertEqual(self.notice, q.dequeue())
+        q.enqueue(self.msgs[0])
+        self.assertEqual(flood[1], q.dequeue())
+        self.assertEqual(self.msgs[0], q.dequeue())
+        for msg in flood[2:]:
+            self.assertEqual(msg, q.dequeue())
+        self.failIf(q)
+
+    def testTargetCase(self):
+        q = irclib.IrcMsgQueue()
+        msgs = [ircmsgs.privmsg('#Foo', '1'), ircmsgs.privmsg('#foo', '2')]
+        other = ircmsgs.privmsg('#bar', '3')
+        for msg in msgs + [other]:
+            q.enqueue(msg)
+        self.assertEqual(msgs[0], q.dequeue())
+        self.assertEqual(other, q.dequeue())
+        self.assertEqual(msgs[1], q.dequeue())
+        queuing = conf.supybot.protocols.irc.queuing
+        originals = (queuing.maxPerTarget(), queuing.overflow())
+        try:
+            queuing.maxPerTarget.setValue(1)
+            queuing.overflow.setValue('drop')
+            q.enqueue(ircmsgs.privmsg('#a[', '1'))
+            self.failIf(q.enqueue(ircmsgs.privmsg('#A{', '2')))
+            state = irclib.IrcState()
+            state.casemapping = 'ascii'
+            q = irclib.IrcMsgQueue(state=state)
+            q.enqueue(ircmsgs.privmsg('#a[', '1'))
+            self.failUnless(q.enqueue(ircmsgs.privmsg('#A{', '2')))
+            self.failIf(q.enqueue(ircmsgs.privmsg('#A[', '3')))
+        finally:
+            queuing.maxPerTarget.setValue(originals[0])
+            queuing.overflow.setValue(originals[1])
+
+    def testBytesFairness(self):
+        configVar = conf.supybot.protocols.irc.queuing.fairness
+        original = configVar()
+        try:
+            configVar.setValue('bytes')
+            q = irclib.IrcMsgQueue()
+            longMsgs = [ircmsgs.privmsg('#long', 'x' * 100)] * 2
+            short = [ircmsgs.privmsg('#short', str(i)) for i in range(3)]
+            for msg in longMsgs + short:
+                q.enqueue(msg)
+            self.assertEqual(short[0], q.dequeue())
+            self.assertEqual(short[1], q.dequeue())
+            self.assertEqual(short[2], q.dequeue())
+            self.assertEqual(longMsgs[0], q.dequeue())
+            self.assertEqual(longMsgs[1], q.dequeue())
+        finally:
+            configVar.setValue(original)
+
+    def _testOverflow(self, overflow):
+        queuing = conf.supybot.protocols.irc.queuing
+        originals = (queuing.maxPerTarget(), queuing.overflow())
+        try:
+            queuing.maxPerTarget.setValue(2)
+            queuing.overflow.setValue(overflow)
+            q = irclib.IrcMsgQueue()
+            for msg in self.msgs[:4]:
+                q.enqueue(msg)
+            q.enqueue(self.notice)
+            return q
+        finally:
+            queuing.maxPerTarget.setValue(originals[0])
+            queuing.overflow.setValue(originals[1])
+
+    def testOverflowDrop(self):
+        q = self._testOverflow('drop')
+        self.assertEqual(len(q), 3)
+        self.assertEqual(self.msgs[0], q.dequeue())
+        self.assertEqual(self.notice, q.dequeue())
+        self.assertEqual(self.msgs[1], q.dequeue())
+        self.failIf(self.msgs[2] in q)
+
+    def testOverflowDropOldest(self):
+        q = self._testOverflow('dropOldest')
+        self.assertEqual(len(q), 3)
+        self.failIf(self.msgs[0] in q)
+        self.assertEqual(self.notice, q.dequeue())
+        self.assertEqual(self.msgs[2], q.dequeue())
+        self.assertEqual(self.msgs[3], q.dequeue())
+        self.failIf(q)
+
+    def testOverflowMerge(self):
+        q = self._testOverflow('merge')
+        self.assertEqual(len(q), 3)
+        self.assertEqual(self.msgs[0], q.dequeue())
+        self.assertEqual(self.notice, q.dequeue())
+        merged = ircmsgs.privmsg('#foo', '1  2  3')
+        self.failUnless(merged in q)
+        self.assertEqual(merged, q.dequeue())
+        self.failIf(q)
+
+    def testJoinRateLimit(self):
+        configVar = conf.supybot.protocols.irc.queuing.rateLimit.join
+        original = configVar()
+        try:
+            configVar.setValue(60)
+            q = irclib.IrcMsgQueue()
+            q.enqueue(self.join)
+            q.enqueue(ircmsgs.join('#bar'))
+            self.assertEqual(q.delay(), 0)
+            self.assertEqual(self.join, q.dequeue())
+            self.assertEqual(None, q.dequeue())
+            self.assertEqual(len(q), 1)
+            self.failUnless(ircmsgs.join('#bar') in q)
+            self.failUnless(59 < q.delay() <= 60)
+            self.assertEqual(q.delay(now=q.lastJoin + 60), 0)
+        finally:
+            configVar.setValue(original)
+
     def testJoinBeforeWho(self):
         q = irclib.IrcMsgQueue()
         q.enqueue(self.join)
@@ -182,6 +303,68 @@ class IrcMsgQueueTestCase(SupyTestCase):
         self.assertEqual(self.msg, q.dequeue())
 
 
+class TokenBucketTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        throttleTime = conf.supybot.protocols.irc.throttleTime
+        self.originals = [(throttleTime, throttleTime()),
+                          (throttleTime.burst, throttleTime.burst()),
+                          (throttleTime.bytesPerToken,
+                           throttleTime.bytesPerToken())]
+        throttleTime.setValue(2.0)
+        throttleTime.burst.setValue(3)
+        self.msg = ircmsgs.privmsg('#foo', 'bar')
+
+    def tearDown(self):
+        for (group, value) in self.originals:
+            group.setValue(value)
+        SupyTestCase.tearDown(self)
+
+    def testBurst(self):
+        bucket = irclib.TokenBucket()
+        now = bucket.lastRefill
+        for i in range(3):
+            self.assertEqual(bucket.delay(now), 0)
+            bucket.take(self.msg, now)
+        self.assertEqual(bucket.delay(now), 2)
+        self.assertEqual(bucket.delay(now + 1), 1)
+        self.assertEqual(bucket.delay(now + 2), 0)
+        self.assertEqual(bucket.expectedDelay(5, now + 10), 4)
+        self.assertEqual(bucket.sent, 3)
+
+    def testBytesPerToken(self):
+        conf.supybot.protocols.irc.throttleTime.bytesPerToken.setValue(10)
+        bucket = irclib.TokenBucket()
+        now = bucket.lastRefill
+        msg = ircmsgs.privmsg('#foo', 'barbaz')
+        self.assertEqual(len(msg), 22)
+        self.assertEqual(bucket.cost(msg), 3)
+        bucket.take(msg, now)
+        bucket.take(msg, now)
+        self.assertEqual(bucket.delay(now), 8)
+
+    def testNoThrottle(self):
+        conf.supybot.protocols.irc.throttleTime.setValue(0)
+        bucket = irclib.TokenBucket()
+        now = bucket.lastRefill
+        for i in range(10):
+            self.assertEqual(bucket.delay(now), 0)
+            bucket.take(self.msg, now)
+
+    def testIrcSendsBursts(self):
+        irc = irclib.Irc('test')
+        irc.reset()
+        irc.queue.reset()
+        irc.fastqueue.reset()
+        for i in range(5):
+            irc.queueMsg(ircmsgs.privmsg('#foo', str(i)))
+        self.assertNotEqual(irc.takeMsg(), None)
+        self.assertNotEqual(irc.takeMsg(), None)
+        self.assertNotEqual(irc.takeMsg(), None)
+        self.assertEqual(irc.takeMsg(), None)
+        self.assertEqual(len(irc.queue), 2)
+
+
 class ChannelStateTestCase(SupyTestCase):
     def testPickleCopy(self):
         c = irclib.ChannelState()
@@ -224,6 +407,94 @@ class ChannelStateTestCase(SupyTestCase):
         self.failIf('quuz' in c.halfops)
         self.failIf('quuz' in c.voices)
 
+    def testMembers(self):
+        c = irclib.ChannelState()
+        c.addUser('@+Foo[]')
+        c.addUser('bar')
+        self.failUnless('foo{}' in c.users)
+        self.failUnless(c.isOp('FOO[]'))
+        self.failUnless(c.isVoice('foo{}'))
+        self.failUnless(c.isHalfopPlus('foo[]'))
+        self.failIf(c.isHalfop('foo[]'))
+        self.failIf(c.isVoicePlus('bar'))
+        self.assertEqual(sorted(c.users), ['Foo[]', 'bar'])
+        self.assertEqual(list(c.ops), ['Foo[]'])
+        self.assertEqual(len(c.users), 2)
+        self.assertEqual(len(c.voices), 1)
+        self.assertEqual(len(c.halfops), 0)
+        c.voices.discard('foo[]')
+        self.failIf(c.isVoice('Foo[]'))
+        self.failUnless(c.isOp('Foo[]'))
+        c.ops.add('baz')
+        self.failUnless(c.isOp('baz'))
+        self.failIf('baz' in c.users)
+        self.assertEqual(len(c.users), 2)
+        self.assertRaises(KeyError, c.halfops.remove, 'bar')
+        c.replaceUser('foo[]', 'Qux')
+        self.assertEqual(sorted(c.users), ['Qux', 'bar'])
+        self.failUnless(c.isOp('qux'))
+        self.failIf('foo[]' in c.users)
+        c.removeUser('QUX')
+        self.assertEqual(list(c.users), ['bar'])
+        self.assertEqual(list(c.ops), ['baz'])
+        self.failIf(c.isOp('qux'))
+        # Nicks are interned, and shared by the channels they are in.
+        c2 = irclib.ChannelState()
+        c2.addUser(ircutils.IrcString('ba' + 'r'))
+        self.failUnless(list(c.users)[0] is list(c2.users)[0])
+        self.assertEqual(type(list(c2.users)[0]), str)
+
+    if benchmark:
+        def testBenchmarkUsers(self):
+            nicks = ['Nick%d[away]' % i for i in range(10000)]
+            c = irclib.ChannelState()
+            started = time.time()
+            for nick in nicks:
+                c.addUser('@' + nick)
+            for nick in nicks:
+                nick = nick.lower()
+                (nick in c.users, c.isOp(nick), c.isVoicePlus(nick))
+            for nick in nicks:
+                c.replaceUser(nick, nick + '_')
+            for nick in nicks:
+                c.removeUser(nick + '_')
+            print('')
+            print('ChannelState: %d users added, checked, renamed and '
+                  'removed in %.2f seconds.' %
+                  (len(nicks), time.time() - started))
+
+        def testBenchmarkMemory(self):
+            try:
+                import tracemalloc
+            except ImportError: # Python < 3.4
+                return
+            nicks = ['Nick%d[away]' % i for i in range(10000)]
+            def measure(f):
+                tracemalloc.start()
+                try:
+                    channels = [f(i) for i in range(10)]
+                    return tracemalloc.get_traced_memory()[0]
+                finally:
+                    tracemalloc.stop()
+            def channelState(i):
+                c = irclib.ChannelState()
+                for (j, nick) in enumerate(nicks):
+                    c.addUser(('@' if j % 50 == i else '') + nick)
+                return c
+            def ircSets(i):
+                (users, ops) = (ircutils.IrcSet(), ircutils.IrcSet())
+                sets = (ops, ircutils.IrcSet(), ircutils.IrcSet())
+                for (j, nick) in enumerate(nicks):
+                    nick = ircutils.IrcString(nick)
+                    if j % 50 == i:
+                        ops.add(nick)
+                    users.add(nick)
+                return (users, sets)
+            print('')
+            print('10 channels of %d users: %d KiB with ChannelState, '
+                  '%d KiB with IrcSets.' % (len(nicks),
+                  measure(channelState) // 1024, measure(ircSets) // 1024))
+
 
 class IrcStateTestCase(SupyTestCase):
     class FakeIrc:
@@ -286,6 +557,18 @@ class IrcStateTestCase(SupyTestCase):
         state.addMsg(self.irc, ircmsgs.IrcMsg(':irc.inet.tele.dk 005 adkwbot WALLCHOPS KNOCK EXCEPTS INVEX MODES=4 MAXCHANNELS=20 MAXBANS=beI:100 MAXTARGETS=4 NICKLEN=9 TOPICLEN=120 KICKLEN=90 :are supported by this server'))
         self.assertEqual(state.supported['maxbans'], 100)
 
+    def testCasemapping005(self):
+        state = irclib.IrcState()
+        self.assertEqual(state.casemapping, 'rfc1459')
+        state.addMsg(self.irc, ircmsgs.IrcMsg(':irc.example.net 005 nick CASEMAPPING=ascii CHANTYPES=# :are supported by this server'))
+        self.assertEqual(state.casemapping, 'ascii')
+        self.assertEqual(state.copy().casemapping, 'ascii')
+        state.reset()
+        self.assertEqual(state.casemapping, 'rfc1459')
+        state.addMsg(self.irc, ircmsgs.IrcMsg(':irc.example.net 005 nick CASEMAPPING=ascii :are supported by this server'))
+        state.addMsg(self.irc, ircmsgs.IrcMsg(':irc.example.net 005 nick CASEMAPPING=rfc7613 :are supported by this server'))
+        self.assertEqual(state.casemapping, 'rfc1459')
+
     def testSupportedUmodes(self):
         state = irclib.IrcState()
         state.addMsg(self.irc, ircmsgs.IrcMsg(':coulomb.oftc.net 004 testnick coulomb.oftc.net hybrid-7.2.2+oftc1.6.8 CDGPRSabcdfgiklnorsuwxyz biklmnopstveI bkloveI'))
@@ -324,6 +607,50 @@ class IrcStateTestCase(SupyTestCase):
         state.channels['#foo'] = None
         self.failIf('#foo' in stateCopy.channels)
 
+    def testCopyIsCopyOnWrite(self):
+        st = irclib.IrcState()
+        for channel in ('#foo', '#bar'):
+            st.addMsg(self.irc, ircmsgs.join(channel, prefix=self.irc.prefix))
+            st.addMsg(self.irc, ircmsgs.join(channel, prefix='foo!bar@baz'))
+        st2 = st.copy()
+        self.failUnless(st.channels['#foo'] is st2.channels['#foo'])
+        st.addMsg(self.irc, ircmsgs.join('#foo', prefix='baz!bar@baz'))
+        st.addMsg(self.irc, ircmsgs.topic('#foo', 'new topic',
+                                          prefix='baz!bar@baz'))
+        self.failIf(st.channels['#foo'] is st2.channels['#foo'])
+        self.failUnless(st.channels['#bar'] is st2.channels['#bar'])
+        self.failUnless('baz' in st.channels['#foo'].users)
+        self.failIf('baz' in st2.channels['#foo'].users)
+        self.assertEqual(st.channels['#foo'].topic, 'new topic')
+        self.assertEqual(st2.channels['#foo'].topic, '')
+        self.assertEqual(len(st2.history), 4)
+        # Changes to the copy don't affect the original either.
+        st2.addMsg(self.irc, ircmsgs.part('#bar', prefix='foo!bar@baz'))
+        self.failIf('foo' in st2.channels['#bar'].users)
+        self.failUnless('foo' in st.channels['#bar'].users)
+        st2.addMsg(self.irc, ircmsgs.part('#foo', prefix=self.irc.prefix))
+        self.failIf('#foo' in st2.channels)
+        self.failUnless('#foo' in st.channels)
+
+    if benchmark:
+        def testBenchmarkCopy(self):
+            st = irclib.IrcState()
+            for i in range(100):
+                channel = '#chan%d' % i
+                st.addMsg(self.irc, ircmsgs.join(channel,
+                                                 prefix=self.irc.prefix))
+                st.addMsg(self.irc, ircmsgs.IrcMsg(command='353',
+                    args=(self.irc.nick, '=', channel,
+                          ' '.join('nick%d' % j for j in range(1000)))))
+            started = time.time()
+            for i in range(100):
+                st.copy()
+                st.addMsg(self.irc, ircmsgs.join('#chan%d' % i,
+                                                 prefix='foo!bar@baz'))
+            print('')
+            print('IrcState: 100 copies of a state with 100 channels of '
+                  '1000 users in %.2f seconds.' % (time.time() - started))
+
     def testJoin(self):
         st = irclib.IrcState()
         st.addMsg(self.irc, ircmsgs.join('#foo', prefix=self.irc.prefix))
@@ -466,6 +793,35 @@ class IrcTestCase(SupyTestCase):
         self.irc.feedMsg(msg2)
         self.assertEqual(list(self.irc.state.history), [msg1, msg2])
 
+    def testDispatchTable(self):
+        calls = []
+        class Privmsgs(irclib.IrcCallback):
+            def doPrivmsg(self, irc, msg):
+                calls.append(('Privmsgs', msg.command))
+        class Everything(irclib.IrcCallback):
+            def __call__(self, irc, msg):
+                calls.append(('Everything', msg.command))
+        class Filter(irclib.IrcCallback):
+            def inFilter(self, irc, msg):
+                calls.append(('Filter', msg.command))
+                return msg
+        irc = irclib.Irc('test', callbacks=[])
+        for cb in (Privmsgs(), Everything(), Filter()):
+            irc.addCallback(cb)
+        irc.feedMsg(ircmsgs.privmsg('#foo', 'bar'))
+        self.assertEqual(calls[0], ('Filter', 'PRIVMSG'))
+        self.assertEqual(set(calls[1:]), set([('Privmsgs', 'PRIVMSG'),
+                                              ('Everything', 'PRIVMSG')]))
+        calls[:] = []
+        irc.feedMsg(ircmsgs.notice('#foo', 'bar'))
+        self.assertEqual(calls, [('Filter', 'NOTICE'),
+                                 ('Everything', 'NOTICE')])
+        calls[:] = []
+        irc.removeCallback('Everything')
+        irc.feedMsg(ircmsgs.notice('#foo', 'bar'))
+        self.assertEqual(calls, [('Filter', 'NOTICE')])
+        irc._reallyDie()
+
     def testQuit(self):
         self.irc.reset()
         self.irc.feedMsg(ircmsgs.IrcMsg(':someuser JOIN #foo'))
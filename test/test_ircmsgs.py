@@ -157,6 +157,45 @@ class IrcMsgTestCase(SupyTestCase):
                              ':Angel!angel@example.org PRIVMSG Wiz :Hello')
         self.assertEqual(msg.time, 1319042451.62)
 
+        self.assertRaises(ircmsgs.MalformedIrcMsg, ircmsgs.IrcMsg,
+                          '@time=2011-10-19 :Angel!angel@example.org '
+                          'PRIVMSG Wiz :Hello')
+        self.assertRaises(ircmsgs.MalformedIrcMsg, ircmsgs.IrcMsg,
+                          '@aaa=b;time=2011-13-19T16:40:51.620Z '
+                          ':Angel!angel@example.org PRIVMSG Wiz :Hello')
+
+        before = time.time()
+        msg = ircmsgs.IrcMsg('@aaa=btime=2011-10-19 :Angel!angel@example.org '
+                             'PRIVMSG Wiz :Hello')
+        after = time.time()
+        self.assertTrue(before <= msg.time <= after)
+
+    def testParseTimeTag(self):
+        for (s, timestamp) in [('2011-10-19T16:40:51.620Z', 1319042451.62),
+                               ('2011-10-19T16:40:51Z', 1319042451.0),
+                               ('1970-01-01T00:00:00.000001Z', 0.000001),
+                               ('2020-02-29T23:59:59.999999999Z',
+                                1583020799.999999)]:
+            self.assertEqual(ircmsgs.parse_time_tag(s), timestamp)
+        for s in ['', '2011-10-19', '2011-10-19T16:40:51.620',
+                  '2011-10-19 16:40:51.620Z', '2011-10-19T16:40:51,620Z']:
+            self.assertRaises(ValueError, ircmsgs.parse_time_tag, s)
+
+    def testLazyParsing(self):
+        m = ircmsgs.IrcMsg('@aaa=b;time=2011-10-19T16:40:51.620Z '
+                           ':nick!ident@host.com PRIVMSG #chan :Hi there')
+        self.assertEqual(m.command, 'PRIVMSG')
+        self.assertEqual(m.args, ('#chan', 'Hi there'))
+        self.assertEqual((m.nick, m.user, m.host),
+                         ('nick', 'ident', 'host.com'))
+        self.assertEqual(m.server_tags['aaa'], 'b')
+        self.assertEqual(m.time, 1319042451.62)
+        m.args = ('#other', 'text')
+        self.assertEqual(m.args, ('#other', 'text'))
+        m = ircmsgs.IrcMsg(':irc.example.net 001 nick')
+        self.assertEqual((m.nick, m.user, m.host), ('irc.example.net',)*3)
+        self.assertEqual(m.args, ('nick',))
+
 class FunctionsTestCase(SupyTestCase):
     def testIsAction(self):
         L = [':jemfinch!~jfincher@ts26-2.homenet.ohio-state.edu PRIVMSG'
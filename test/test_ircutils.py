@@ -58,6 +58,58 @@ class FunctionsTestCase(SupyTestCase):
             'abr-ubr1.sbo-abr.ma.cable.rcn.com'
         self.failUnless(ircutils.hostmaskPatternEqual(s, s))
 
+    hostmaskPatterns = ['*!*@*', '*!*@*.example.com', '*!*@Host.Example.COM',
+                        'nick!*@*', 'ni?k!*@*', 'n*!*@*', '*!user@*',
+                        '*!*@1.2.3.*', 'NICK!*@*.COM', 'foo[]!*@*', '*',
+                        'nick!user@host.example.com', '*!*@h\xe9te',
+                        '*ck!*us*@*.com', 'nick!~user@*', '*a*a*']
+    hostmasks = ['nick!user@host.example.com', 'NiCk!user@host',
+                 'nick2!~user@1.2.3.4', 'FOO{}!bar@baz', 'n!u@h\xc9te',
+                 'nick!us\xe9r@host.example.com', 'aa!a@a', 'a!b@c']
+    def testHostmaskPattern(self):
+        kinds = [ircutils.HostmaskPattern(pattern).kind
+                 for pattern in ['*!*@host', '*@host', 'nick!user@host',
+                                 'nick!*']]
+        self.assertEqual(kinds, ['segments', 'suffix', 'exact', 'prefix'])
+        self.assertEqual(ircutils.HostmaskPattern('ni?k!*@*').kind,
+                         'generic')
+        for pattern in self.hostmaskPatterns:
+            compiled = ircutils.HostmaskPattern(pattern)
+            regexp = compiled._compile()
+            for hostmask in self.hostmasks:
+                self.assertEqual(compiled.match(hostmask),
+                                 regexp(hostmask) is not None,
+                                 '%r and %r' % (pattern, hostmask))
+        self.failUnless(ircutils.hostmaskPatternEqual('*!*@*.example.com',
+                                                      'a!b@C.EXAMPLE.COM'))
+        self.failIf(ircutils.hostmaskPatternEqual('*!*@*.example.com',
+                                                  'a!b@example.com'))
+        self.failUnless(ircutils.hostmaskPatternEqual('*ck!*us*@*.com',
+                                                      'nick!user@host.com'))
+        self.failIf(ircutils.hostmaskPatternEqual('*a*a*', 'xa'))
+
+    if benchmark:
+        def testBenchmarkHostmaskPattern(self):
+            hostmasks = ['nick%d!~user%d@host%d.example.com' % (i, i, i)
+                         for i in range(10000)]
+            for pattern in ['*!*@host5.example.com', '*!*@*.example.org',
+                            'nick5!*@*', '*!*user5@*', 'nick5!*@host?.*']:
+                compiled = ircutils.HostmaskPattern(pattern)
+                regexp = compiled._compile()
+                started = time.time()
+                for _ in range(10):
+                    for hostmask in hostmasks:
+                        compiled.match(hostmask)
+                elapsed = time.time() - started
+                started = time.time()
+                for _ in range(10):
+                    for hostmask in hostmasks:
+                        regexp(hostmask)
+                regexpElapsed = time.time() - started
+                print('')
+                print('%s (%s): %.3fs, regexp: %.3fs' %
+                      (pattern, compiled.kind, elapsed, regexpElapsed))
+
     def testIsUserHostmask(self):
         self.failUnless(ircutils.isUserHostmask(self.hostmask))
         self.failUnless(ircutils.isUserHostmask('a!b@c'))
@@ -270,6 +322,10 @@ class FunctionsTestCase(SupyTestCase):
     def testToLower(self):
         self.assertEqual('jemfinch', ircutils.toLower('jemfinch'))
         self.assertEqual('{}|^', ircutils.toLower('[]\\~'))
+        self.assertEqual('{}|~', ircutils.toLower('[]\\~', 'strict-rfc1459'))
+        self.assertEqual('[]\\~', ircutils.toLower('[]\\~', 'ascii'))
+        self.assertEqual('foo\xc9', ircutils.toLower('FOO\xc9', 'ascii'))
+        self.assertRaises(ValueError, ircutils.toLower, 'foo', 'rfc7613')
 
     def testReplyTo(self):
         prefix = 'foo!bar@baz'
@@ -386,6 +442,10 @@ class IrcStringTestCase(SupyTestCase):
         self.assertEqual('#FOO', ircutils.IrcString('#FOO'))
         self.assertEqual(hash(ircutils.IrcString('#FOO')),
                          hash(ircutils.IrcString('#foo')))
+        self.assertEqual(ircutils.IrcString('[foo]'),
+                         ircutils.IrcString('{FOO}'))
+        s = ircutils.IrcString('Foo')
+        self.failUnless(ircutils.IrcString(s) is s)
 
     def testInequality(self):
         s1 = 'supybot'
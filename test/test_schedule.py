@@ -118,6 +118,16 @@ class TestSchedule(SupyTestCase):
         sched.run() # 3.4
         self.assertEqual(i[0], 3)
 
+    def testNextEventTime(self):
+        sched = schedule.Schedule()
+        self.assertEqual(sched.nextEventTime(), None)
+        now = time.time()
+        sched.addEvent(lambda: None, now + 3, 'later')
+        sched.addEvent(lambda: None, now + 1, 'sooner')
+        self.assertEqual(sched.nextEventTime(), now + 1)
+        sched.removeEvent('sooner')
+        self.assertEqual(sched.nextEventTime(), now + 3)
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
 
@@ -30,9 +30,12 @@
 
 from supybot.test import *
 
+import re
 import sys
+import copy
 import time
 import pickle
+import random
 import supybot.utils as utils
 from supybot.utils.structures import *
 import supybot.utils.minisix as minisix
@@ -391,6 +394,155 @@ class StrTest(SupyTestCase):
         self.failUnless(len(f('x'*35, 30)) <= 30)
         self.failUnless(f(' '.join(['xxxx']*10), 30)[:-3].endswith('xxxx'))
 
+    def testSafeRegexps(self):
+        original = utils.str.safeRegexps
+        utils.str.safeRegexps = True
+        try:
+            r = utils.str.perlReToPythonRe('m/(a+)+$/')
+            self.failUnless(utils.safere.isLinear(r))
+            self.failIf(r.search('a'*1000 + 'b'))
+            f = utils.str.perlReToReplacer('s/(\\w+) (\\w+)/\\2 \\1/g')
+            self.assertEqual(f('foo bar baz qux'), 'bar foo qux baz')
+            self.assertRaises(ValueError, utils.str.perlReToPythonRe, 'm/?/')
+        finally:
+            utils.str.safeRegexps = original
+
+
+class SafeReTest(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        # Tests the pure Python engine even if RE2 is installed.
+        self.re2 = utils.safere.re2
+        utils.safere.re2 = None
+        utils.safere._cache.clear()
+
+    def tearDown(self):
+        utils.safere.re2 = self.re2
+        utils.safere._cache.clear()
+        SupyTestCase.tearDown(self)
+
+    def testMatchesLikeRe(self):
+        cases = [('an+', 'bannnana'), ('(a)(n)?', 'banana'), ('^b', 'banana'),
+                 ('a$', 'banana\n'), ('(?m)^a', 'b\na\nc'), ('\\Z', 'ab\n'),
+                 ('\\bfoo\\b', 'a foo b'), ('\\Bo', 'foo'), ('\\b', ''),
+                 ('(a|ab)(c|bcd)(d*)', 'abcd'), ('x*', 'abxd'),
+                 ('[^a-c]+', 'abcdefa'), ('(?i)HELLO', 'say hello'),
+                 ('(?i)[A-Z]+', 'abcDEF'), ('\\d+\\s\\w+', 'x 12 ab!'),
+                 ('a.c', 'a\nc abc'), ('(?s)a.c', 'a\nc'), ('a{2,3}', 'a'*7),
+                 ('a{2,3}?', 'a'*7), ('(?P<x>o+)', 'foo boo'), ('.*?b', 'aaab'),
+                 ('(a|b)*c', 'ababc'), ('(?:(a)|b)*', 'ab'), ('[^\\W\\d]+', 'ab12cd')]
+        def describe(m):
+            return m and (m.span(), m.group(), m.groups(), m.groupdict())
+        for (pattern, s) in cases:
+            r = re.compile(pattern)
+            safe = utils.safere.compile(pattern)
+            self.failUnless(isinstance(safe, utils.safere.Pattern), pattern)
+            self.assertEqual(describe(safe.search(s)), describe(r.search(s)),
+                             pattern)
+            self.assertEqual(describe(safe.match(s)), describe(r.match(s)),
+                             pattern)
+            self.assertEqual(safe.findall(s), r.findall(s), pattern)
+            self.assertEqual(safe.sub('<\\g<0>>', s), r.sub('<\\g<0>>', s),
+                             pattern)
+
+    def testNullableRepeats(self):
+        # re ends a loop as soon as an iteration matches the empty string.
+        cases = [('(x??)+', 'xx'), ('(?:a|b??)+', 'ab'), ('(a*)*', 'baa'),
+                 ('(a|)+b', 'aab'), ('(?:x*)*?y', 'xxy'), ('(a?){2,5}', 'aa')]
+        for (pattern, s) in cases:
+            r = re.compile(pattern)
+            safe = utils.safere.compile(pattern)
+            self.assertEqual(safe.search(s).span(), r.search(s).span(),
+                             pattern)
+            self.assertEqual(safe.sub('_', s), r.sub('_', s), pattern)
+            self.assertEqual([m.span() for m in safe.finditer(s)],
+                             [m.span() for m in r.finditer(s)], pattern)
+
+    def testDifferential(self):
+        atoms = ['a', 'b', 'x', '.', '[ab]', '[^a]', '\\b', '\\B', '^', '$',
+                 '\\w', '\\s', '']
+        quantifiers = ['*', '+', '?', '*?', '+?', '??', '{0,2}', '{1,3}',
+                       '{2}', '{1,2}?', '{2,}']
+        rnd = random.Random(42)
+        def generate(depth=0):
+            r = rnd.random()
+            if depth > 3 or r < 0.3:
+                pattern = rnd.choice(atoms)
+            elif r < 0.5:
+                pattern = '(%s)' % generate(depth+1)
+            elif r < 0.6:
+                pattern = '(?:%s)' % generate(depth+1)
+            elif r < 0.75:
+                pattern = '(%s|%s)' % (generate(depth+1), generate(depth+1))
+            else:
+                pattern = generate(depth+1) + generate(depth+1)
+            if pattern not in ('', '^', '$', '\\b', '\\B') and \
+               pattern[-1] not in '*+?}' and rnd.random() < 0.4:
+                pattern += rnd.choice(quantifiers)
+            return pattern
+        # Older versions of re leave stale captures in some repeats.
+        withGroups = sys.version_info >= (3, 11)
+        def describe(m):
+            if m is None:
+                return None
+            elif withGroups:
+                return (m.span(), m.groups())
+            else:
+                return m.span()
+        for i in range(1500):
+            pattern = generate()
+            try:
+                r = re.compile(pattern)
+            except re.error:
+                continue
+            safe = utils.safere.compile(pattern)
+            for j in range(3):
+                s = ''.join(rnd.choice('abx \n')
+                            for k in range(rnd.randint(0, 6)))
+                msg = '%r on %r' % (pattern, s)
+                self.assertEqual(describe(safe.search(s)),
+                                 describe(r.search(s)), msg)
+                self.assertEqual([describe(m) for m in safe.finditer(s)],
+                                 [describe(m) for m in r.finditer(s)], msg)
+                self.assertEqual(safe.sub('<\\g<0>>', s),
+                                 r.sub('<\\g<0>>', s), msg)
+
+    def testUnsupported(self):
+        cases = [('(a)\\1', 'baa'), ('a(?=b)', 'ab'), ('(?<!a)b', 'cb'),
+                 ('(?:a{1000}){1000}', 'a'*1000000)]
+        for (pattern, s) in cases:
+            r = utils.safere.compile(pattern)
+            self.failIf(utils.safere.isLinear(r), pattern)
+            self.failUnless(r.search(s), pattern)
+        self.assertRaises(re.error, utils.safere.compile, '(')
+
+    def testLinear(self):
+        r = utils.safere.compile('(a+)+$')
+        self.failUnless(utils.safere.isLinear(r))
+        self.assertEqual(r.search('a'*5000 + 'b'), None)
+        self.assertEqual(r.search('b' + 'a'*5000).span(), (1, 5001))
+
+    def testSearchBefore(self):
+        r = utils.safere.compile('a[ab]{20}c')
+        self.failUnless(utils.safere.searchBefore(r, 'ba' + 'b'*20 + 'c',
+                                                  time.time() + 60))
+        self.failIf(utils.safere.searchBefore(r, 'ab'*20, time.time() + 60))
+        self.assertRaises(utils.safere.Timeout, utils.safere.searchBefore,
+                          r, 'ab'*20, time.time() - 1)
+
+    def testSub(self):
+        r = utils.safere.compile('(?P<first>\\w+) (\\w+)')
+        self.assertEqual(r.sub('\\2 \\g<first>', 'hello world foo bar'),
+                         'world hello bar foo')
+        self.assertEqual(r.subn(lambda m: m.group(2), 'a b c d', 1),
+                         ('b c d', 1))
+        self.assertRaises(re.error, r.sub, '\\3', 'a b')
+
+    def testPickle(self):
+        r = utils.safere.compile('(a)(b)?')
+        r = pickle.loads(pickle.dumps(r))
+        self.assertEqual(r.search('xa').groups(), ('a', None))
+
 
 class IterTest(SupyTestCase):
     def testLimited(self):
@@ -504,6 +656,27 @@ class FileTest(SupyTestCase):
         self.failUnless(utils.file.mktemp())
         self.failUnless(utils.file.mktemp())
 
+    def testJournal(self):
+        filename = os.path.join(conf.supybot.directories.data(),
+                                'JournalTest.txt')
+        for name in (filename, filename + '.journal'):
+            if os.path.exists(name):
+                os.remove(name)
+        journal = utils.file.Journal(filename, lambda key: '-%s\n' % key,
+                                     maxSize=3)
+        journal.update([('a', 'a 1\n'), ('b', 'b 1\n')])
+        # The file is written as soon as there is something to write.
+        self.assertEqual(utils.file.contents(filename), 'a 1\nb 1\n')
+        journal.update([('a', 'a 1\n'), ('b', 'b 2\n')])
+        journal.update([('a', None)])
+        self.assertEqual(utils.file.contents(filename), 'a 1\nb 1\n')
+        self.assertEqual(utils.file.contents(filename + '.journal'),
+                         'b 2\n-a\n')
+        journal.update([('c', 'c 1\n'), ('d', 'd 1\n')])
+        self.assertEqual(utils.file.contents(filename), 'b 2\nc 1\nd 1\n')
+        self.assertFalse(os.path.exists(filename + '.journal'))
+        journal.close()
+
 
 class NetTest(SupyTestCase):
     def testEmailRe(self):
@@ -687,6 +860,14 @@ class RingBufferTestCase(SupyTestCase):
         b = RingBuffer(10, range(10))
         self.assertEqual(pickle.loads(pickle.dumps(b)), b)
 
+    def testCopy(self):
+        b = RingBuffer(5, range(8))
+        b1 = copy.copy(b)
+        self.assertEqual(b, b1)
+        b.append(8)
+        self.assertEqual(list(b1), [3, 4, 5, 6, 7])
+        self.assertEqual(list(b), [4, 5, 6, 7, 8])
+
     def testEq(self):
         b = RingBuffer(3, range(3))
         self.failIf(b == list(range(3)))
@@ -1147,6 +1328,59 @@ class TestCacheDict(SupyTestCase):
             self.failUnless(i in d)
             self.failUnless(d[i] == i)
 
+    def testRecentlyUsedAreKept(self):
+        d = CacheDict(10)
+        for i in range(10):
+            d[i] = i
+        for i in range(100, 200):
+            d[0] # Keep it hot.
+            d[i] = i
+        self.assertEqual(d[0], 0)
+        self.assertEqual(len(d), 10)
+        self.failIf(1 in d)
+        (size, hits, misses, evictions) = d.stats()
+        self.assertEqual((size, evictions), (10, 100))
+        self.failUnless(hits >= 101)
+
+    def testDelete(self):
+        d = CacheDict(3)
+        d[1] = 1
+        d[2] = 2
+        d[3] = 3
+        del d[2]
+        d[2] = 'two'
+        d[4] = 4
+        self.assertEqual(len(d), 3)
+        self.assertEqual(d.stats()[3], 1)
+        self.assertEqual(d.get(2), 'two')
+        d.clear()
+        self.assertEqual(len(d), 0)
+        self.assertRaises(KeyError, d.__getitem__, 4)
+
+    def testTtl(self):
+        d = CacheDict(10, ttl=0.5)
+        d['foo'] = 'bar'
+        self.assertEqual(d['foo'], 'bar')
+        time.sleep(0.6)
+        self.failIf('foo' in d)
+        self.assertEqual(list(d), [])
+        d['foo'] = 'baz'
+        self.assertEqual(d['foo'], 'baz')
+
+    def testResize(self):
+        size = [10]
+        d = CacheDict(lambda: size[0])
+        for i in range(10):
+            d[i] = i
+        d.resize(5)
+        self.assertEqual(len(d), 5)
+        size[0] = 20
+        for i in range(10, 30):
+            d[i] = i
+            self.failUnless(len(d) <= 20)
+        self.assertEqual(d.max, 20)
+        self.assertEqual(len(d), 20)
+
 class TestTruncatableSet(SupyTestCase):
     def testBasics(self):
         s = TruncatableSet(['foo', 'bar', 'baz', 'qux'])